@@ -40,6 +40,7 @@ class Net2NetTransformer(L.LightningModule):
                 wp0 = 0.005, #initial lr ratio at the begging of lr warm up
                 wpe = 0.01, #final lr ratio at the end of training
                 twde = 0,
+                loss_chunk_size=1024,
                  ):
         super().__init__()
 
@@ -65,6 +66,8 @@ class Net2NetTransformer(L.LightningModule):
         self.wp0 = wp0
         self.wpe = wpe
         self.twde = twde or weight_decay
+        ## rows of the output head computed at a time by the training loss, None materializes the full logits
+        self.loss_chunk_size = loss_chunk_size
 
         self.strict_loading = False
 
@@ -110,7 +113,11 @@ class Net2NetTransformer(L.LightningModule):
             model.train = disabled_train
             self.cond_stage_model = model
 
-    def forward(self, x, c):
+    def forward(self, x, c, return_loss=False):
+        """
+        return: logits, target, or with return_loss the cross entropy computed by the transformer
+        in loss_chunk_size tiles without materializing the [B, N, vocab_size] logits
+        """
         # one step to produce the logits
         _, z_indices = self.encode_to_z(x)
         _, c_indices = self.encode_to_c(c)
@@ -129,6 +136,9 @@ class Net2NetTransformer(L.LightningModule):
         target = z_indices
         # make the prediction
         cz_indices = (a_indices[:, :-1], c_indices)  # not token factorization
+        if return_loss:
+            _, loss = self.transformer(cz_indices, targets=target, loss_chunk_size=self.loss_chunk_size)
+            return loss
         logits, _ = self.transformer(cz_indices)
         # cut off conditioning outputs - output i corresponds to p(z_i | z_{<i}, c)
         logits = logits[:, c_indices.shape[1] - 1:]
@@ -185,6 +195,8 @@ class Net2NetTransformer(L.LightningModule):
 
     def shared_step(self, batch, batch_idx):
         x, c = self.get_xc(batch)
+        if self.loss_chunk_size:
+            return self(x, c, return_loss=True)
         logits, target = self(x, c)
         loss = F.cross_entropy(logits.reshape(-1, logits.size(-1)), target.reshape(-1))
         return loss
@@ -1,3 +1,5 @@
+import time
+from collections import OrderedDict
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
@@ -45,6 +47,179 @@ def top_k_top_p_filtering(
     return logits
 
 
+def top_k_top_p_filtering_rows(
+        logits,
+        top_k=None,
+        top_p=None,
+        filter_value: float = -float("Inf"),
+        min_tokens_to_keep: int = 1,
+):
+    """Per-row version of top_k_top_p_filtering
+    top_k / top_p: [B] tensors (or scalars) with the parameters of each row, rows with
+    top_k <= 0 / top_p >= 1.0 are not filtered by that criterion
+    """
+    B, V = logits.shape
+    top_k = torch.as_tensor(0 if top_k is None else top_k, device=logits.device).long().view(-1).expand(B)
+    top_p = torch.as_tensor(1.0 if top_p is None else top_p, device=logits.device).float().view(-1).expand(B)
+    sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+
+    # top-k: remove everything below the k-th largest logit of the row
+    k = torch.where(top_k > 0, top_k.clamp(min=min_tokens_to_keep, max=V), torch.full_like(top_k, V))
+    kth_logit = sorted_logits.gather(1, (k - 1)[:, None])
+    sorted_indices_to_remove = sorted_logits < kth_logit
+    sorted_logits = sorted_logits.masked_fill(sorted_indices_to_remove, filter_value)
+
+    # top-p on what is left, keeping the first token above the threshold
+    cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
+    nucleus_to_remove = cumulative_probs > top_p[:, None]
+    nucleus_to_remove[..., 1:] = nucleus_to_remove[..., :-1].clone()
+    nucleus_to_remove[..., :min_tokens_to_keep] = 0
+    nucleus_to_remove &= (top_p < 1.0)[:, None]
+    sorted_indices_to_remove |= nucleus_to_remove
+
+    indices_to_remove = sorted_indices_to_remove.scatter(1, sorted_indices, sorted_indices_to_remove)
+    return logits.masked_fill(indices_to_remove, filter_value)
+
+
+def sample_top_k_top_p(
+        logits,
+        top_k=None,
+        top_p=None,
+        method: str = "gumbel",
+        min_tokens_to_keep: int = 1,
+        num_candidates: int = 64,
+):
+    """Sample from the top-k / top-p filtered distribution of logits [B, V] without sorting the vocabulary
+    Draws from the same distribution as top_k_top_p_filtering(_rows) + softmax + multinomial, but only
+    the candidates returned by torch.topk are ordered: top-k rows take their k best logits, rows with
+    top-p only start from num_candidates and double them until the nucleus is inside. The survivors
+    are sampled with the Gumbel-max trick (method="gumbel") or an inverse CDF (method="icdf").
+    top_k / top_p: scalars or [B] tensors, rows with top_k <= 0 / top_p >= 1.0 are not filtered by
+    that criterion (rows with neither are sampled over the whole vocabulary)
+    return: sampled token ids [B, 1]
+    """
+    B, V = logits.shape
+    per_row_params = isinstance(top_k, torch.Tensor) or isinstance(top_p, torch.Tensor)
+    top_k = torch.as_tensor(0 if top_k is None else top_k, device=logits.device).long().view(-1).expand(B)
+    top_p = torch.as_tensor(1.0 if top_p is None else top_p, device=logits.device).float().view(-1).expand(B)
+    with_k = top_k > 0
+    nucleus_only = ~with_k & (top_p < 1.0)
+    unfiltered = ~with_k & (top_p >= 1.0)
+    if per_row_params: # one host sync to size the candidate set
+        num_k, any_nucleus_only, any_unfiltered = top_k.max().item(), bool(nucleus_only.any()), bool(unfiltered.any())
+    else: # scalars, nothing to read back
+        num_k, any_nucleus_only, any_unfiltered = int(top_k[0]), bool(nucleus_only[0]), bool(unfiltered[0])
+
+    if any_unfiltered and not (num_k > 0 or any_nucleus_only):
+        return _sample_from_candidates(logits, method)
+    k = top_k.clamp(min=min_tokens_to_keep, max=V)
+    num = min(max(num_k, min_tokens_to_keep), V) if num_k > 0 else 0
+    if any_nucleus_only:
+        # top-p without top-k is normalized over the whole vocabulary, the candidates must cover top_p
+        probs = F.softmax(logits, dim=-1)
+        num_nucleus = min(num_candidates, V)
+        while num_nucleus < V:
+            mass = torch.topk(probs, num_nucleus)[0].sum(-1)
+            if bool((mass > top_p)[nucleus_only].all()):
+                break
+            num_nucleus = min(2 * num_nucleus, V)
+        num = max(num, num_nucleus)
+
+    candidate_logits, candidate_indices = torch.topk(logits, num) # sorted, largest first
+    position = torch.arange(num, device=logits.device)
+    candidate_logits = candidate_logits.masked_fill(with_k[:, None] & (position >= k[:, None]), -float("Inf"))
+
+    # top-p on the candidates, keeping the first token above the threshold
+    log_norm = torch.where(with_k, torch.logsumexp(candidate_logits, dim=-1), torch.logsumexp(logits, dim=-1))
+    cumulative_probs = torch.cumsum((candidate_logits - log_norm[:, None]).exp(), dim=-1)
+    nucleus_to_remove = cumulative_probs > top_p[:, None]
+    nucleus_to_remove[..., 1:] = nucleus_to_remove[..., :-1].clone()
+    nucleus_to_remove[..., :min_tokens_to_keep] = 0
+    nucleus_to_remove &= (top_p < 1.0)[:, None]
+    candidate_logits = candidate_logits.masked_fill(nucleus_to_remove, -float("Inf"))
+
+    next_token = candidate_indices.gather(1, _sample_from_candidates(candidate_logits, method))
+    if any_unfiltered:
+        next_token = torch.where(unfiltered[:, None], _sample_from_candidates(logits, method), next_token)
+    return next_token
+
+
+def _sample_from_candidates(logits, method):
+    """ index [B, 1] drawn from softmax(logits) ([B, N], -inf for removed entries) """
+    if method == "gumbel":
+        # argmax(logits + Gumbel noise), the noise written as -log(Exp(1))
+        noise = torch.empty_like(logits, dtype=torch.float).exponential_().log()
+        return (logits.float() - noise).masked_fill(logits == -float("Inf"), -float("Inf")).argmax(-1, keepdim=True)
+    if method == "icdf":
+        weights = (logits.float() - logits.max(-1, keepdim=True)[0].float()).exp()
+        cdf = torch.cumsum(weights, dim=-1)
+        u = torch.rand_like(cdf[:, :1]) * cdf[:, -1:]
+        last = (logits > -float("Inf")).sum(-1, keepdim=True) - 1 # u == total can only round onto the last survivor
+        return torch.searchsorted(cdf, u, right=True).clamp(max=last)
+    raise ValueError(f"Unknown sampling method {method}")
+
+
+def per_row(value, device, ndim=2):
+    """ scalar sampling parameters are used as is, per-row ones (one per sample) become a [B, 1]
+    column ([B, 1, 1] with ndim=3, to broadcast against [B, S, V] logits)
+    """
+    if isinstance(value, (list, tuple)) or isinstance(value, torch.Tensor):
+        return torch.as_tensor(value, device=device).view(-1, *[1] * (ndim - 1))
+    return value
+
+
+def cfg_enabled(cfg_scale):
+    """ null-class rows are needed when any sample uses a guidance scale above 1 """
+    if isinstance(cfg_scale, (list, tuple)) or isinstance(cfg_scale, torch.Tensor):
+        return bool((torch.as_tensor(cfg_scale) > 1.0).any())
+    return cfg_scale > 1.0
+
+
+class ChunkedLinearCrossEntropy(torch.autograd.Function):
+    """
+    F.cross_entropy(h @ weight.T, target) (mean over rows) computed over tiles of chunk_size rows,
+    so the [N, vocab_size] logits are never held: every tile's logits give its loss terms and, when
+    gradients are needed, are turned straight into the gradients of h and weight, backward only
+    scales them. Peak memory is a few [chunk_size, vocab_size] float32 tiles.
+    """
+    @staticmethod
+    def forward(ctx, h, weight, target, chunk_size, compute_grad):
+        N = h.shape[0]
+        loss = torch.zeros((), dtype=torch.float32, device=h.device)
+        grad_h = torch.empty_like(h) if compute_grad else None
+        grad_weight = torch.zeros(weight.shape, dtype=torch.float32, device=weight.device) if compute_grad else None
+        for start in range(0, N, chunk_size):
+            h_chunk, target_chunk = h[start:start + chunk_size], target[start:start + chunk_size]
+            logits = (h_chunk @ weight.T).float() # as F.cross_entropy upcasts under autocast
+            lse = torch.logsumexp(logits, dim=-1)
+            loss += (lse - logits.gather(1, target_chunk[:, None])[:, 0]).sum()
+            if compute_grad:
+                # d loss / d logits = (softmax - one_hot) / N, computed in place over the tile
+                grad_logits = logits.sub_(lse[:, None]).exp_()
+                grad_logits[torch.arange(len(target_chunk), device=h.device), target_chunk] -= 1.0
+                grad_logits.div_(N)
+                grad_h[start:start + chunk_size] = (grad_logits.to(weight.dtype) @ weight).to(h.dtype)
+                grad_weight += grad_logits.T.to(h_chunk.dtype) @ h_chunk
+        if compute_grad:
+            ctx.save_for_backward(grad_h, grad_weight.to(weight.dtype))
+        return loss / N
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad_h, grad_weight = ctx.saved_tensors
+        return grad_h * grad_output.to(grad_h.dtype), grad_weight * grad_output.to(grad_weight.dtype), None, None, None
+
+
+def chunked_cross_entropy(h, weight, target, chunk_size=1024):
+    """
+    Memory-bounded F.cross_entropy(F.linear(h, weight), target) for a bias-free output head
+    h: [..., D] hidden states, weight: [vocab_size, D], target: [...] token indices
+    """
+    h = h.reshape(-1, h.shape[-1])
+    compute_grad = torch.is_grad_enabled() and (h.requires_grad or weight.requires_grad)
+    return ChunkedLinearCrossEntropy.apply(h, weight, target.reshape(-1), chunk_size, compute_grad)
+
+
 def find_multiple(n: int, k: int):
     if n % k == 0:
         return n
@@ -198,6 +373,47 @@ class FeedForward(nn.Module):
         return self.ffn_dropout(self.w2(F.silu(self.w1(x)) * self.w3(x)))
 
 
+def length_causal_mask(seqlen, kv_len, device):
+    """ Mask for seqlen new queries at the end of a cache prefix of kv_len positions
+    None when no mask is needed: a single decoding query sees the whole prefix, and a
+    prefill from position 0 (seqlen == kv_len) is plain is_causal attention. Only a
+    prefill appended to an existing prefix builds a small [seqlen, kv_len] mask.
+    """
+    if seqlen == 1 or seqlen == kv_len:
+        return None
+    mask = torch.ones(seqlen, kv_len, dtype=torch.bool, device=device).tril(diagonal=kv_len - seqlen)
+    return mask[None, None]
+
+def row_prefix_mask(input_pos, kv_len):
+    """ Mask for rows decoding at different positions (continuous batching)
+    input_pos: [B, S] positions written by every row, row b only sees cache positions <= input_pos[b]
+    return: [B, 1, S, kv_len]
+    """
+    positions = torch.arange(kv_len, device=input_pos.device)
+    return (positions[None, None, :] <= input_pos[:, :, None])[:, None]
+
+def grouped_query_attention(xq, keys, values, n_rep, attn_mask=None, is_causal=False, dropout_p=0.0):
+    """ Attention of n_head query heads against n_head // n_rep shared key / value heads
+    The query heads of each group are folded into the sequence axis and attend to their
+    shared head directly, so the (cached) keys and values are never repeat_interleave'd.
+    xq: [B, H, S, D], keys / values: [B, H // n_rep, T, D], attn_mask: [B, 1, S, T] or None
+    """
+    if n_rep == 1:
+        return F.scaled_dot_product_attention(xq, keys, values, attn_mask=attn_mask, is_causal=is_causal, dropout_p=dropout_p)
+    if is_causal: # query i has to line up with key i, only used without a cache (training / no kv cache)
+        keys = keys.repeat_interleave(n_rep, dim=1)
+        values = values.repeat_interleave(n_rep, dim=1)
+        return F.scaled_dot_product_attention(xq, keys, values, attn_mask=attn_mask, is_causal=True, dropout_p=dropout_p)
+
+    B, H, S, D = xq.shape
+    xq = xq.reshape(B, H // n_rep, n_rep * S, D) # heads g * n_rep ... (g + 1) * n_rep - 1 share kv head g
+    if attn_mask is not None:
+        assert attn_mask.dim() == 4 and attn_mask.shape[1] == 1
+        attn_mask = attn_mask.unsqueeze(2).expand(-1, -1, n_rep, -1, -1).reshape(attn_mask.shape[0], 1, n_rep * S, -1)
+    output = F.scaled_dot_product_attention(xq, keys, values, attn_mask=attn_mask, dropout_p=dropout_p)
+    return output.reshape(B, H, S, D)
+
+
 class Attention(nn.Module):
     def __init__(self, config):
         super().__init__()
@@ -220,7 +436,8 @@ class Attention(nn.Module):
     def forward(
             self, x: torch.Tensor, freqs_cis: torch.Tensor = None,
             input_pos: Optional[torch.Tensor] = None,
-            mask: Optional[torch.Tensor] = None
+            mask: Optional[torch.Tensor] = None,
+            kv_len: Optional[int] = None
     ):
         bsz, seqlen, _ = x.shape
         kv_size = self.n_kv_head * self.head_dim
@@ -236,16 +453,16 @@ class Attention(nn.Module):
         xq, xk, xv = map(lambda x: x.transpose(1, 2), (xq, xk, xv))
 
         if self.kv_cache is not None:
-            keys, values = self.kv_cache.update(input_pos, xk, xv)
+            keys, values = self.kv_cache.update(input_pos, xk, xv, kv_len)
         else:
             keys, values = xk, xv
-        keys = keys.repeat_interleave(self.n_head // self.n_kv_head, dim=1)
-        values = values.repeat_interleave(self.n_head // self.n_kv_head, dim=1)
+        if kv_len is not None and mask is None: ## attend to the valid prefix of the cache, no dense mask
+            mask = length_causal_mask(seqlen, kv_len, x.device)
 
-        output = F.scaled_dot_product_attention(
-            xq, keys, values,
+        output = grouped_query_attention(
+            xq, keys, values, self.n_head // self.n_kv_head,
             attn_mask=mask,
-            is_causal=True if mask is None else False,  # is_causal=False is for KV cache
+            is_causal=seqlen > 1 and mask is None,  # prefill / training, a decoding query needs no mask
             dropout_p=self.attn_dropout_p if self.training else 0)
 
         output = output.transpose(1, 2).contiguous().view(bsz, seqlen, self.dim)
@@ -274,11 +491,11 @@ def precompute_freqs_cis_2d(grid_size: int, n_elem: int, base: int = 10000, cls_
 
 def apply_rotary_emb(x: torch.Tensor, freqs_cis: torch.Tensor):
     # x: (bs, seq_len, n_head, head_dim)
-    # freqs_cis (seq_len, head_dim // 2, 2)
+    # freqs_cis (seq_len, head_dim // 2, 2), or (bs, seq_len, head_dim // 2, 2) with per-row positions
     if not x.is_contiguous():
         x = x.contiguous()
     xshaped = x.float().view(*x.shape[:-1], -1, 2) # (bs, seq_len, n_head, head_dim//2, 2)
-    freqs_cis = freqs_cis.view(1, xshaped.size(1), 1, xshaped.size(3), 2) # (1, seq_len, 1, head_dim//2, 2)
+    freqs_cis = freqs_cis.view(-1, xshaped.size(1), 1, xshaped.size(3), 2) # (1 or bs, seq_len, 1, head_dim//2, 2)
     freqs_cis = freqs_cis.to(xshaped.dtype)
     x_out2 = torch.stack([
             xshaped[..., 0] * freqs_cis[..., 0] - xshaped[..., 1] * freqs_cis[..., 1],
@@ -308,34 +525,75 @@ class Block(nn.Module):
 
     def forward(
             self, x: torch.Tensor, cond_BD, freqs_cis: torch.Tensor, start_pos: int,
-            mask: Optional[torch.Tensor] = None):
+            mask: Optional[torch.Tensor] = None, kv_len: Optional[int] = None):
         if self.shared_aln:
             gamma1, gamma2, scale1, scale2, shift1, shift2 = (self.ada_gss + cond_BD).unbind(
                 2)  # 116C + B16C =unbind(2)=> 6 B1C
         else:
             gamma1, gamma2, scale1, scale2, shift1, shift2 = self.ada_lin(cond_BD).view(-1, 1, 6, self.C).unbind(2)
         h = x + self.drop_path(
-            self.attention(self.attention_norm(x).mul(scale1.add(1)).add_(shift1), freqs_cis, start_pos, mask).mul_(
+            self.attention(self.attention_norm(x).mul(scale1.add(1)).add_(shift1), freqs_cis, start_pos, mask, kv_len).mul_(
                 gamma1))
         out = h + self.drop_path(self.feed_forward(self.ffn_norm(h).mul(scale2.add(1)).add_(shift2)).mul(gamma2))
         return out
 
 
 class KVCache(nn.Module):
+    """
+    dtype: storage dtype of the cache, torch.int8 stores every cached key / value
+    vector as int8 with its own fp16 absmax scale (one per row, head and position)
+    and dequantizes the attended prefix on read
+    """
     def __init__(self, max_batch_size, max_seq_length, n_head, head_dim, dtype):
         super().__init__()
         cache_shape = (max_batch_size, n_head, max_seq_length, head_dim)
+        self.quantized = dtype == torch.int8
         self.register_buffer('k_cache', torch.zeros(cache_shape, dtype=dtype))
         self.register_buffer('v_cache', torch.zeros(cache_shape, dtype=dtype))
-
-    def update(self, input_pos, k_val, v_val):
-        # input_pos: [S], k_val: [B, H, S, D]
-        assert input_pos.shape[0] == k_val.shape[2]
-        k_out = self.k_cache
-        v_out = self.v_cache
-        k_out[:, :, input_pos] = k_val
-        v_out[:, :, input_pos] = v_val
-
+        if self.quantized:
+            scale_shape = (max_batch_size, n_head, max_seq_length, 1)
+            self.register_buffer('k_scale', torch.zeros(scale_shape, dtype=torch.float16))
+            self.register_buffer('v_scale', torch.zeros(scale_shape, dtype=torch.float16))
+
+    @staticmethod
+    def bytes_per_position(n_head, head_dim, dtype):
+        """ bytes of one cached position of one row (keys and values) """
+        if dtype == torch.int8:
+            return 2 * n_head * (head_dim + torch.finfo(torch.float16).bits // 8)
+        return 2 * n_head * head_dim * (torch.finfo(dtype).bits // 8)
+
+    @staticmethod
+    def quantize(x):
+        scale = x.abs().amax(dim=-1, keepdim=True).clamp(min=1e-6) / 127.
+        scale = scale.half()
+        return torch.round(x / scale.to(x.dtype)).clamp_(-127, 127).to(torch.int8), scale
+
+    def update(self, input_pos, k_val, v_val, kv_len=None):
+        # input_pos: [S] shared by all rows or [B, S] per row, k_val: [B, H, S, D]
+        assert input_pos.shape[-1] == k_val.shape[2]
+        bs = k_val.shape[0]
+        k_out = self.k_cache[:bs]
+        v_out = self.v_cache[:bs]
+        if input_pos.dim() == 2: # row b writes positions input_pos[b], the indexed values come as [B, S, H, D]
+            index = (torch.arange(bs, device=input_pos.device)[:, None], slice(None), input_pos)
+            k_new, v_new = k_val.transpose(1, 2), v_val.transpose(1, 2)
+        else:
+            index = (slice(None), slice(None), input_pos)
+            k_new, v_new = k_val, v_val
+        if self.quantized:
+            k_out[index], self.k_scale[:bs][index] = self.quantize(k_new)
+            v_out[index], self.v_scale[:bs][index] = self.quantize(v_new)
+        else:
+            k_out[index] = k_new.to(k_out.dtype)
+            v_out[index] = v_new.to(v_out.dtype)
+
+        kv_len = k_out.shape[2] if kv_len is None else kv_len
+        k_out, v_out = k_out[:, :, :kv_len], v_out[:, :, :kv_len]
+        if self.quantized:
+            k_out = k_out.to(k_val.dtype) * self.k_scale[:bs, :, :kv_len].to(k_val.dtype)
+            v_out = v_out.to(v_val.dtype) * self.v_scale[:bs, :, :kv_len].to(v_val.dtype)
+        elif k_out.dtype != k_val.dtype:
+            k_out, v_out = k_out.to(k_val.dtype), v_out.to(v_val.dtype)
         return k_out, v_out
 
 
@@ -458,26 +716,33 @@ class GPT(nn.Module):
             if not self.use_pretrained_codebook:
                 module.weight.data.normal_(mean=0.0, std=std)
 
-    def setup_caches(self, max_batch_size, max_seq_length, dtype):
+    def setup_caches(self, max_batch_size, max_seq_length, dtype, kv_cache_dtype=None):
+        """
+        kv_cache_dtype: storage dtype of the KV caches (torch.bfloat16, torch.float16 or
+        torch.int8), defaults to dtype
+        """
         # if self.max_seq_length >= max_seq_length and self.max_batch_size >= max_batch_size:
         #     return
         head_dim = self.config.n_embd // self.config.n_head
+        n_kv_head = self.config.n_kv_head if self.config.n_kv_head is not None else self.config.n_head
         max_seq_length = find_multiple(max_seq_length, 8)
         self.max_seq_length = max_seq_length
         self.max_batch_size = max_batch_size
         for b in self.blocks:
-            b.attention.kv_cache = KVCache(max_batch_size, max_seq_length, self.config.n_head, head_dim, dtype)
+            b.attention.kv_cache = KVCache(max_batch_size, max_seq_length, n_kv_head, head_dim, kv_cache_dtype or dtype)
 
-        causal_mask = torch.tril(torch.ones(self.max_seq_length, self.max_seq_length, dtype=torch.bool))
-        self.causal_mask = causal_mask.unsqueeze(0).repeat(self.max_batch_size, 1, 1)
         grid_size = int(self.config.block_size ** 0.5)
         assert grid_size * grid_size == self.config.block_size
         self.freqs_cis = precompute_freqs_cis_2d(grid_size, self.config.n_embd // self.config.n_head,
                                                  self.config.rope_base, self.config.cls_token_num)
 
     def forward(
-            self, idx, input_pos=None, mask=None, targets=None,
+            self, idx, input_pos=None, mask=None, targets=None, loss_chunk_size=1024,
     ):
+        """
+        targets: [B, T] tokens predicted by the last T positions, when given the loss is computed
+        by chunked_cross_entropy over loss_chunk_size rows at a time and the logits are not returned
+        """
         idx, idx_cls = idx[0], idx[1]
         token_embeddings = self.tok_emb(idx)  # each index maps to a (learnable) vector
         if self.use_pretrained_codebook:
@@ -493,18 +758,20 @@ class GPT(nn.Module):
         for block in self.blocks:
             h = block(h, cond_BD, freqs_cis, input_pos, mask)
         h = self.head_nm(h, cond_BD)
-        logits = self.head(h)
 
-        # if we are given some desired targets also calculate the loss
-        loss = None
+        # if we are given some desired targets only calculate the loss, tile by tile
         if targets is not None:
-            loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1))
+            loss = chunked_cross_entropy(h[:, -targets.shape[1]:], self.head.weight, targets, chunk_size=loss_chunk_size)
+            return None, loss
 
-        return logits, loss
+        logits = self.head(h)
+        return logits, None
 
-    def decode_tokens(self, idx, input_pos=None, targets=None, first_step=False, ):
+    def decode_tokens(self, idx, input_pos=None, targets=None, first_step=False, kv_len=None):
         """
         Inference Only
+        kv_len: number of valid cache positions after this step (input_pos[-1] + 1),
+        pass it to avoid reading input_pos back from the device
         """
         assert not self.training
         if first_step:
@@ -517,14 +784,14 @@ class GPT(nn.Module):
             cond_BD = self.class_emb(cls_idx, train=self.training)
 
         ### KV cache
-        bs = token_embeddings.shape[0]
-        mask = self.causal_mask[:bs, None, input_pos]
+        if kv_len is None:
+            kv_len = int(input_pos[-1]) + 1
         h = self.token_drop(token_embeddings)
 
         freq_cis = self.freqs_cis[input_pos]  # (cls_token_num+grid_size**2, head_dim // 2, 2) shape
         freq_cis = freq_cis.to(h.device)
         for block in self.blocks:
-            h = block(h, cond_BD, freq_cis, input_pos, mask)
+            h = block(h, cond_BD, freq_cis, input_pos, kv_len=kv_len)
 
         h = self.head_nm(h, cond_BD)
         logits = self.head(h)
@@ -535,73 +802,545 @@ class GPT(nn.Module):
 
         return logits, loss
 
+    def decode_rows(self, idx, cls_idx, input_pos, kv_len):
+        """
+        Inference Only, one decoding step of independent sequences (continuous batching)
+        idx: [B, 1] last sampled token of every row, cls_idx: [B, 1] class of every row
+        input_pos: [B] position written by every row, rows at position 0 start a new
+        sequence and are fed their class token instead of idx
+        kv_len: cache positions to read (max(input_pos) + 1), every row only attends to its own prefix
+        """
+        assert not self.training
+        assert self.config.cls_token_num == 1, "a new sequence is prefilled by a single decoding step"
+        cond_BD = self.class_emb(cls_idx, train=self.training)
+        token_embeddings = self.tok_emb(idx)
+        if self.use_pretrained_codebook:
+            token_embeddings = self.embedding_projection(token_embeddings)
+        h = self.token_drop(torch.where((input_pos == 0)[:, None, None], cond_BD, token_embeddings))
 
-@torch.no_grad()
-def sample_IBQ(x, model, steps, temperature=1., sample_logits=True,
-           top_k=None, top_p=None, callback=None, cfg_scale=1.0, token_factorization=False):
-    # x is conditioning
-    bs, _ = x.shape
-    device = x.device
-    assert x is not None
-    if cfg_scale > 1.0:
-        cond_token, uncond_token = torch.split(x, bs // 2, dim=0)
-        sample = cond_token
-    else:
-        sample = x
-
-    cond_len = x.shape[1]
-    if cfg_scale > 1.0:
-        max_batch_size = x.shape[0] // 2
-    else:
-        max_batch_size = x.shape[0]
-
-    max_seq_length = cond_len + steps
-    with torch.device(device):
-        max_batch_size_cfg = max_batch_size * 2 if cfg_scale > 1.0 else max_batch_size
-        model.setup_caches(max_batch_size=max_batch_size_cfg, max_seq_length=max_seq_length,
-                           dtype=model.class_emb.embedding_table.weight.dtype)
-
-    for n in range(steps):
-        if n == 0:  # prefill operation
-            input_pos = torch.arange(0, cond_len, device=device)  # C
-        elif n == 1:
-            input_pos = torch.tensor([cond_len], device=device)
-        else:
-            input_pos = input_pos + 1
+        input_pos = input_pos[:, None]
+        freq_cis = self.freqs_cis[input_pos].to(h.device) # (B, 1, head_dim // 2, 2)
+        mask = row_prefix_mask(input_pos, kv_len)
+        for block in self.blocks:
+            h = block(h, cond_BD, freq_cis, input_pos, mask=mask, kv_len=kv_len)
 
-        logits, _ = model.decode_tokens(x, input_pos=input_pos, first_step=(n == 0))
+        h = self.head_nm(h, cond_BD)
+        return self.head(h)
 
-        if cfg_scale > 1.0:
-            cond_logits, uncond_logits = torch.split(logits, bs // 2, dim=0)
+
+class IBQGenerationEngine:
+    """ Reusable decoding state for sample_IBQ
+    Owns the KV caches of `model` sized for max_batch_size rows
+    (conditional + unconditional rows when using cfg) and max_seq_length positions,
+    a preallocated buffer for the sampled tokens and the rotary table resident on the
+    device. Between calls the caches are reset in place instead of reallocated, so
+    repeated sampling does no allocation beyond the per-step activations.
+    """
+    def __init__(self, model, max_batch_size, max_seq_length, dtype=None, device=None, kv_cache_dtype=None):
+        self.model = model
+        self.device = torch.device(device) if device is not None else model.class_emb.embedding_table.weight.device
+        self.dtype = dtype if dtype is not None else model.class_emb.embedding_table.weight.dtype
+        self.kv_cache_dtype = kv_cache_dtype
+        with torch.device(self.device):
+            model.setup_caches(max_batch_size=max_batch_size, max_seq_length=max_seq_length, dtype=self.dtype,
+                               kv_cache_dtype=kv_cache_dtype)
+        self.max_batch_size = model.max_batch_size
+        self.max_seq_length = model.max_seq_length
+        self.kv_caches = [b.attention.kv_cache for b in model.blocks]
+        self.freqs_cis = model.freqs_cis.to(self.device)
+        self.tokens = torch.empty(self.max_batch_size, self.max_seq_length, dtype=torch.long, device=self.device)
+        self.step_tokens = torch.empty(self.max_batch_size, 1, dtype=torch.long, device=self.device)
+        self.last_stats = None
+
+    @classmethod
+    def for_model(cls, model, batch_size, seq_length, device, kv_cache_dtype=None):
+        """ reuse the engine attached to the model when it is large enough, otherwise build a new one """
+        engine = getattr(model, "generation_engine", None)
+        if (engine is None or engine.model is not model or engine.device != torch.device(device)
+                or engine.dtype != model.class_emb.embedding_table.weight.dtype
+                or engine.kv_cache_dtype != kv_cache_dtype
+                or engine.max_batch_size < batch_size or engine.max_seq_length < seq_length):
+            engine = cls(model, batch_size, seq_length, device=device, kv_cache_dtype=kv_cache_dtype)
+            model.generation_engine = engine
+        return engine
+
+    def fits(self, batch_size, seq_length):
+        return batch_size <= self.max_batch_size and seq_length <= self.max_seq_length
+
+    def bind(self):
+        """ hand the caches back to the model (another engine may have replaced them) """
+        for block, kv_cache in zip(self.model.blocks, self.kv_caches):
+            block.attention.kv_cache = kv_cache
+        self.model.freqs_cis = self.freqs_cis
+        self.model.max_batch_size = self.max_batch_size
+        self.model.max_seq_length = self.max_seq_length
+
+    def prefix_buffers(self):
+        """ cache buffers holding the class prefix (keys, values and int8 scales of every layer) """
+        return [buf for kv_cache in self.kv_caches for buf in kv_cache.buffers()]
+
+    def prefill_prefix(self, x):
+        """ prefill the class tokens x [M, cls_len] into the first M cache rows
+        return: logits of the last class position [M, 1, V]
+        """
+        cond_len = x.shape[1]
+        logits, _ = self.model.decode_tokens(x, input_pos=torch.arange(0, cond_len, device=x.device),
+                                             first_step=True, kv_len=cond_len)
+        return logits[:, -1:]
+
+    def reset(self):
+        """ hand the caches back to the model and clear them in place """
+        self.bind()
+        for kv_cache in self.kv_caches:
+            kv_cache.k_cache.zero_()
+            kv_cache.v_cache.zero_()
+
+    @torch.no_grad()
+    def generate(self, x, steps, temperature=1., sample_logits=True, top_k=None, top_p=None, cfg_scale=1.0,
+                 prefix_cache=None):
+        """
+        x: class tokens [B, cls_len] ([2B, cls_len], conditional then null class, when cfg_scale > 1)
+        temperature, top_k, top_p, cfg_scale: scalars or per-sample values ([B] tensors or lists),
+        so a batch can mix classes and sampling settings. As in the original sample_IBQ, top_p is only
+        applied when top_k is given (scalar or per-sample), top_k = 0 leaves a row to top_p alone
+        prefix_cache: PrefixKVCache to take the class prefill from
+        return: sampled tokens [B, steps]
+        """
+        bs, cond_len = x.shape
+        assert self.fits(bs, cond_len + steps), \
+            f"engine sized for {self.max_batch_size} x {self.max_seq_length}, got {bs} x {cond_len + steps}"
+        use_cfg = cfg_enabled(cfg_scale)
+        num_samples = bs // 2 if use_cfg else bs
+        device = x.device
+        cfg_scale, temperature = per_row(cfg_scale, device, ndim=3), per_row(temperature, device)
+        top_k, top_p = per_row(top_k, device), per_row(top_p, device)
+        if top_k is None:
+            top_p = None # top_p is only applied together with top_k, scalar or per-sample
+        self.reset()
+
+        t0 = time.time()
+        tokens = self.tokens[:num_samples, :steps]
+        step_tokens = self.step_tokens[:bs]
+        cond_token = x[:num_samples]
+        cls_idx = x if use_cfg else cond_token #conditional + null class rows, fixed for the whole loop
+        inputs = x
+        for n in range(steps):
+            if n == 0:  # prefill operation
+                input_pos = torch.arange(0, cond_len, device=device)  # C
+            elif n == 1:
+                input_pos = torch.tensor([cond_len], device=device)
+            else:
+                input_pos = input_pos + 1
+
+            if n == 0 and prefix_cache is not None:
+                logits = prefix_cache.prefill(self, x, num_null=bs - num_samples)
+            else:
+                logits, _ = self.model.decode_tokens(inputs, input_pos=input_pos, first_step=(n == 0), kv_len=cond_len + n)
+
+            if use_cfg:
+                cond_logits, uncond_logits = torch.split(logits, num_samples, dim=0)
+                logits = uncond_logits + (cond_logits - uncond_logits) * cfg_scale
+            logits = logits[:, -1, :] / temperature
+
+            if not sample_logits: # the most likely token always survives top-k / top-p
+                _, next_token = torch.topk(logits, k=1, dim=-1)
+            else:
+                next_token = sample_top_k_top_p(logits, top_k=top_k, top_p=top_p)
+            tokens[:, n] = next_token[:, 0]
+            step_tokens[:num_samples] = next_token
+            if use_cfg:
+                step_tokens[num_samples:] = next_token
+            inputs = (step_tokens, cls_idx)
+
+        sample = tokens.clone()
+        if device.type == "cuda":
+            torch.cuda.current_stream(device).synchronize() # not other streams (e.g. a decode worker)
+        seconds = time.time() - t0
+        self.last_stats = {"tokens": num_samples * steps, "seconds": seconds,
+                           "tokens_per_sec": num_samples * steps / max(seconds, 1e-9)}
+        return sample
+
+    @torch.no_grad()
+    def step_slots(self, tokens, cls_idx, input_pos, kv_len, cfg_scale, temperature, top_k, top_p, use_cfg,
+                   sample_logits=True):
+        """ One decoding step over the cache rows of a continuous batch (see ContinuousBatchingScheduler)
+        tokens: [R, 1] last token of every row, cls_idx: [R, 1] class of every row,
+        input_pos: [R] position of every row (0 starts a new sequence), kv_len: max(input_pos) + 1
+        with use_cfg rows 2s / 2s + 1 are the conditional / null-class rows of sequence s
+        cfg_scale, temperature, top_k, top_p: [S, 1] per sequence (top_k 0 / top_p 1.0 disable filtering,
+        top_k = top_p = None skips it for the whole batch)
+        return: next token of every sequence [S, 1]
+        """
+        logits = self.model.decode_rows(tokens, cls_idx, input_pos, kv_len)[:, -1]
+        if use_cfg:
+            cond_logits, uncond_logits = logits.view(-1, 2, logits.shape[-1]).unbind(1)
             logits = uncond_logits + (cond_logits - uncond_logits) * cfg_scale
-        logits = logits[:, -1, :] / temperature
+        logits = logits / temperature
+        if not sample_logits:
+            return torch.topk(logits, k=1, dim=-1)[1]
+        return sample_top_k_top_p(logits, top_k=top_k, top_p=top_p)
+
+
+class PrefixKVCache:
+    """ Bounded LRU of prefilled class prefixes, reused across batches
+    The prefill over the cls_token_num class positions only depends on the class label, so its
+    KV entries and the output of its last position are computed once per class and copied into
+    the cache rows of later sequences, which start straight at token 0. Labels of the null-class
+    (cfg) rows are pinned and shared by every pair, at most max_classes other labels are kept.
+    The entries belong to one model and are dropped when another model, dtype or cache storage is
+    used, or when a weight of the model is written in place (load_state_dict, an optimizer step) or
+    replaced.
+
+    Usage:
+        prefix_cache = PrefixKVCache(max_classes=1000)
+        for x in batches:
+            sample = sample_IBQ(x, model, steps, ..., prefix_cache=prefix_cache)
+    """
+    def __init__(self, max_classes=1000):
+        self.max_classes = max_classes
+        self.entries = OrderedDict() # label -> ([prefix of every cache buffer], last position output)
+        self.pinned = set()
+        self.model = None
+        self.key = None
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.entries.clear()
+        self.pinned.clear()
+
+    @staticmethod
+    def weights_version(model):
+        """ changes whenever a parameter of model is written in place or replaced """
+        return tuple((param.data_ptr(), param._version) for param in model.parameters())
+
+    def prefill(self, engine, x, num_null=0):
+        """ Write the class prefixes of x [B, cls_len] (the last num_null rows being null-class rows)
+        into the first B cache rows of engine, prefilling the classes that are not cached yet
+        return: prefill output of the last class position of every row
+        """
+        bs, cond_len = x.shape
+        key = (engine.dtype, engine.kv_cache_dtype, cond_len, self.weights_version(engine.model))
+        if engine.model is not self.model or key != self.key: # prefixes of other weights or cache storage are of no use
+            self.clear()
+            self.model, self.key = engine.model, key
+        labels = [tuple(row) for row in x.tolist()]
+        self.pinned.update(labels[bs - num_null:])
+        buffers = engine.prefix_buffers()
+
+        missing = list(dict.fromkeys(label for label in labels if label not in self.entries))
+        if missing:
+            output = engine.prefill_prefix(torch.tensor(missing, dtype=x.dtype, device=x.device))
+            for i, label in enumerate(missing):
+                self.entries[label] = ([buf[i, :, :cond_len].clone() for buf in buffers], output[i:i + 1].clone())
+        missing = set(missing)
+        self.misses += sum(label in missing for label in labels)
+        self.hits += sum(label not in missing for label in labels)
+
+        states = [self.entries[label] for label in labels]
+        for j, buf in enumerate(buffers):
+            buf[:bs, :, :cond_len] = torch.stack([prefix[j] for prefix, _ in states])
+        output = torch.cat([last for _, last in states])
+
+        for label in labels:
+            self.entries.move_to_end(label)
+        evictable = [label for label in self.entries if label not in self.pinned]
+        for label in evictable[:max(0, len(evictable) - self.max_classes)]:
+            del self.entries[label]
+        return output
 
+    def stats(self):
+        rows = self.hits + self.misses
+        return {"classes": len(self.entries), "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / rows if rows else 0.}
+
+
+class IBQSpeculativeEngine:
+    """ Speculative sampling for sample_IBQ, a small draft transformer proposing tokens for a large one
+    Both transformers have to share the tokenizer (vocabulary) and the class tokens, e.g. IBQ-AR-B
+    drafting for IBQ-AR-L / XL / XXL. Every round the draft samples num_draft tokens one by one,
+    the target scores all of them in a single forward over its KV cache, and each draft token d is
+    kept with probability min(1, p(d) / q(d)). The first rejected one is replaced by a sample of
+    norm(max(p - q, 0)) and when all are kept a bonus token is drawn from the target. p and q are
+    the distributions actually sampled from (cfg, temperature and top-k / top-p applied to both
+    models), so the output follows the sample_IBQ distribution of the target exactly.
+    The rows of a batch advance together by the shortest accepted run of the batch, which keeps
+    their cache positions aligned, every emitted token still follows the accept / resample rule.
+    """
+    def __init__(self, model, draft_model, max_batch_size, max_seq_length, num_draft=4, device=None, kv_cache_dtype=None):
+        assert model.config.vocab_size == draft_model.config.vocab_size, "draft and target must share the tokenizer"
+        assert model.config.class_num == draft_model.config.class_num, "draft and target must share the class tokens"
+        self.target = IBQGenerationEngine(model, max_batch_size, max_seq_length, device=device, kv_cache_dtype=kv_cache_dtype)
+        self.draft = IBQGenerationEngine(draft_model, max_batch_size, max_seq_length, device=device, kv_cache_dtype=kv_cache_dtype)
+        self.model = model
+        self.draft_model = draft_model
+        self.num_draft = num_draft
+        self.device = self.target.device
+        self.kv_cache_dtype = kv_cache_dtype
+        self.last_stats = None
+
+    @classmethod
+    def for_model(cls, model, draft_model, batch_size, seq_length, device, num_draft=4, kv_cache_dtype=None):
+        """ reuse the engine attached to the target model when it matches, otherwise build a new one """
+        engine = getattr(model, "speculative_engine", None)
+        if (engine is None or engine.model is not model or engine.draft_model is not draft_model
+                or engine.device != torch.device(device) or engine.kv_cache_dtype != kv_cache_dtype
+                or not engine.target.fits(batch_size, seq_length)):
+            engine = cls(model, draft_model, batch_size, seq_length, num_draft=num_draft, device=device,
+                         kv_cache_dtype=kv_cache_dtype)
+            model.speculative_engine = engine
+        engine.num_draft = num_draft
+        return engine
+
+    @staticmethod
+    def sampling_probs(logits, num_samples, cfg_scale, temperature, top_k, top_p):
+        """ distributions sample_IBQ samples from, logits: [rows, S, V] -> probs [B, S, V] """
+        if cfg_scale > 1.0:
+            cond_logits, uncond_logits = torch.split(logits, num_samples, dim=0)
+            logits = uncond_logits + (cond_logits - uncond_logits) * cfg_scale
+        B, S, V = logits.shape
+        logits = logits.reshape(B * S, V) / temperature
         if top_k is not None:
-            if top_k > 0 or top_p < 1.0:
-                logits = top_k_top_p_filtering(logits, top_k=top_k, top_p=top_p)
+            if top_k > 0 or (top_p is not None and top_p < 1.0):
+                logits = top_k_top_p_filtering(logits, top_k=top_k, top_p=1.0 if top_p is None else top_p)
+        return F.softmax(logits.float(), dim=-1).view(B, S, V)
 
-            probs = F.softmax(logits, dim=-1)
+    @torch.no_grad()
+    def generate(self, x, steps, temperature=1., top_k=None, top_p=None, cfg_scale=1.0, sample_logits=True):
+        """
+        x: class tokens [B, cls_len] ([2B, cls_len], conditional then null class, when cfg_scale > 1)
+        temperature, top_k, top_p, cfg_scale: scalars, as for sample_IBQ (per-sample values and
+        sample_logits=False are rejected, the accept / resample rule needs one sampled distribution)
+        return: sampled tokens [B, steps]
+        """
+        if not sample_logits:
+            raise ValueError("speculative sampling only samples (sample_logits=True), use sample_IBQ for greedy decoding")
+        if any(isinstance(value, (list, tuple, torch.Tensor)) for value in (temperature, top_k, top_p, cfg_scale)):
+            raise ValueError("speculative sampling takes scalar temperature / top_k / top_p / cfg_scale, "
+                             "use sample_IBQ for per-sample values")
+        bs, cond_len = x.shape
+        assert self.target.fits(bs, cond_len + steps), \
+            f"engine sized for {self.target.max_batch_size} x {self.target.max_seq_length}, got {bs} x {cond_len + steps}"
+        use_cfg = cfg_scale > 1.0
+        num_samples = bs // 2 if use_cfg else bs
+        device = x.device
+        probs = lambda logits: self.sampling_probs(logits, num_samples, cfg_scale, temperature, top_k, top_p)
+        rows = lambda t: torch.cat([t, t]) if use_cfg else t
+        target, draft = self.target.model, self.draft.model
+        self.target.reset()
+        self.draft.reset()
+
+        t0 = time.time()
+        tokens = self.target.tokens[:num_samples, :steps]
+        prefill_pos = torch.arange(0, cond_len, device=device)
+        logits, _ = target.decode_tokens(x, input_pos=prefill_pos, first_step=True, kv_len=cond_len)
+        draft.decode_tokens(x, input_pos=prefill_pos, first_step=True, kv_len=cond_len)
+        tokens[:, 0] = torch.multinomial(probs(logits[:, -1:])[:, 0], num_samples=1)[:, 0]
+
+        n = 1 # tokens emitted so far
+        draft_inputs = tokens[:, :1] # emitted tokens the draft has not read yet
+        rounds = proposed = accepted = 0
+        while n < steps:
+            k = min(self.num_draft, steps - n - 1)
+
+            ## draft k tokens autoregressively
+            pos = cond_len + n - draft_inputs.shape[1]
+            inputs, draft_tokens, draft_probs = draft_inputs, [], []
+            for i in range(k):
+                logits, _ = draft.decode_tokens((rows(inputs), x), input_pos=torch.arange(pos, pos + inputs.shape[1], device=device),
+                                                kv_len=pos + inputs.shape[1])
+                q = probs(logits[:, -1:])[:, 0]
+                inputs = torch.multinomial(q, num_samples=1)
+                pos += logits.shape[1]
+                draft_tokens.append(inputs)
+                draft_probs.append(q)
+
+            ## score the last emitted token and the k drafts with a single target forward
+            start = cond_len + n - 1
+            chunk = torch.cat([tokens[:, n - 1:n]] + draft_tokens, dim=1) # [B, k + 1]
+            logits, _ = target.decode_tokens((rows(chunk), x), input_pos=torch.arange(start, start + k + 1, device=device),
+                                             kv_len=start + k + 1)
+            p = probs(logits) # [B, k + 1, V]
+
+            n_acc = 0
+            if k > 0:
+                d = chunk[:, 1:]
+                q = torch.stack(draft_probs, dim=1) # [B, k, V]
+                p_d = p[:, :k].gather(-1, d[..., None])[..., 0]
+                q_d = q.gather(-1, d[..., None])[..., 0]
+                run = (torch.rand_like(p_d) * q_d < p_d).long().cumprod(dim=1).sum(dim=1) # leading accepted drafts
+                n_acc = int(run.min())
+                proposed += k * num_samples
+                accepted += int(run.sum())
+            if n_acc < k: # rows that rejected draft n_acc resample it from the residual, the others keep it
+                residual = (p[:, n_acc] - q[:, n_acc]).clamp(min=0)
+                residual = torch.where(residual.sum(-1, keepdim=True) > 0, residual, p[:, n_acc])
+                last = torch.where(run > n_acc, d[:, n_acc], torch.multinomial(residual, num_samples=1)[:, 0])
+            else: # every draft kept, bonus token from the target
+                last = torch.multinomial(p[:, k], num_samples=1)[:, 0]
+            tokens[:, n:n + n_acc] = chunk[:, 1:1 + n_acc]
+            tokens[:, n + n_acc] = last
+
+            ## the draft has read its inputs up to draft k - 2, after a full acceptance draft k - 1 is still unread
+            first_unread = n + n_acc - 1 if (k > 0 and n_acc == k) else n + n_acc
+            draft_inputs = tokens[:, first_unread:n + n_acc + 1]
+            n += n_acc + 1
+            rounds += 1
+
+        sample = tokens.clone()
+        if device.type == "cuda":
+            torch.cuda.current_stream(device).synchronize() # not other streams (e.g. a decode worker)
+        seconds = time.time() - t0
+        self.last_stats = {"tokens": num_samples * steps, "seconds": seconds,
+                           "tokens_per_sec": num_samples * steps / max(seconds, 1e-9),
+                           "acceptance_rate": accepted / max(proposed, 1),
+                           "tokens_per_round": (steps - 1) / max(rounds, 1), "rounds": rounds}
+        return sample
+
+
+def plan_kv_cache_batch(model, memory_budget, seq_length, kv_cache_dtype=None, cfg=True):
+    """ Largest number of images whose KV caches fit in memory_budget bytes
+    seq_length: class tokens + image tokens, cfg: every image also needs a null-class row
+    """
+    dtype = kv_cache_dtype or model.class_emb.embedding_table.weight.dtype
+    n_kv_head = model.config.n_kv_head if model.config.n_kv_head is not None else model.config.n_head
+    head_dim = model.config.n_embd // model.config.n_head
+    bytes_per_row = (len(model.blocks) * find_multiple(seq_length, 8)
+                     * KVCache.bytes_per_position(n_kv_head, head_dim, dtype))
+    bytes_per_image = bytes_per_row * (2 if cfg else 1)
+    return {"bytes_per_image": bytes_per_image, "max_batch_size": int(memory_budget // bytes_per_image)}
 
-            if not sample_logits:
-                _, x = torch.topk(probs, k=1, dim=-1)
-            else:
-                x = torch.multinomial(probs, num_samples=1)
-            # append to the sequence and continue
-            sample = torch.cat((sample, x), dim=1)
-            if cfg_scale > 1.0:
-                x = (torch.concat([x, x]),  torch.concat([cond_token, uncond_token]))
-            else:
-                x = (x, cond_token)
-    sample = sample[:, cond_len:]  # cut conditioning off
-    return sample
 
+@torch.no_grad()
+def kv_cache_logit_kl(model, x, tokens, kv_cache_dtype, cfg_scale=1.0):
+    """ Quality check of a compressed KV cache against the full precision one
+    Both caches are fed the same (teacher forced) tokens, e.g. a sample_IBQ output, and
+    the per-step next token distributions (after cfg) are compared.
+    x: class tokens as passed to sample_IBQ, tokens: [B, steps]
+    return: {'mean_kl', 'max_kl'} of KL(full precision || compressed) in nats
+    """
+    bs, cond_len = x.shape
+    steps = tokens.shape[1]
+    use_cfg = cfg_scale > 1.0
+    num_samples = bs // 2 if use_cfg else bs
+    dtype = model.class_emb.embedding_table.weight.dtype
+
+    def step_log_probs(cache_dtype):
+        with torch.device(x.device):
+            model.setup_caches(max_batch_size=bs, max_seq_length=cond_len + steps, dtype=dtype,
+                               kv_cache_dtype=cache_dtype)
+        log_probs = []
+        for n in range(steps):
+            if n == 0:
+                inputs, input_pos = x, torch.arange(0, cond_len, device=x.device)
+            else:
+                prev = tokens[:, n - 1:n]
+                inputs = (torch.cat([prev, prev]) if use_cfg else prev, x)
+                input_pos = torch.tensor([cond_len + n - 1], device=x.device)
+            logits, _ = model.decode_tokens(inputs, input_pos=input_pos, first_step=(n == 0), kv_len=cond_len + n)
+            logits = logits[:, -1].float()
+            if use_cfg:
+                cond_logits, uncond_logits = torch.split(logits, num_samples, dim=0)
+                logits = uncond_logits + (cond_logits - uncond_logits) * cfg_scale
+            log_probs.append(F.log_softmax(logits, dim=-1))
+        return torch.stack(log_probs, dim=1) # [B, steps, V]
+
+    reference = step_log_probs(None)
+    compressed = step_log_probs(kv_cache_dtype)
+    kl = (reference.exp() * (reference - compressed)).sum(-1)
+    return {"mean_kl": kl.mean().item(), "max_kl": kl.max().item()}
 
 
+@torch.no_grad()
+def sample_IBQ(x, model, steps, temperature=1., sample_logits=True,
+           top_k=None, top_p=None, callback=None, cfg_scale=1.0, token_factorization=False, engine=None,
+           kv_cache_dtype=None, prefix_cache=None):
+    # x is conditioning
+    if engine is None:
+        engine = IBQGenerationEngine.for_model(model, x.shape[0], x.shape[1] + steps, x.device,
+                                               kv_cache_dtype=kv_cache_dtype)
+    return engine.generate(x, steps, temperature=temperature, sample_logits=sample_logits,
+                           top_k=top_k, top_p=top_p, cfg_scale=cfg_scale, prefix_cache=prefix_cache)
 
 
+@torch.no_grad()
+def speculative_sample_IBQ(x, model, draft_model, steps, temperature=1., top_k=None, top_p=None, cfg_scale=1.0,
+                           num_draft=4, engine=None, kv_cache_dtype=None, sample_logits=True):
+    """ sample_IBQ with draft_model proposing num_draft tokens per target forward, see IBQSpeculativeEngine """
+    if engine is None:
+        engine = IBQSpeculativeEngine.for_model(model, draft_model, x.shape[0], x.shape[1] + steps, x.device,
+                                                num_draft=num_draft, kv_cache_dtype=kv_cache_dtype)
+    return engine.generate(x, steps, temperature=temperature, top_k=top_k, top_p=top_p, cfg_scale=cfg_scale,
+                           sample_logits=sample_logits)
 
 
+@torch.no_grad()
+def benchmark_speculative(x, model, draft_model, steps, num_draft=4, repeats=3, **sampling):
+    """ Wall-clock of speculative_sample_IBQ against sample_IBQ on the target alone
+    sampling: temperature / top_k / top_p / cfg_scale, as for sample_IBQ
+    return: {'acceptance_rate', 'tokens_per_round', 'target_seconds', 'speculative_seconds', 'speedup'}
+    """
+    def best_time(fn):
+        seconds = []
+        for _ in range(repeats):
+            if x.device.type == "cuda":
+                torch.cuda.synchronize(x.device)
+            t = time.time()
+            fn()
+            if x.device.type == "cuda":
+                torch.cuda.synchronize(x.device)
+            seconds.append(time.time() - t)
+        return min(seconds)
+
+    target_seconds = best_time(lambda: sample_IBQ(x, model, steps, **sampling))
+    speculative_seconds = best_time(lambda: speculative_sample_IBQ(x, model, draft_model, steps, num_draft=num_draft, **sampling))
+    stats = model.speculative_engine.last_stats
+    return {"acceptance_rate": stats["acceptance_rate"], "tokens_per_round": stats["tokens_per_round"],
+            "target_seconds": target_seconds, "speculative_seconds": speculative_seconds,
+            "speedup": target_seconds / speculative_seconds}
 
 
+@torch.no_grad()
+def check_top_k_top_p_sampler(logits, top_k=None, top_p=None, method="gumbel", num_samples=200000, batch_size=10000):
+    """ Chi-square test of sample_top_k_top_p against the filtered distribution of the sorting path
+    logits: [V] one next token distribution, top_k / top_p: scalars as for top_k_top_p_filtering
+    return: {'chi2', 'dof', 'p_value', 'outside'} where outside counts samples the filter removes
+    """
+    V = logits.shape[-1]
+    reference = F.softmax(top_k_top_p_filtering_rows(logits.view(1, V).clone(), top_k=top_k, top_p=top_p), dim=-1)[0]
+    counts = torch.zeros(V, dtype=torch.float64, device=logits.device)
+    for start in range(0, num_samples, batch_size):
+        rows = logits.view(1, V).expand(min(batch_size, num_samples - start), V)
+        token = sample_top_k_top_p(rows, top_k=top_k, top_p=top_p, method=method)[:, 0]
+        counts += torch.bincount(token, minlength=V).double()
+    expected = reference.double() * num_samples
+    support = expected > 0
+    chi2 = ((counts - expected)[support] ** 2 / expected[support]).sum()
+    dof = int(support.sum()) - 1
+    p_value = torch.special.gammaincc(torch.tensor(dof / 2, dtype=torch.float64), chi2.cpu() / 2) if dof > 0 else torch.tensor(1.)
+    return {"chi2": chi2.item(), "dof": dof, "p_value": p_value.item(), "outside": int(counts[~support].sum())}
 
 
+@torch.no_grad()
+def benchmark_top_k_top_p(logits, top_k=None, top_p=None, repeats=100):
+    """ Milliseconds per sampling step of one [B, V] logits batch: full sort (top_k_top_p_filtering_rows
+    + softmax + multinomial) against sample_top_k_top_p with the Gumbel-max and inverse CDF draws
+    """
+    def sort_path():
+        filtered = top_k_top_p_filtering_rows(logits, top_k=top_k, top_p=top_p)
+        return torch.multinomial(F.softmax(filtered, dim=-1), num_samples=1)
+
+    def best_ms(fn):
+        fn() # warm up
+        if logits.device.type == "cuda":
+            torch.cuda.synchronize(logits.device)
+        t = time.time()
+        for _ in range(repeats):
+            fn()
+        if logits.device.type == "cuda":
+            torch.cuda.synchronize(logits.device)
+        return (time.time() - t) * 1000 / repeats
+
+    return {"sort": best_ms(sort_path),
+            "gumbel": best_ms(lambda: sample_top_k_top_p(logits, top_k, top_p, method="gumbel")),
+            "icdf": best_ms(lambda: sample_top_k_top_p(logits, top_k, top_p, method="icdf"))}
@@ -8,4 +8,6 @@ from .random_erasing import *
 from .ucf101 import *
 from .utils import *
 from .video_transforms import *
-from .volume_transforms import *
\ No newline at end of file
+from .volume_transforms import *
+from .video_reader import *
+from .video_writer import *
\ No newline at end of file
@@ -0,0 +1,189 @@
+import os
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import imageio
+from decord import VideoReader, cpu
+
+_END_OF_VIDEO = object()
+
+def plan_frame_sampling(video_path, target_fps=None, target_duration=None, start_time=0.0, max_frames=None, num_threads=0):
+    """ Decide which frames of a video to decode before reading any of them
+    Frames are taken on a fixed time grid (target_fps, never above the source fps)
+    over [start_time, start_time + target_duration), so every clip gets the same
+    temporal density and the tokenization cost per second of video is predictable.
+    The requested frames are then grouped by keyframe interval (GOP): inside a group
+    the decoder only moves forward, and between groups the planner picks whatever
+    is cheaper, decoding on through the gap or seeking to the next keyframe.
+
+    Args:
+        video_path: path to the video file
+        target_fps: sampling rate in frames per second (None keeps the source fps)
+        target_duration: seconds of video to sample (None until the end)
+        start_time: first second to sample
+        max_frames: cap on the number of sampled frames (shortens the duration, keeps the fps)
+        num_threads: decord decoding threads (0 lets decord decide)
+    Returns:
+        dict: {
+            'indices': sorted frame indices to read,
+            'groups': the indices split by keyframe interval,
+            'source_fps', 'fps': fps of the file and of the sampled frames,
+            'duration': seconds covered by the sampled frames,
+            'num_seeks': keyframe seeks needed to read the groups in order,
+            'decoded_frames': frames the decoder has to decode to produce them,
+            'used_frames': frames actually used (len(indices)),
+            'num_threads': decoding threads to use when reading
+        }
+    """
+    vr = VideoReader(video_path, ctx=cpu(0), num_threads=num_threads)
+    total_frames = len(vr)
+    source_fps = float(vr.get_avg_fps())
+    keyframes = np.asarray(vr.get_key_indices(), dtype=int)
+    if len(keyframes) == 0 or keyframes[0] != 0:
+        keyframes = np.concatenate([[0], keyframes]).astype(int)
+    del vr
+
+    fps = source_fps if target_fps is None else min(float(target_fps), source_fps)
+    end_time = total_frames / source_fps
+    if target_duration is not None:
+        end_time = min(end_time, start_time + target_duration)
+
+    ## fixed time grid mapped to the nearest source frame
+    timestamps = np.arange(start_time, end_time, 1.0 / fps)
+    if max_frames is not None:
+        timestamps = timestamps[:max_frames]
+    indices = np.clip(np.round(timestamps * source_fps).astype(int), 0, total_frames - 1)
+    indices = np.unique(indices)
+
+    ## group by keyframe interval and count what the decoder has to do
+    gop = np.searchsorted(keyframes, indices, side="right") - 1
+    split_points = np.nonzero(np.diff(gop))[0] + 1
+    groups = np.split(indices, split_points) if len(indices) > 0 else []
+    num_seeks = 0
+    decoded_frames = 0
+    position = -1 #last decoded frame
+    for group in groups:
+        keyframe = keyframes[np.searchsorted(keyframes, group[0], side="right") - 1]
+        sequential_cost = group[0] - position
+        seek_cost = group[0] - keyframe + 1
+        if position < 0 or seek_cost < sequential_cost:
+            num_seeks += 1
+            decoded_frames += seek_cost
+        else:
+            decoded_frames += sequential_cost
+        decoded_frames += group[-1] - group[0]
+        position = group[-1]
+
+    return {
+        "indices": indices,
+        "groups": groups,
+        "source_fps": source_fps,
+        "fps": fps,
+        "duration": len(indices) / fps,
+        "num_seeks": num_seeks,
+        "decoded_frames": int(decoded_frames),
+        "used_frames": len(indices),
+        "num_threads": num_threads,
+    }
+
+def iter_video_windows(video_path, window_size, transforms=None, frame_indices=None, prefetch=2, num_threads=0):
+    """ Read a video window by window instead of loading the whole clip
+    A background thread decodes the next windows with decord (and applies the
+    transforms) while the consumer is still encoding the current one. At most
+    `prefetch` windows are waiting in the queue, so peak memory is proportional
+    to window_size and not to the length of the video.
+
+    Args:
+        video_path: path to the video file
+        window_size: number of frames per window
+        transforms: clip transform applied to every uint8 window [t, H, W, C]
+            (e.g. Resize + CenterCrop + ClipToTensor + Normalize)
+        frame_indices: frames to read, all the frames of the video by default
+        prefetch: number of decoded windows kept ahead of the consumer
+        num_threads: decord decoding threads (0 lets decord decide)
+    Yields:
+        (window, indices): the transformed window and the frame indices it holds
+    """
+    vr = VideoReader(video_path, ctx=cpu(0), num_threads=num_threads)
+    if frame_indices is None:
+        frame_indices = np.arange(0, len(vr), dtype=int)
+    frame_indices = np.asarray(frame_indices, dtype=int)
+
+    windows = queue.Queue(maxsize=max(1, prefetch))
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                windows.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False #consumer went away
+
+    def read():
+        try:
+            for start in range(0, len(frame_indices), window_size):
+                indices = frame_indices[start:start + window_size]
+                frames = vr.get_batch(indices).asnumpy().astype(np.uint8)
+                if transforms is not None:
+                    frames = transforms(frames)
+                if not put((frames, indices)):
+                    return
+        except Exception as e: ##re-raised in the consumer thread
+            put(e)
+            return
+        put(_END_OF_VIDEO)
+
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+    try:
+        while True:
+            item = windows.get()
+            if item is _END_OF_VIDEO:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        reader.join()
+
+def save_video_frames(video_path, output_dir, interval=0.5, filename="frame_{time:.1f}.png", batch_size=32, num_workers=4, num_threads=0):
+    """ Save one frame every `interval` seconds as an image
+    Only the target frames are decoded (decord get_batch seeks to them), in batches
+    of batch_size, and the images are encoded and written by a thread pool while the
+    next batch is being decoded. The frames saved are the same as reading the video
+    sequentially and keeping every int(fps * interval)-th frame.
+
+    Args:
+        video_path: path to the video file
+        output_dir: directory for the images
+        interval: seconds between saved frames
+        filename: format string for the image names, gets the time of the frame (`time`)
+        batch_size: frames decoded per get_batch call
+        num_workers: image writer threads
+        num_threads: decord decoding threads (0 lets decord decide)
+    Returns:
+        int: number of saved frames
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    vr = VideoReader(video_path, ctx=cpu(0), num_threads=num_threads)
+    frame_interval = max(1, int(vr.get_avg_fps() * interval))
+    frame_indices = np.arange(0, len(vr), frame_interval, dtype=int)
+
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as pool:
+        pending = []
+        for start in range(0, len(frame_indices), batch_size):
+            frames = vr.get_batch(frame_indices[start:start + batch_size]).asnumpy()
+            for offset, frame in enumerate(frames):
+                count = start + offset
+                path = os.path.join(output_dir, filename.format(time=count * interval))
+                pending.append(pool.submit(imageio.imwrite, path, frame))
+            ## keep at most one decoded batch queued behind the writers
+            while len(pending) > batch_size:
+                pending.pop(0).result()
+        for future in pending:
+            future.result()
+    return len(frame_indices)
@@ -0,0 +1,64 @@
+from fractions import Fraction
+import torch
+import av
+
+_UINT8_MAX_F = float(torch.iinfo(torch.uint8).max)
+
+class VideoStreamWriter:
+    """ Append video chunks to a single file as they are produced
+    Chunks in [-1, 1] are converted to uint8 on their own device and only the
+    uint8 frames are copied to the host and handed to PyAV, so neither a segment
+    file per window nor a copy of the whole video in RAM is needed.
+
+    Usage:
+        with VideoStreamWriter("out.mp4", fps=24) as writer:
+            for chunk in chunks: # [C, T, H, W] or [1, C, T, H, W]
+                writer.write(chunk)
+    """
+    def __init__(self, path, fps=24, codec="libx264", pix_fmt="yuv420p", options=None):
+        self.path = path
+        self.fps = fps
+        self.codec = codec
+        self.pix_fmt = pix_fmt
+        self.options = options or {}
+        self.container = av.open(path, mode="w")
+        self.stream = None
+        self.num_frames = 0
+
+    def _open_stream(self, height, width):
+        self.stream = self.container.add_stream(self.codec, rate=Fraction(self.fps).limit_denominator(10000), options=self.options)
+        self.stream.width = width
+        self.stream.height = height
+        self.stream.pix_fmt = self.pix_fmt
+
+    def write(self, chunk):
+        """
+        chunk: tensor [C T H W] (or [1 C T H W]) in [-1, 1]
+        """
+        if chunk.dim() == 5:
+            if chunk.shape[0] != 1:
+                raise ValueError(f"Expected a single video, got a batch of {chunk.shape[0]}")
+            chunk = chunk[0]
+        frames = (torch.clamp(chunk.detach(), -1., 1.) + 1.0) / 2.0
+        frames = (frames * _UINT8_MAX_F + 0.5).to(torch.uint8) #on device
+        frames = frames.permute(1, 2, 3, 0).contiguous().cpu().numpy() #[T H W C]
+
+        if self.stream is None:
+            self._open_stream(frames.shape[1], frames.shape[2])
+        for frame in frames:
+            frame = av.VideoFrame.from_ndarray(frame, format="rgb24")
+            for packet in self.stream.encode(frame):
+                self.container.mux(packet)
+        self.num_frames += len(frames)
+
+    def close(self):
+        if self.stream is not None:
+            for packet in self.stream.encode(): #flush
+                self.container.mux(packet)
+        self.container.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
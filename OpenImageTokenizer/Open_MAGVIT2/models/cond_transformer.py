@@ -1,4 +1,4 @@
-import os, math
+import os, math, time
 import torch
 import torch.nn.functional as F
 import lightning as L
@@ -13,6 +13,31 @@ def disabled_train(self, mode=True):
     return self
 
 
+@torch.no_grad()
+def benchmark_sample(model, x, c, steps, repeats=3, seed=0, **sampling):
+    """ Wall-clock of Net2NetTransformer.sample with the kv cache against the full recompute path
+    sampling: temperature / sample / top_k, as for sample; both paths are run from the same seed
+    return: {'equal', 'recompute_seconds', 'cached_seconds', 'speedup'}, equal: same tokens from both
+    """
+    def best_time(use_cache):
+        seconds = []
+        for _ in range(repeats):
+            torch.manual_seed(seed)
+            if x.device.type == "cuda":
+                torch.cuda.synchronize(x.device)
+            t = time.time()
+            index = model.sample(x, c, steps, use_cache=use_cache, **sampling)
+            if x.device.type == "cuda":
+                torch.cuda.synchronize(x.device)
+            seconds.append(time.time() - t)
+        return min(seconds), index
+
+    recompute_seconds, recompute_index = best_time(use_cache=False)
+    cached_seconds, cached_index = best_time(use_cache=True)
+    return {"equal": torch.equal(recompute_index, cached_index), "recompute_seconds": recompute_seconds,
+            "cached_seconds": cached_seconds, "speedup": recompute_seconds / cached_seconds}
+
+
 class Net2NetTransformer(L.LightningModule):
     def __init__(self,
                  transformer_config,
@@ -143,13 +168,37 @@ class Net2NetTransformer(L.LightningModule):
         out[out < v[..., [-1]]] = -float('Inf')
         return out
 
+    def sample_logits(self, logits, temperature=1.0, sample=False, top_k=None):
+        """ next token (b, 1) from the last position logits (b, vocab_size) """
+        # scale by temperature
+        logits = logits / temperature
+        # optionally crop probabilities to only the top k options
+        if top_k is not None:
+            logits = self.top_k_logits(logits, top_k)
+        # apply softmax to convert to probabilities
+        probs = F.softmax(logits, dim=-1)
+        # sample from the distribution or take the most likely
+        if sample:
+            ix = torch.multinomial(probs, num_samples=1)
+        else:
+            _, ix = torch.topk(probs, k=1, dim=-1)
+        return ix
+
     @torch.no_grad()
     def sample(self, x, c, steps, temperature=1.0, sample=False, top_k=None,
-               callback=lambda k: None):
-        x = torch.cat((c,x),dim=1)
+               callback=lambda k: None, use_cache=True):
+        """
+        x: given first tokens (b, t), c: class indices (b, 1), return: x continued by steps tokens, (b, steps)
+        use_cache: forward only the new token each step against a preallocated kv cache (sample_with_cache),
+        False reruns the transformer over the whole sequence for every token (same tokens under a fixed seed)
+        """
         block_size = self.transformer.get_block_size()
         assert not self.transformer.training
+        if self.pkeep > 0.0 and use_cache:
+            return self.sample_with_cache(x, c, steps, temperature=temperature, sample=sample,
+                                          top_k=top_k, callback=callback)
         if self.pkeep <= 0.0:
+            x = torch.cat((c,x),dim=1)
             # one pass suffices since input is pure noise anyway
             assert len(x.shape)==2
             noise_shape = (x.shape[0], steps-1)
@@ -176,29 +225,51 @@ class Net2NetTransformer(L.LightningModule):
             # cut off conditioning
             x = ix[:, c.shape[1]-1:]
         else:
+            x_len = x.shape[1]
             for k in range(steps):
                 callback(k)
-                assert x.size(1) <= block_size # make sure model can see conditioning
-                x_cond = x if x.size(1) <= block_size else x[:, -block_size:]  # crop context if needed
-                logits, _ = self.transformer(x_cond)
-                # pluck the logits at the final step and scale by temperature
-                logits = logits[:, -1, :] / temperature
-                # optionally crop probabilities to only the top k options
-                if top_k is not None:
-                    logits = self.top_k_logits(logits, top_k)
-                # apply softmax to convert to probabilities
-                probs = F.softmax(logits, dim=-1)
-                # sample from the distribution or take the most likely
-                if sample:
-                    ix = torch.multinomial(probs, num_samples=1)
-                else:
-                    _, ix = torch.topk(probs, k=1, dim=-1)
+                # the transformer prepends the class token(s) to the given tokens, as in forward
+                logits, _ = self.transformer((x, c))
+                assert logits.size(1) <= block_size # make sure model can see conditioning
+                # pluck the logits at the final step
+                ix = self.sample_logits(logits[:, -1, :], temperature=temperature, sample=sample, top_k=top_k)
                 # append to the sequence and continue
                 x = torch.cat((x, ix), dim=1)
-            # cut off conditioning
-            x = x[:, c.shape[1]:]
+            # cut off the given tokens
+            x = x[:, x_len:]
         return x
 
+    @torch.no_grad()
+    def sample_with_cache(self, x, c, steps, temperature=1.0, sample=False, top_k=None,
+                          callback=lambda k: None):
+        """
+        sample with incremental decoding: the class token(s) and the given tokens x are prefilled in one
+        pass, then every step forwards only the last sampled token against a kv cache preallocated for the
+        whole sequence (GPT.forward_with_cache), and tokens are written into a preallocated buffer.
+        Same sampling ops as the full recompute path, so a fixed seed gives the same tokens.
+        """
+        transformer = self.transformer
+        assert not transformer.training and not self.token_factorization
+        B, x_len = x.shape
+        cls_embeddings = transformer.class_emb(c, train=False)[:, :transformer.cls_token_number]
+        prefix_len = cls_embeddings.shape[1] + x_len
+        # the last sampled token is never forwarded
+        assert prefix_len + steps - 1 <= transformer.get_block_size() # make sure model can see conditioning
+
+        tokens = x.new_empty(B, x_len + steps)
+        tokens[:, :x_len] = x
+        cache = transformer.new_kv_cache(B, prefix_len + max(steps - 1, 0))
+        logits = transformer.forward_with_cache(x, cache, pos=0, embeddings=cls_embeddings)[:, -1, :]
+        for k in range(steps):
+            callback(k)
+            tokens[:, x_len + k:x_len + k + 1] = self.sample_logits(logits, temperature=temperature,
+                                                                    sample=sample, top_k=top_k)
+            if k < steps - 1:
+                logits = transformer.forward_with_cache(tokens[:, x_len + k:x_len + k + 1], cache,
+                                                        pos=prefix_len + k)[:, -1, :]
+        # cut off the given tokens
+        return tokens[:, x_len:]
+
     @torch.no_grad()
     def encode_to_z(self, x):
         quant_z, _, indices, _ = self.first_stage_model.encode(x)
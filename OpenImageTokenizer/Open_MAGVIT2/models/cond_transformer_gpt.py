@@ -42,6 +42,7 @@ class Net2NetTransformer(L.LightningModule):
                 wp0 = 0.005, #initial lr ratio at the begging of lr warm up
                 wpe = 0.01, #final lr ratio at the end of training
                 twde = 0,
+                loss_chunk_size=1024,
                  ):
         super().__init__()
 
@@ -71,6 +72,8 @@ class Net2NetTransformer(L.LightningModule):
         self.wp0 = wp0
         self.wpe = wpe
         self.twde = twde or weight_decay
+        ## rows of the output heads computed at a time by the training loss, None materializes the full logits
+        self.loss_chunk_size = loss_chunk_size
 
     def state_dict(self, *kwargs, destination=None, prefix='', keep_vars=False):
         return {k: v for k, v in super().state_dict(*kwargs, destination, prefix, keep_vars).items() if ("inception_model" not in k and "lpips_vgg" not in k and "lpips_alex" not in k)}
@@ -107,7 +110,11 @@ class Net2NetTransformer(L.LightningModule):
             model.train = disabled_train
             self.cond_stage_model = model
 
-    def forward(self, x, c):
+    def forward(self, x, c, return_loss=False):
+        """
+        return: logits, target, or with return_loss the (pre, post) cross entropies computed by the
+        transformer in loss_chunk_size tiles without materializing the [B, N, 2**bits] logits
+        """
         # one step to produce the logits
         _, z_indices = self.encode_to_z(x)
         _, c_indices = self.encode_to_c(c)
@@ -127,7 +134,12 @@ class Net2NetTransformer(L.LightningModule):
 
             target_pre = a_indices_pre
             target_post = a_indices_post
-            
+
+            if return_loss:
+                _, (loss_pre, loss_post) = self.transformer(cz_indices, targets=(target_pre, target_post),
+                                                            loss_chunk_size=self.loss_chunk_size)
+                return loss_pre, loss_post
+
             logits, _ = self.transformer(cz_indices) #[B N 2 D]
 
             logits_pre, logits_post = logits[0], logits[1]
@@ -211,6 +223,9 @@ class Net2NetTransformer(L.LightningModule):
 
     def shared_step(self, batch, batch_idx):
         x, c = self.get_xc(batch)
+        if self.token_factorization and self.loss_chunk_size:
+            loss_pre, loss_post = self(x, c, return_loss=True)
+            return loss_pre + loss_post, (loss_pre, loss_post)
         logits, target = self(x, c)
         if self.token_factorization:
             logits_pre, target_pre = logits[0], target[0]
@@ -6,7 +6,7 @@ import lightning as L
 from .main import instantiate_from_config
 from contextlib import contextmanager
 
-from OpenImageTokenizer.Open_MAGVIT2.modules.diffusionmodules.improved_video_model import Encoder, Decoder
+from OpenImageTokenizer.Open_MAGVIT2.modules.diffusionmodules.improved_video_model import Encoder, Decoder, set_streaming
 from OpenImageTokenizer.Open_MAGVIT2.modules.vqvae.lookup_free_quantize import LFQ
 from OpenImageTokenizer.Open_MAGVIT2.modules.scheduler.lr_scheduler import Scheduler_LinearWarmup, Scheduler_LinearWarmup_CosineDecay
 from OpenImageTokenizer.Open_MAGVIT2.modules.util import requires_grad
@@ -103,6 +103,22 @@ class VQModel(L.LightningModule):
                 if context is not None:
                     print(f"{context}: Restored training weights")
 
+    @contextmanager
+    def streaming_scope(self, context=None):
+        """
+        chunk-by-chunk causal inference: every causal conv keeps its temporal cache
+        between calls, so encode/decode can be fed consecutive chunks of one long video
+        """
+        set_streaming(self, True)
+        if context is not None:
+            print(f"{context}: Switched to streaming inference")
+        try:
+            yield None
+        finally:
+            set_streaming(self, False)
+            if context is not None:
+                print(f"{context}: Restored full-clip inference")
+
     def inflate_from_image(self, image_pretrain_path):
         """
         use last temporal inflation as MAGVIT2 does
@@ -248,9 +264,9 @@ class VQModel(L.LightningModule):
         (quant, emb_loss, info), loss_breakdown = self.quantize(h, return_loss_breakdown=True)
         return quant, emb_loss, info, loss_breakdown
 
-    def decode(self, quant):
+    def decode(self, quant, style=None, modulation=None):
         # quant = self.post_quant_conv(quant)
-        dec = self.decoder(quant)
+        dec = self.decoder(quant, style=style, modulation=modulation)
         return dec
 
     def decode_code(self, code_b):
@@ -169,9 +169,23 @@ class Decoder(nn.Module):
 
         self.conv_out = nn.Conv2d(block_in, out_ch, kernel_size=(3, 3), padding=1)
     
+    def style_modulation(self, style):
+        """
+        adaGN (scale, bias) of every level from a single pass over the style latent:
+        the statistics are shared by all levels and the gamma / beta linears of all
+        levels are applied as one concatenated projection each
+        """
+        std, mean = AdaptiveGroupNorm.style_statistics(style, self.adaptive[0].eps)
+        sizes = [norm.gamma.out_features for norm in self.adaptive]
+        scale = F.linear(std, torch.cat([norm.gamma.weight for norm in self.adaptive]),
+                         torch.cat([norm.gamma.bias for norm in self.adaptive]))
+        bias = F.linear(mean, torch.cat([norm.beta.weight for norm in self.adaptive]),
+                        torch.cat([norm.beta.bias for norm in self.adaptive]))
+        return list(zip(scale.split(sizes, dim=1), bias.split(sizes, dim=1)))
+
     def forward(self, z):
         
-        style = z.clone() #for adaptive groupnorm
+        modulation = self.style_modulation(z) #for adaptive groupnorm
 
         z = self.conv_in(z)
 
@@ -182,7 +196,7 @@ class Decoder(nn.Module):
         ## upsample
         for i_level in reversed(range(self.num_blocks)):
             ### pass in each resblock first adaGN
-            z = self.adaptive[i_level](z, style)
+            z = self.adaptive[i_level](z, modulation=modulation[i_level])
             for i_block in range(self.num_res_blocks):
                 z = self.up[i_level].block[i_block](z)
             
@@ -257,21 +271,27 @@ class AdaptiveGroupNorm(nn.Module):
         self.beta = nn.Linear(z_channel, in_filters)
         self.eps = eps
     
-    def forward(self, x, quantizer):
-        B, C, _, _ = x.shape
-        # quantizer = F.adaptive_avg_pool2d(quantizer, (1, 1))
-        ### calcuate var for scale
-        scale = rearrange(quantizer, "b c h w -> b c (h w)")
-        scale = scale.var(dim=-1) + self.eps #not unbias
-        scale = scale.sqrt()
-        scale = self.gamma(scale).view(B, C, 1, 1)
-
-        ### calculate mean for bias
-        bias = rearrange(quantizer, "b c h w -> b c (h w)")
-        bias = bias.mean(dim=-1)
-        bias = self.beta(bias).view(B, C, 1, 1)
-       
+    @staticmethod
+    def style_statistics(quantizer, eps=1e-6):
+        """
+        per-channel (std, mean) of the style latent over all spatial positions
+        """
+        var, mean = torch.var_mean(quantizer.flatten(2), dim=-1) #unbiased var, as before
+        return (var + eps).sqrt(), mean
+
+    def forward(self, x, quantizer=None, modulation=None):
+        """
+        input: [B C H W]
+        modulation: precomputed (scale, bias) of shape [B C], see Decoder.style_modulation
+        """
+        B, C = x.shape[:2]
+        if modulation is None:
+            std, mean = self.style_statistics(quantizer, self.eps)
+            modulation = (self.gamma(std), self.beta(mean))
+        scale, bias = modulation
+        view = (B, C) + (1,) * (x.dim() - 2)
+
         x = self.gn(x)
-        x = scale * x + bias
+        x = scale.view(view) * x + bias.view(view)
 
         return x
\ No newline at end of file
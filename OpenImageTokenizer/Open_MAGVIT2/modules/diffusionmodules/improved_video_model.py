@@ -60,15 +60,212 @@ class ConvBlock3D(nn.Module):
                         groups=groups,
                         bias=bias,
                         **kwargs)
+
+        ### streaming state (see set_streaming)
+        self.causal = causal
+        self.time_kernel = kernel_size[0]
+        self.time_stride = stride[0]
+        self.time_pad = time_pad
+        self.streaming = False
+        self.cache = None
         
     def forward(self, x):
         """
         CasuelConv3D
         """
+        if self.streaming and self.causal:
+            return self.forward_streaming(x)
         x = F.pad(x, self.padding, mode="constant")
         x = self.conv_1(x)
         return x
 
+    def forward_streaming(self, x):
+        """
+        Causal conv over one temporal chunk of a longer video.
+        The cache holds the frames the next chunk still needs: the last k-1 frames
+        for stride 1, and the frames after the last consumed stride step otherwise,
+        so the concatenation of the outputs equals the output on the whole clip.
+        input: [B C T H W]
+        """
+        if self.cache is None: ### first chunk, same zero padding as the full clip
+            self.cache = x.new_zeros(x.shape[0], x.shape[1], self.time_pad, x.shape[3], x.shape[4])
+        x = torch.cat([self.cache, x], dim=2)
+        num_out = (x.shape[2] - self.time_kernel) // self.time_stride + 1
+        if num_out <= 0:
+            ### not enough frames for one output yet, keep them for the next chunk
+            self.cache = x
+            h = (x.shape[3] + 2 * self.padding[2] - self.conv_1.kernel_size[1]) // self.conv_1.stride[1] + 1
+            w = (x.shape[4] + 2 * self.padding[0] - self.conv_1.kernel_size[2]) // self.conv_1.stride[2] + 1
+            return x.new_zeros(x.shape[0], self.conv_1.out_channels, 0, h, w)
+        self.cache = x[:, :, num_out * self.time_stride:].clone()
+        x = F.pad(x, self.padding[:4], mode="constant") #spatial padding only
+        x = self.conv_1(x)
+        return x
+
+
+class StreamingStatisticsPass(Exception):
+    """
+    Raised by a StreamingGroupNorm that is collecting its statistics: the rest of the
+    forward does not matter during that pass, so the chunk stops there.
+    """
+
+
+class StreamingGroupNorm(nn.GroupNorm):
+    """
+    nn.GroupNorm that normalizes streamed chunks with the statistics of the whole stream.
+    GroupNorm statistics span all frames of the clip, so per-chunk statistics would change
+    the result with the chunking. In streaming mode the norm first collects float64 sums and
+    sums of squares per (sample, group) over every chunk of a statistics pass (stopping the
+    forward there), then normalizes every chunk of the later passes with the frozen
+    whole-stream mean and variance, see iter_streaming.
+    Same parameters and state dict as nn.GroupNorm.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.streaming = False
+        self.reset_statistics()
+
+    def reset_statistics(self):
+        self.stream_sum = None
+        self.stream_sqsum = None
+        self.stream_count = 0
+        self.stream_stats = None
+
+    def finish_statistics(self):
+        """
+        freeze the statistics collected over the whole stream, return True if this norm collected any
+        """
+        if self.stream_stats is not None or self.stream_sum is None:
+            return False
+        mean = self.stream_sum / self.stream_count
+        var = (self.stream_sqsum / self.stream_count - mean * mean).clamp_min(0) #biased, as F.group_norm
+        self.stream_stats = (mean.float(), torch.rsqrt(var + self.eps).float())
+        self.stream_sum = self.stream_sqsum = None
+        return True
+
+    def forward(self, x):
+        if not self.streaming:
+            return super().forward(x)
+        B = x.shape[0]
+        if self.stream_stats is None: ### statistics pass
+            if x.numel() > 0:
+                groups = x.detach().double().reshape(B, self.num_groups, -1)
+                if self.stream_sum is None:
+                    self.stream_sum = groups.new_zeros(B, self.num_groups)
+                    self.stream_sqsum = groups.new_zeros(B, self.num_groups)
+                self.stream_sum += groups.sum(dim=-1)
+                self.stream_sqsum += (groups * groups).sum(dim=-1)
+                self.stream_count += groups.shape[-1]
+            raise StreamingStatisticsPass()
+        if x.numel() == 0:
+            return x
+        mean, rstd = self.stream_stats
+        out = (x.float().reshape(B, self.num_groups, -1) - mean[..., None]) * rstd[..., None]
+        out = out.reshape(x.shape).to(x.dtype)
+        if self.affine:
+            view = (1, self.num_channels) + (1,) * (x.dim() - 2)
+            out = out * self.weight.view(view) + self.bias.view(view)
+        return out
+
+
+def reset_streaming_caches(module):
+    """
+    Drop the temporal caches of every causal ConvBlock3D and temporal Upsampler inside
+    module, so the next chunk is treated as the first frames of a video.
+    """
+    for m in module.modules():
+        if isinstance(m, ConvBlock3D):
+            m.cache = None
+        elif isinstance(m, Upsampler):
+            m.first_chunk = True
+
+
+def set_streaming(module, enabled=True):
+    """
+    Switch chunk-by-chunk causal inference on or off for every causal ConvBlock3D,
+    temporal Upsampler and StreamingGroupNorm inside module. The temporal caches and the
+    stream statistics are dropped in both cases, so the next chunk is treated as the
+    first frames of a new video.
+    """
+    for m in module.modules():
+        if isinstance(m, (ConvBlock3D, Upsampler, StreamingGroupNorm)):
+            m.streaming = enabled
+        if isinstance(m, StreamingGroupNorm):
+            m.reset_statistics()
+    reset_streaming_caches(module)
+
+
+def iter_streaming(module, forward, make_chunks):
+    """
+    Exact chunk-by-chunk forward of a whole stream through module (in streaming mode).
+    The causal convs carry their caches between chunks, and the GroupNorm statistics of the
+    whole stream are collected first, one statistics pass over the stream per norm in
+    execution order, so the outputs concatenate to the full-clip output whatever the chunking.
+    Memory stays bounded by one chunk, the price is re-reading the stream once per norm.
+    A stream made of a single chunk is forwarded directly as a full clip.
+
+    forward: function of one chunk (e.g. encoder or decoder call)
+    make_chunks: function returning a fresh iterator over the chunks of the stream
+    yields: forward(chunk) of every chunk, in order
+    """
+    chunks = make_chunks()
+    first = next(chunks, None)
+    if first is None:
+        return
+    if next(chunks, None) is None:
+        set_streaming(module, False)
+        try:
+            yield forward(first)
+        finally:
+            set_streaming(module, True)
+        return
+    del chunks
+
+    norms = [m for m in module.modules() if isinstance(m, StreamingGroupNorm)]
+    for norm in norms:
+        norm.reset_statistics()
+    while True:
+        reset_streaming_caches(module)
+        statistics_pass, outputs = False, 0
+        for chunk in make_chunks():
+            try:
+                out = forward(chunk)
+            except StreamingStatisticsPass:
+                statistics_pass = True
+                continue
+            finally:
+                assert not (statistics_pass and outputs), "a chunk of the output pass hit a norm without statistics"
+            outputs += 1
+            yield out
+        if not statistics_pass:
+            return
+        assert any([norm.finish_statistics() for norm in norms]), "no norm collected statistics"
+
+
+@torch.no_grad()
+def check_streaming(module, x, chunkings, forward=None):
+    """
+    Relative L2 error between the full-clip output of module on x [B C T H W] and the
+    concatenated outputs of iter_streaming over each chunking (list of chunk lengths along T)
+    forward: function of one chunk, defaults to module
+    return: {chunking: relative error}
+    """
+    forward = forward or module
+    set_streaming(module, False)
+    full = forward(x)
+    errors = {}
+    for chunking in chunkings:
+        bounds = [sum(chunking[:i]) for i in range(len(chunking) + 1)]
+        assert bounds[-1] == x.shape[2], f"{chunking} does not cover {x.shape[2]} frames"
+        make_chunks = lambda: (x[:, :, start:end] for start, end in zip(bounds[:-1], bounds[1:]))
+        set_streaming(module, True)
+        try:
+            out = torch.cat(list(iter_streaming(module, forward, make_chunks)), dim=2)
+        finally:
+            set_streaming(module, False)
+        errors[tuple(chunking)] = ((out - full).norm() / full.norm()).item()
+    return errors
+
 
 class ResBlock(nn.Module):
     def __init__(self, 
@@ -85,8 +282,8 @@ class ResBlock(nn.Module):
         self.use_agn = use_agn
 
         if not use_agn: ## agn is GroupNorm likewise skip it if has agn before
-            self.norm1 = nn.GroupNorm(32, in_filters, eps=1e-6)
-        self.norm2 = nn.GroupNorm(32, out_filters, eps=1e-6)
+            self.norm1 = StreamingGroupNorm(32, in_filters, eps=1e-6)
+        self.norm2 = StreamingGroupNorm(32, out_filters, eps=1e-6)
 
         self.conv1 = ConvBlock3D(in_filters, out_filters, kernel_size=(3, 3, 3), causal=True, padding=1, bias=False)
         self.conv2 = ConvBlock3D(out_filters, out_filters, kernel_size=(3, 3, 3), causal=True, padding=1, bias=False)
@@ -140,6 +337,7 @@ class Encoder(nn.Module):
 
         ## construct the model
         self.down = nn.ModuleList()
+        self.temporal_downsample = 1 #frames per latent frame after the first one
 
         in_ch_mult = (1,)+tuple(ch_mult)
         for i_level in range(self.num_blocks):
@@ -157,6 +355,7 @@ class Encoder(nn.Module):
                     down.downsample = ConvBlock3D(block_out, block_out, kernel_size=(3, 3, 3), causal=True, stride=(1, 2, 2), padding=1)
                 else:
                     down.downsample = ConvBlock3D(block_out, block_out, kernel_size=(3, 3, 3), causal=True, stride=(2, 2, 2), padding=1)
+                    self.temporal_downsample *= 2
 
             self.down.append(down)
         
@@ -166,7 +365,7 @@ class Encoder(nn.Module):
             self.mid_block.append(ResBlock(block_in, block_in))
         
         ### end
-        self.norm_out = nn.GroupNorm(32, block_out, eps=1e-6)
+        self.norm_out = StreamingGroupNorm(32, block_out, eps=1e-6)
         self.conv_out = ConvBlock3D(block_out, z_channels, kernel_size=(1, 1, 1), causal=True)
 
     def forward(self, x):
@@ -233,13 +432,35 @@ class Decoder(nn.Module):
                     up.upsample = Upsampler(block_in, block_size=(2, 2, 2))
             self.up.insert(0, up)
         
-        self.norm_out = nn.GroupNorm(32, block_in, eps=1e-6)
+        self.norm_out = StreamingGroupNorm(32, block_in, eps=1e-6)
 
         self.conv_out = ConvBlock3D(block_in, out_ch, kernel_size=(3, 3, 3), causal=True, padding=1)
     
-    def forward(self, z):
-        
-        style = z.clone() #for adaptive groupnorm
+    def style_modulation(self, style=None, statistics=None):
+        """
+        adaGN (scale, bias) of every level from a single pass over the style latent:
+        the statistics are shared by all levels and the gamma / beta linears of all
+        levels are applied as one concatenated projection each
+        statistics: precomputed (std, mean) of the style, e.g. AdaptiveGroupNorm.stream_style_statistics
+        """
+        if statistics is None:
+            statistics = AdaptiveGroupNorm.style_statistics(style, self.adaptive[0].eps)
+        std, mean = statistics
+        sizes = [norm.gamma.out_features for norm in self.adaptive]
+        scale = F.linear(std, torch.cat([norm.gamma.weight for norm in self.adaptive]),
+                         torch.cat([norm.gamma.bias for norm in self.adaptive]))
+        bias = F.linear(mean, torch.cat([norm.beta.weight for norm in self.adaptive]),
+                        torch.cat([norm.beta.bias for norm in self.adaptive]))
+        return list(zip(scale.split(sizes, dim=1), bias.split(sizes, dim=1)))
+
+    def forward(self, z, style=None, modulation=None):
+        """
+        style: latent used by the adaptive groupnorm statistics, defaults to z
+        (pass the whole latent when decoding it chunk by chunk)
+        modulation: precomputed style_modulation(style), reused across chunks
+        """
+        if modulation is None:
+            modulation = self.style_modulation(z if style is None else style) #for adaptive groupnorm
 
         z = self.conv_in(z)
 
@@ -250,7 +471,7 @@ class Decoder(nn.Module):
         ## upsample
         for i_level in reversed(range(self.num_blocks)):
             ### pass in each resblock first adaGN
-            z = self.adaptive[i_level](z, style)
+            z = self.adaptive[i_level](z, modulation=modulation[i_level])
             for i_block in range(self.num_res_blocks):
                 z = self.up[i_level].block[i_block](z)
             
@@ -309,6 +530,10 @@ class Upsampler(nn.Module):
         self.block_size = block_size
         self.conv1 = ConvBlock3D(dim, dim_out, kernel_size=(3, 3, 3), causal=True, padding=1)
         self.depth2space = depth_to_space3d
+
+        ### streaming state (see set_streaming)
+        self.streaming = False
+        self.first_chunk = True
     
     def forward(self, x):
         """
@@ -318,7 +543,11 @@ class Upsampler(nn.Module):
         out = self.depth2space(out, self.block_size)
         if self.block_size[0] > 1:
             ### drop the first s-1 frames
-            if out.shape[2] > 2: #video input
+            if self.streaming: #only the first chunk holds the frame to drop
+                if self.first_chunk and out.shape[2] > 0:
+                    out = torch.concat([out[:, :, [0], ...], out[:, :, 2:, ...]], dim=2)
+                    self.first_chunk = False
+            elif out.shape[2] > 2: #video input
                 out = torch.concat([out[:, :, [0], ...], out[:, :, 2:, ...]], dim=2)
             else:
                 out = out[:, :, [0], ...] #only take the first frame
@@ -327,7 +556,7 @@ class Upsampler(nn.Module):
 class AdaptiveGroupNorm(nn.Module):
     def __init__(self, z_channel, in_filters, num_groups=32, eps=1e-6):
         super().__init__()
-        self.gn = nn.GroupNorm(num_groups=32, num_channels=in_filters, eps=eps, affine=False)
+        self.gn = StreamingGroupNorm(num_groups=32, num_channels=in_filters, eps=eps, affine=False)
         self.gamma = nn.Linear(z_channel, in_filters)
         self.beta = nn.Linear(z_channel, in_filters)
         self.eps = eps
@@ -353,29 +582,49 @@ class AdaptiveGroupNorm(nn.Module):
 class AdaptiveGroupNorm(nn.Module):
     def __init__(self, z_channel, in_filters, num_groups=32, eps=1e-6):
         super().__init__()
-        self.gn = nn.GroupNorm(num_groups=32, num_channels=in_filters, eps=eps, affine=False)
+        self.gn = StreamingGroupNorm(num_groups=32, num_channels=in_filters, eps=eps, affine=False)
         self.gamma = nn.Linear(z_channel, in_filters)
         self.beta = nn.Linear(z_channel, in_filters)
         self.eps = eps
     
-    def forward(self, x, quantizer):
+    @staticmethod
+    def style_statistics(quantizer, eps=1e-6):
+        """
+        per-channel (std, mean) of the style latent over all spatio-temporal positions
+        """
+        var, mean = torch.var_mean(quantizer.flatten(2), dim=-1) #unbiased var, as before
+        return (var + eps).sqrt(), mean
+
+    @staticmethod
+    def stream_style_statistics(chunks, eps=1e-6):
+        """
+        style_statistics of a latent given as consecutive temporal chunks [B C t H W]
+        (float64 running sums, so the whole latent is never held)
+        """
+        total, sqtotal, count = None, None, 0
+        for chunk in chunks:
+            chunk = chunk.double().flatten(2)
+            total = chunk.sum(dim=-1) if total is None else total + chunk.sum(dim=-1)
+            sqtotal = (chunk * chunk).sum(dim=-1) if sqtotal is None else sqtotal + (chunk * chunk).sum(dim=-1)
+            count += chunk.shape[-1]
+        mean = total / count
+        var = (sqtotal - count * mean * mean) / (count - 1) #unbiased, as style_statistics
+        return (var.float() + eps).sqrt(), mean.float()
+
+    def forward(self, x, quantizer=None, modulation=None):
         """
         input: [B C T H W]
+        modulation: precomputed (scale, bias) of shape [B C], see Decoder.style_modulation
         """
-        B, C, _, _, _ = x.shape
-        ### calcuate var for scale
-        scale = rearrange(quantizer, "b c t h w -> b c (t h w)")
-        scale = scale.var(dim=-1) + self.eps #not unbias
-        scale = scale.sqrt()
-        scale = self.gamma(scale).view(B, C, 1, 1, 1)
+        B, C = x.shape[:2]
+        if modulation is None:
+            std, mean = self.style_statistics(quantizer, self.eps)
+            modulation = (self.gamma(std), self.beta(mean))
+        scale, bias = modulation
+        view = (B, C) + (1,) * (x.dim() - 2)
 
-        ### calculate mean for bias
-        bias = rearrange(quantizer, "b c t h w -> b c (t h w)")
-        bias = bias.mean(dim=-1)
-        bias = self.beta(bias).view(B, C, 1, 1, 1)
-       
         x = self.gn(x)
-        x = scale * x + bias
+        x = scale.view(view) * x + bias.view(view)
 
         return x
 
@@ -8,7 +8,9 @@ import torch
 import torch.nn as nn
 from torch.nn import functional as F
 from typing import Optional
+from collections import OrderedDict
 import math
+import time
 
 ### from https://huggingface.co/transformers/v3.2.0/_modules/transformers/generation_utils.html
 def top_k_top_p_filtering(
@@ -52,6 +54,172 @@ def top_k_top_p_filtering(
     return logits
 
 
+def top_k_top_p_filtering_rows(
+        logits,
+        top_k=None,
+        top_p=None,
+        filter_value: float = -float("Inf"),
+        min_tokens_to_keep: int = 1,
+):
+    """Per-row version of top_k_top_p_filtering
+    top_k / top_p: [B] tensors (or scalars) with the parameters of each row, rows with
+    top_k <= 0 / top_p >= 1.0 are not filtered by that criterion
+    """
+    B, V = logits.shape
+    top_k = torch.as_tensor(0 if top_k is None else top_k, device=logits.device).long().view(-1).expand(B)
+    top_p = torch.as_tensor(1.0 if top_p is None else top_p, device=logits.device).float().view(-1).expand(B)
+    sorted_logits, sorted_indices = torch.sort(logits, descending=True)
+
+    # top-k: remove everything below the k-th largest logit of the row
+    k = torch.where(top_k > 0, top_k.clamp(min=min_tokens_to_keep, max=V), torch.full_like(top_k, V))
+    kth_logit = sorted_logits.gather(1, (k - 1)[:, None])
+    sorted_indices_to_remove = sorted_logits < kth_logit
+    sorted_logits = sorted_logits.masked_fill(sorted_indices_to_remove, filter_value)
+
+    # top-p on what is left, keeping the first token above the threshold
+    cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
+    nucleus_to_remove = cumulative_probs > top_p[:, None]
+    nucleus_to_remove[..., 1:] = nucleus_to_remove[..., :-1].clone()
+    nucleus_to_remove[..., :min_tokens_to_keep] = 0
+    nucleus_to_remove &= (top_p < 1.0)[:, None]
+    sorted_indices_to_remove |= nucleus_to_remove
+
+    indices_to_remove = sorted_indices_to_remove.scatter(1, sorted_indices, sorted_indices_to_remove)
+    return logits.masked_fill(indices_to_remove, filter_value)
+
+def sample_top_k_top_p(
+        logits,
+        top_k=None,
+        top_p=None,
+        method: str = "gumbel",
+        min_tokens_to_keep: int = 1,
+        num_candidates: int = 64,
+):
+    """Sample from the top-k / top-p filtered distribution of logits [B, V] without sorting the vocabulary
+    Draws from the same distribution as top_k_top_p_filtering(_rows) + softmax + multinomial, but only
+    the candidates returned by torch.topk are ordered: top-k rows take their k best logits, rows with
+    top-p only start from num_candidates and double them until the nucleus is inside. The survivors
+    are sampled with the Gumbel-max trick (method="gumbel") or an inverse CDF (method="icdf").
+    top_k / top_p: scalars or [B] tensors, rows with top_k <= 0 / top_p >= 1.0 are not filtered by
+    that criterion (rows with neither are sampled over the whole vocabulary)
+    return: sampled token ids [B, 1]
+    """
+    B, V = logits.shape
+    per_row_params = isinstance(top_k, torch.Tensor) or isinstance(top_p, torch.Tensor)
+    top_k = torch.as_tensor(0 if top_k is None else top_k, device=logits.device).long().view(-1).expand(B)
+    top_p = torch.as_tensor(1.0 if top_p is None else top_p, device=logits.device).float().view(-1).expand(B)
+    with_k = top_k > 0
+    nucleus_only = ~with_k & (top_p < 1.0)
+    unfiltered = ~with_k & (top_p >= 1.0)
+    if per_row_params: # one host sync to size the candidate set
+        num_k, any_nucleus_only, any_unfiltered = top_k.max().item(), bool(nucleus_only.any()), bool(unfiltered.any())
+    else: # scalars, nothing to read back
+        num_k, any_nucleus_only, any_unfiltered = int(top_k[0]), bool(nucleus_only[0]), bool(unfiltered[0])
+
+    if any_unfiltered and not (num_k > 0 or any_nucleus_only):
+        return _sample_from_candidates(logits, method)
+    k = top_k.clamp(min=min_tokens_to_keep, max=V)
+    num = min(max(num_k, min_tokens_to_keep), V) if num_k > 0 else 0
+    if any_nucleus_only:
+        # top-p without top-k is normalized over the whole vocabulary, the candidates must cover top_p
+        probs = F.softmax(logits, dim=-1)
+        num_nucleus = min(num_candidates, V)
+        while num_nucleus < V:
+            mass = torch.topk(probs, num_nucleus)[0].sum(-1)
+            if bool((mass > top_p)[nucleus_only].all()):
+                break
+            num_nucleus = min(2 * num_nucleus, V)
+        num = max(num, num_nucleus)
+
+    candidate_logits, candidate_indices = torch.topk(logits, num) # sorted, largest first
+    position = torch.arange(num, device=logits.device)
+    candidate_logits = candidate_logits.masked_fill(with_k[:, None] & (position >= k[:, None]), -float("Inf"))
+
+    # top-p on the candidates, keeping the first token above the threshold
+    log_norm = torch.where(with_k, torch.logsumexp(candidate_logits, dim=-1), torch.logsumexp(logits, dim=-1))
+    cumulative_probs = torch.cumsum((candidate_logits - log_norm[:, None]).exp(), dim=-1)
+    nucleus_to_remove = cumulative_probs > top_p[:, None]
+    nucleus_to_remove[..., 1:] = nucleus_to_remove[..., :-1].clone()
+    nucleus_to_remove[..., :min_tokens_to_keep] = 0
+    nucleus_to_remove &= (top_p < 1.0)[:, None]
+    candidate_logits = candidate_logits.masked_fill(nucleus_to_remove, -float("Inf"))
+
+    next_token = candidate_indices.gather(1, _sample_from_candidates(candidate_logits, method))
+    if any_unfiltered:
+        next_token = torch.where(unfiltered[:, None], _sample_from_candidates(logits, method), next_token)
+    return next_token
+
+def _sample_from_candidates(logits, method):
+    """ index [B, 1] drawn from softmax(logits) ([B, N], -inf for removed entries) """
+    if method == "gumbel":
+        # argmax(logits + Gumbel noise), the noise written as -log(Exp(1))
+        noise = torch.empty_like(logits, dtype=torch.float).exponential_().log()
+        return (logits.float() - noise).masked_fill(logits == -float("Inf"), -float("Inf")).argmax(-1, keepdim=True)
+    if method == "icdf":
+        weights = (logits.float() - logits.max(-1, keepdim=True)[0].float()).exp()
+        cdf = torch.cumsum(weights, dim=-1)
+        u = torch.rand_like(cdf[:, :1]) * cdf[:, -1:]
+        last = (logits > -float("Inf")).sum(-1, keepdim=True) - 1 # u == total can only round onto the last survivor
+        return torch.searchsorted(cdf, u, right=True).clamp(max=last)
+    raise ValueError(f"Unknown sampling method {method}")
+
+def per_row(value, device, ndim=2):
+    """ scalar sampling parameters are used as is, per-row ones (one per sample) become a [B, 1]
+    column ([B, 1, 1] with ndim=3, to broadcast against [B, S, V] logits)
+    """
+    if isinstance(value, (list, tuple)) or isinstance(value, torch.Tensor):
+        return torch.as_tensor(value, device=device).view(-1, *[1] * (ndim - 1))
+    return value
+
+def cfg_enabled(cfg_scale):
+    """ null-class rows are needed when any sample uses a guidance scale above 1 """
+    if isinstance(cfg_scale, (list, tuple)) or isinstance(cfg_scale, torch.Tensor):
+        return bool((torch.as_tensor(cfg_scale) > 1.0).any())
+    return cfg_scale > 1.0
+
+class ChunkedLinearCrossEntropy(torch.autograd.Function):
+    """
+    F.cross_entropy(h @ weight.T, target) (mean over rows) computed over tiles of chunk_size rows,
+    so the [N, vocab_size] logits are never held: every tile's logits give its loss terms and, when
+    gradients are needed, are turned straight into the gradients of h and weight, backward only
+    scales them. Peak memory is a few [chunk_size, vocab_size] float32 tiles.
+    """
+    @staticmethod
+    def forward(ctx, h, weight, target, chunk_size, compute_grad):
+        N = h.shape[0]
+        loss = torch.zeros((), dtype=torch.float32, device=h.device)
+        grad_h = torch.empty_like(h) if compute_grad else None
+        grad_weight = torch.zeros(weight.shape, dtype=torch.float32, device=weight.device) if compute_grad else None
+        for start in range(0, N, chunk_size):
+            h_chunk, target_chunk = h[start:start + chunk_size], target[start:start + chunk_size]
+            logits = (h_chunk @ weight.T).float() # as F.cross_entropy upcasts under autocast
+            lse = torch.logsumexp(logits, dim=-1)
+            loss += (lse - logits.gather(1, target_chunk[:, None])[:, 0]).sum()
+            if compute_grad:
+                # d loss / d logits = (softmax - one_hot) / N, computed in place over the tile
+                grad_logits = logits.sub_(lse[:, None]).exp_()
+                grad_logits[torch.arange(len(target_chunk), device=h.device), target_chunk] -= 1.0
+                grad_logits.div_(N)
+                grad_h[start:start + chunk_size] = (grad_logits.to(weight.dtype) @ weight).to(h.dtype)
+                grad_weight += grad_logits.T.to(h_chunk.dtype) @ h_chunk
+        if compute_grad:
+            ctx.save_for_backward(grad_h, grad_weight.to(weight.dtype))
+        return loss / N
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad_h, grad_weight = ctx.saved_tensors
+        return grad_h * grad_output.to(grad_h.dtype), grad_weight * grad_output.to(grad_weight.dtype), None, None, None
+
+def chunked_cross_entropy(h, weight, target, chunk_size=1024):
+    """
+    Memory-bounded F.cross_entropy(F.linear(h, weight), target) for a bias-free output head
+    h: [..., D] hidden states, weight: [vocab_size, D], target: [...] token indices
+    """
+    h = h.reshape(-1, h.shape[-1])
+    compute_grad = torch.is_grad_enabled() and (h.requires_grad or weight.requires_grad)
+    return ChunkedLinearCrossEntropy.apply(h, weight, target.reshape(-1), chunk_size, compute_grad)
+
 def find_multiple(n: int, k: int):
     if n % k == 0:
         return n
@@ -180,6 +348,46 @@ class FeedForward(nn.Module):
     def forward(self, x):
         return self.ffn_dropout(self.w2(F.silu(self.w1(x)) * self.w3(x)))
 
+def length_causal_mask(seqlen, kv_len, device):
+    """ Mask for seqlen new queries at the end of a cache prefix of kv_len positions
+    None when no mask is needed: a single decoding query sees the whole prefix, and a
+    prefill from position 0 (seqlen == kv_len) is plain is_causal attention. Only a
+    prefill appended to an existing prefix builds a small [seqlen, kv_len] mask.
+    """
+    if seqlen == 1 or seqlen == kv_len:
+        return None
+    mask = torch.ones(seqlen, kv_len, dtype=torch.bool, device=device).tril(diagonal=kv_len - seqlen)
+    return mask[None, None]
+
+def row_prefix_mask(input_pos, kv_len):
+    """ Mask for rows decoding at different positions (continuous batching)
+    input_pos: [B, S] positions written by every row, row b only sees cache positions <= input_pos[b]
+    return: [B, 1, S, kv_len]
+    """
+    positions = torch.arange(kv_len, device=input_pos.device)
+    return (positions[None, None, :] <= input_pos[:, :, None])[:, None]
+
+def grouped_query_attention(xq, keys, values, n_rep, attn_mask=None, is_causal=False, dropout_p=0.0):
+    """ Attention of n_head query heads against n_head // n_rep shared key / value heads
+    The query heads of each group are folded into the sequence axis and attend to their
+    shared head directly, so the (cached) keys and values are never repeat_interleave'd.
+    xq: [B, H, S, D], keys / values: [B, H // n_rep, T, D], attn_mask: [B, 1, S, T] or None
+    """
+    if n_rep == 1:
+        return F.scaled_dot_product_attention(xq, keys, values, attn_mask=attn_mask, is_causal=is_causal, dropout_p=dropout_p)
+    if is_causal: # query i has to line up with key i, only used without a cache (training / no kv cache)
+        keys = keys.repeat_interleave(n_rep, dim=1)
+        values = values.repeat_interleave(n_rep, dim=1)
+        return F.scaled_dot_product_attention(xq, keys, values, attn_mask=attn_mask, is_causal=True, dropout_p=dropout_p)
+
+    B, H, S, D = xq.shape
+    xq = xq.reshape(B, H // n_rep, n_rep * S, D) # heads g * n_rep ... (g + 1) * n_rep - 1 share kv head g
+    if attn_mask is not None:
+        assert attn_mask.dim() == 4 and attn_mask.shape[1] == 1
+        attn_mask = attn_mask.unsqueeze(2).expand(-1, -1, n_rep, -1, -1).reshape(attn_mask.shape[0], 1, n_rep * S, -1)
+    output = F.scaled_dot_product_attention(xq, keys, values, attn_mask=attn_mask, dropout_p=dropout_p)
+    return output.reshape(B, H, S, D)
+
 class Attention(nn.Module):
     def __init__(self, config):
         super().__init__()
@@ -223,7 +431,8 @@ class Attention(nn.Module):
     def forward(
         self, x: torch.Tensor, freqs_cis: torch.Tensor = None, 
         input_pos: Optional[torch.Tensor] = None, 
-        mask: Optional[torch.Tensor] = None
+        mask: Optional[torch.Tensor] = None,
+        kv_len: Optional[int] = None
     ):
         bsz, seqlen, _ = x.shape
         kv_size = self.n_kv_head * self.head_dim
@@ -239,17 +448,17 @@ class Attention(nn.Module):
         xq, xk, xv = map(lambda x: x.transpose(1, 2), (xq, xk, xv))
 
         if self.kv_cache is not None:
-            keys, values = self.kv_cache.update(input_pos, xk, xv)
+            keys, values = self.kv_cache.update(input_pos, xk, xv, kv_len)
         else:
             keys, values = xk, xv
-        keys = keys.repeat_interleave(self.n_head // self.n_kv_head, dim=1)
-        values = values.repeat_interleave(self.n_head // self.n_kv_head, dim=1)
-
-        output = F.scaled_dot_product_attention(
-            xq, keys, values,
-            attn_mask=mask, 
-            is_causal=True if mask is None else False, # is_causal=False is for KV cache
-            dropout_p=self.attn_dropout_p if self.training else 0)            
+        if kv_len is not None and mask is None: ## attend to the valid prefix of the cache, no dense mask
+            mask = length_causal_mask(seqlen, kv_len, x.device)
+
+        output = grouped_query_attention(
+            xq, keys, values, self.n_head // self.n_kv_head,
+            attn_mask=mask,
+            is_causal=seqlen > 1 and mask is None, # prefill / training, a decoding query needs no mask
+            dropout_p=self.attn_dropout_p if self.training else 0)
         
         output = output.transpose(1, 2).contiguous().view(bsz, seqlen, self.dim)
 
@@ -273,11 +482,11 @@ def precompute_freqs_cis_2d(grid_size: int, n_elem: int, base: int = 10000, cls_
 
 def apply_rotary_emb(x: torch.Tensor, freqs_cis: torch.Tensor):
     # x: (bs, seq_len, n_head, head_dim)
-    # freqs_cis (seq_len, head_dim // 2, 2)
+    # freqs_cis (seq_len, head_dim // 2, 2), or (bs, seq_len, head_dim // 2, 2) with per-row positions
     if not x.is_contiguous():
         x = x.contiguous()
     xshaped = x.float().view(*x.shape[:-1], -1, 2) # (bs, seq_len, n_head, head_dim//2, 2)
-    freqs_cis = freqs_cis.view(1, xshaped.size(1), 1, xshaped.size(3), 2) # (1, seq_len, 1, head_dim//2, 2)
+    freqs_cis = freqs_cis.view(-1, xshaped.size(1), 1, xshaped.size(3), 2) # (1 or bs, seq_len, 1, head_dim//2, 2)
     freqs_cis = freqs_cis.to(xshaped.dtype)
     x_out2 = torch.stack([
             xshaped[..., 0] * freqs_cis[..., 0] - xshaped[..., 1] * freqs_cis[..., 1],
@@ -297,26 +506,68 @@ class Block(nn.Module):
         self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
 
     def forward(
-        self, x: torch.Tensor, freqs_cis: torch.Tensor, start_pos: int, mask: Optional[torch.Tensor] = None):
-        h = x + self.drop_path(self.attention(self.attention_norm(x), freqs_cis, start_pos, mask))
+        self, x: torch.Tensor, freqs_cis: torch.Tensor, start_pos: int, mask: Optional[torch.Tensor] = None,
+        kv_len: Optional[int] = None):
+        h = x + self.drop_path(self.attention(self.attention_norm(x), freqs_cis, start_pos, mask, kv_len))
         out = h + self.drop_path(self.feed_forward(self.ffn_norm(h)))
         return out
 
 class KVCache(nn.Module):
+    """
+    dtype: storage dtype of the cache, torch.int8 stores every cached key / value
+    vector as int8 with its own fp16 absmax scale (one per row, head and position)
+    and dequantizes the attended prefix on read
+    """
     def __init__(self, max_batch_size, max_seq_length, n_head, head_dim, dtype):
         super().__init__()
         cache_shape = (max_batch_size, n_head, max_seq_length, head_dim)
+        self.quantized = dtype == torch.int8
         self.register_buffer('k_cache', torch.zeros(cache_shape, dtype=dtype))
         self.register_buffer('v_cache', torch.zeros(cache_shape, dtype=dtype))
-
-    def update(self, input_pos, k_val, v_val):
-        # input_pos: [S], k_val: [B, H, S, D]
-        assert input_pos.shape[0] == k_val.shape[2]
-        k_out = self.k_cache
-        v_out = self.v_cache
-        k_out[:, :, input_pos] = k_val
-        v_out[:, :, input_pos] = v_val
-
+        if self.quantized:
+            scale_shape = (max_batch_size, n_head, max_seq_length, 1)
+            self.register_buffer('k_scale', torch.zeros(scale_shape, dtype=torch.float16))
+            self.register_buffer('v_scale', torch.zeros(scale_shape, dtype=torch.float16))
+
+    @staticmethod
+    def bytes_per_position(n_head, head_dim, dtype):
+        """ bytes of one cached position of one row (keys and values) """
+        if dtype == torch.int8:
+            return 2 * n_head * (head_dim + torch.finfo(torch.float16).bits // 8)
+        return 2 * n_head * head_dim * (torch.finfo(dtype).bits // 8)
+
+    @staticmethod
+    def quantize(x):
+        scale = x.abs().amax(dim=-1, keepdim=True).clamp(min=1e-6) / 127.
+        scale = scale.half()
+        return torch.round(x / scale.to(x.dtype)).clamp_(-127, 127).to(torch.int8), scale
+
+    def update(self, input_pos, k_val, v_val, kv_len=None):
+        # input_pos: [S] shared by all rows or [B, S] per row, k_val: [B, H, S, D]
+        assert input_pos.shape[-1] == k_val.shape[2]
+        bs = k_val.shape[0]
+        k_out = self.k_cache[:bs]
+        v_out = self.v_cache[:bs]
+        if input_pos.dim() == 2: # row b writes positions input_pos[b], the indexed values come as [B, S, H, D]
+            index = (torch.arange(bs, device=input_pos.device)[:, None], slice(None), input_pos)
+            k_new, v_new = k_val.transpose(1, 2), v_val.transpose(1, 2)
+        else:
+            index = (slice(None), slice(None), input_pos)
+            k_new, v_new = k_val, v_val
+        if self.quantized:
+            k_out[index], self.k_scale[:bs][index] = self.quantize(k_new)
+            v_out[index], self.v_scale[:bs][index] = self.quantize(v_new)
+        else:
+            k_out[index] = k_new.to(k_out.dtype)
+            v_out[index] = v_new.to(v_out.dtype)
+
+        kv_len = k_out.shape[2] if kv_len is None else kv_len
+        k_out, v_out = k_out[:, :, :kv_len], v_out[:, :, :kv_len]
+        if self.quantized:
+            k_out = k_out.to(k_val.dtype) * self.k_scale[:bs, :, :kv_len].to(k_val.dtype)
+            v_out = v_out.to(v_val.dtype) * self.v_scale[:bs, :, :kv_len].to(v_val.dtype)
+        elif k_out.dtype != k_val.dtype:
+            k_out, v_out = k_out.to(k_val.dtype), v_out.to(v_val.dtype)
         return k_out, v_out
 
 class GPT(nn.Module):
@@ -396,30 +647,38 @@ class GPT(nn.Module):
         elif isinstance(module, nn.Embedding):
             module.weight.data.normal_(mean=0.0, std=std)
     
-    def setup_caches(self, max_batch_size, max_seq_length, dtype):
+    def setup_caches(self, max_batch_size, max_seq_length, dtype, kv_cache_dtype=None):
+        """
+        kv_cache_dtype: storage dtype of the KV caches (torch.bfloat16, torch.float16 or
+        torch.int8), defaults to dtype
+        """
         head_dim = self.config.dim // self.config.n_head
+        n_kv_head = self.config.n_kv_head if self.config.n_kv_head is not None else self.config.n_head
         max_seq_length = find_multiple(max_seq_length, 8)
         self.max_seq_length = max_seq_length
         self.max_batch_size = max_batch_size
         for b in self.spatial_blocks:
-            b.attention.kv_cache = KVCache(max_batch_size, max_seq_length, self.config.n_head, head_dim, dtype)
+            b.attention.kv_cache = KVCache(max_batch_size, max_seq_length, n_kv_head, head_dim, kv_cache_dtype or dtype)
 
-        causal_mask = torch.tril(torch.ones(self.max_seq_length, self.max_seq_length, dtype=torch.bool))
-        self.causal_mask = causal_mask.unsqueeze(0).repeat(self.max_batch_size, 1, 1)
         grid_size = int(self.config.block_size ** 0.5)
         assert grid_size * grid_size == self.config.block_size
         self.freqs_cis = precompute_freqs_cis_2d(grid_size, self.config.dim // self.config.n_head, self.config.rope_base, self.config.cls_token_num)
     
-    def setup_factorized_caches(self, max_batch_size, max_seq_length, dtype):
+    def setup_factorized_caches(self, max_batch_size, max_seq_length, dtype, kv_cache_dtype=None):
         head_dim = self.config.dim // self.config.n_head
+        n_kv_head = self.config.n_kv_head if self.config.n_kv_head is not None else self.config.n_head
         self.max_batch_size = max_batch_size
         max_seq_length = find_multiple(max_seq_length, 8)
         for b in self.factorized_blocks:
-            b.attention.kv_cache = KVCache(max_batch_size, max_seq_length, self.config.n_head, head_dim, dtype)
+            b.attention.kv_cache = KVCache(max_batch_size, max_seq_length, n_kv_head, head_dim, kv_cache_dtype or dtype)
 
     def forward(
-        self, idx, input_pos=None, mask=None, targets=None, 
+        self, idx, input_pos=None, mask=None, targets=None, loss_chunk_size=1024,
     ):
+        """
+        targets: (pre, post) [B, N] sub-tokens, when given the losses of both heads are computed
+        by chunked_cross_entropy over loss_chunk_size rows at a time and the logits are not returned
+        """
         if self.token_factorization:
             idx_pre, idx_post, idx_cls = idx[0], idx[1], idx[2] #idx
             token_embeddings_pre = self.pre_emb(idx_pre)
@@ -460,18 +719,21 @@ class GPT(nn.Module):
         h = factorized_ctx.view(B, N, -1, D)
 
         h = self.norm(h)
-        logits = [self.head[i](h[:, :, i, :]) for i in range(self.config.factorized_k)]
 
-        # if we are given some desired targets also calculate the loss
-        loss = None
+        # if we are given some desired targets only calculate the losses (one per head), tile by tile
         if targets is not None:
-            loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1))
+            loss = [chunked_cross_entropy(h[:, :, i, :], self.head[i].weight, targets[i], chunk_size=loss_chunk_size)
+                    for i in range(self.config.factorized_k)]
+            return None, loss
 
-        return logits, loss
+        logits = [self.head[i](h[:, :, i, :]) for i in range(self.config.factorized_k)]
+        return logits, None
     
-    def generate_context(self, idx, input_pos=None, targets=None, first_step=False):
+    def generate_context(self, idx, input_pos=None, targets=None, first_step=False, kv_len=None):
         """
         Generate context token for Inference
+        kv_len: number of valid cache positions after this step (input_pos[-1] + 1),
+        pass it to avoid reading input_pos back from the device
         """
         assert not self.training
         if first_step:
@@ -482,20 +744,20 @@ class GPT(nn.Module):
             token_embedding_post = self.post_emb(idx_post)
             token_embeddings = token_embedding_pre + token_embedding_post ##token summation for factorization
 
-        bs, N, D = token_embeddings.shape
-        
-        mask = self.causal_mask[:bs, None, input_pos]
+        if kv_len is None:
+            kv_len = int(input_pos[-1]) + 1
         h = self.token_drop(token_embeddings)
         freq_cis = self.freqs_cis[input_pos] #(cls_token_num+grid_size**2, head_dim // 2, 2) shape
         freq_cis = freq_cis.to(h.device)
         for block in self.spatial_blocks:
-            h = block(h, freq_cis, input_pos, mask)
+            h = block(h, freq_cis, input_pos, kv_len=kv_len)
         
         return h
     
-    def decode_subtoken(self, h, x, input_pos=None, first_step=False):
+    def decode_subtoken(self, h, x, input_pos=None, first_step=False, kv_len=None):
         """
         Auto-Regressive generate subtoken
+        kv_len: number of valid sub-token cache positions after this step (input_pos[-1] + 1)
         """
         B, N, D = h.shape
         if not h.is_contiguous():
@@ -507,12 +769,13 @@ class GPT(nn.Module):
             token_embedding = self.pre_emb(idx)
             factorized_ctx = token_embedding.reshape(B*N, -1, D)
         
-        mask = self.causal_mask[:B, None, input_pos]
+        if kv_len is None:
+            kv_len = int(input_pos[-1]) + 1
         factorized_ctx_freqs_cis = self.freqs_cis[input_pos]
         factorized_ctx_freqs_cis = factorized_ctx_freqs_cis.to(h.device)
 
         for block in self.factorized_blocks:
-            factorized_ctx = block(factorized_ctx, factorized_ctx_freqs_cis, start_pos=input_pos, mask=mask)
+            factorized_ctx = block(factorized_ctx, factorized_ctx_freqs_cis, start_pos=input_pos, kv_len=kv_len)
         
         h = factorized_ctx.reshape(B, N, -1, D)
         h = self.norm(h)
@@ -521,96 +784,626 @@ class GPT(nn.Module):
 
         return logits 
 
+    def generate_context_rows(self, idx, cls_idx, input_pos, kv_len):
+        """
+        Context of independent sequences decoding at different positions (continuous batching)
+        idx: (pre [B, 1], post [B, 1]) last sampled sub-tokens of every row, cls_idx: [B, 1]
+        input_pos: [B] position written by every row, rows at position 0 start a new
+        sequence and are fed their class token instead of idx
+        kv_len: cache positions to read (max(input_pos) + 1), every row only attends to its own prefix
+        """
+        assert not self.training
+        assert self.config.cls_token_num == 1, "a new sequence is prefilled by a single decoding step"
+        token_embeddings = self.pre_emb(idx[0]) + self.post_emb(idx[1])
+        cls_embeddings = self.class_emb(cls_idx, train=self.training)
+        h = self.token_drop(torch.where((input_pos == 0)[:, None, None], cls_embeddings, token_embeddings))
+
+        input_pos = input_pos[:, None]
+        freq_cis = self.freqs_cis[input_pos].to(h.device) # (B, 1, head_dim // 2, 2)
+        mask = row_prefix_mask(input_pos, kv_len)
+        for block in self.spatial_blocks:
+            h = block(h, freq_cis, input_pos, mask=mask, kv_len=kv_len)
+        return h
+
+
+class FactorizedGenerationEngine:
+    """ Reusable decoding state for sample_Open_MAGVIT2
+    The spatial KV caches (max_seq_length positions) and the intra (sub-token) KV caches
+    (factorized_k positions) are allocated once for max_batch_size rows and reused: the
+    sub-token caches are not rebuilt per position because every slot is rewritten before
+    it is attended to. Sampled pre / post sub-tokens go to preallocated buffers and the
+    conditional + null-class rows used by cfg are fixed for the whole loop.
+    With profile=True every phase is synchronized and timed (see last_stats).
+    subtoken_rows: rows of the sub-token caches (default max_batch_size), decode_subtoken runs the
+    N positions of a [B, N, D] context as B * N rows (see FactorizedSpeculativeEngine)
+    """
+    def __init__(self, model, max_batch_size, max_seq_length, dtype=None, device=None, kv_cache_dtype=None,
+                 subtoken_rows=None):
+        self.model = model
+        self.device = torch.device(device) if device is not None else model.class_emb.embedding_table.weight.device
+        self.dtype = dtype if dtype is not None else model.class_emb.embedding_table.weight.dtype
+        self.kv_cache_dtype = kv_cache_dtype
+        self.k = model.config.factorized_k
+        with torch.device(self.device):
+            model.setup_caches(max_batch_size=max_batch_size, max_seq_length=max_seq_length, dtype=self.dtype,
+                               kv_cache_dtype=kv_cache_dtype)
+            model.setup_factorized_caches(max_batch_size=subtoken_rows or max_batch_size, max_seq_length=self.k,
+                                          dtype=self.dtype, kv_cache_dtype=kv_cache_dtype)
+        self.max_batch_size = max_batch_size
+        self.subtoken_rows = subtoken_rows or max_batch_size
+        self.max_seq_length = model.max_seq_length
+        self.spatial_caches = [b.attention.kv_cache for b in model.spatial_blocks]
+        self.factorized_caches = [b.attention.kv_cache for b in model.factorized_blocks]
+        self.freqs_cis = model.freqs_cis.to(self.device)
+        self.tokens = torch.empty(self.k, self.max_batch_size, self.max_seq_length, dtype=torch.long, device=self.device)
+        self.step_tokens = torch.empty(self.k, self.max_batch_size, 1, dtype=torch.long, device=self.device)
+        self.subtoken_pos = torch.arange(self.k, device=self.device)
+        self.last_stats = None
+
+    @classmethod
+    def for_model(cls, model, batch_size, seq_length, device, kv_cache_dtype=None):
+        """ reuse the engine attached to the model when it is large enough, otherwise build a new one """
+        engine = getattr(model, "generation_engine", None)
+        if (engine is None or engine.model is not model or engine.device != torch.device(device)
+                or engine.dtype != model.class_emb.embedding_table.weight.dtype
+                or engine.kv_cache_dtype != kv_cache_dtype
+                or engine.max_batch_size < batch_size or engine.max_seq_length < seq_length):
+            engine = cls(model, batch_size, seq_length, device=device, kv_cache_dtype=kv_cache_dtype)
+            model.generation_engine = engine
+        return engine
+
+    def fits(self, batch_size, seq_length):
+        return batch_size <= self.max_batch_size and seq_length <= self.max_seq_length
+
+    def bind(self):
+        """ hand the caches back to the model (another engine may have replaced them) """
+        for block, kv_cache in zip(self.model.spatial_blocks, self.spatial_caches):
+            block.attention.kv_cache = kv_cache
+        for block, kv_cache in zip(self.model.factorized_blocks, self.factorized_caches):
+            block.attention.kv_cache = kv_cache
+        self.model.freqs_cis = self.freqs_cis
+        self.model.max_batch_size = self.max_batch_size
+        self.model.max_seq_length = self.max_seq_length
+
+    def prefix_buffers(self):
+        """ spatial cache buffers holding the class prefix (keys, values and int8 scales of every layer) """
+        return [buf for kv_cache in self.spatial_caches for buf in kv_cache.buffers()]
+
+    def prefill_prefix(self, x):
+        """ prefill the class tokens x [M, cls_len] into the first M spatial cache rows
+        return: context of the last class position [M, 1, D]
+        """
+        cond_len = x.shape[1]
+        h = self.model.generate_context(x, input_pos=torch.arange(0, cond_len, device=x.device),
+                                        first_step=True, kv_len=cond_len)
+        return h[:, -1:]
+
+    def reset(self):
+        """ hand the caches back to the model and clear them in place """
+        self.bind()
+        for kv_cache in self.spatial_caches + self.factorized_caches:
+            kv_cache.k_cache.zero_()
+            kv_cache.v_cache.zero_()
+
+    def _tick(self, timings, name, start, profile):
+        if not profile:
+            return start
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+        now = time.time()
+        timings[name] += now - start
+        return now
+
+    @torch.no_grad()
+    def generate(self, x, steps, temperature, top_k, top_p, cfg_scale, profile=False, prefix_cache=None):
+        """
+        x: class tokens [B, cls_len] ([2B, cls_len], conditional then null class, when cfg_scale[0] > 1)
+        temperature, top_k, top_p, cfg_scale: one value per sub-token, each a scalar or per-sample
+        values ([B] tensors or lists), so a batch can mix classes and sampling settings
+        prefix_cache: PrefixKVCache to take the class prefill from (only the last class position
+        goes through the sub-token decoding of the first token)
+        return: (pre tokens [B, steps], post tokens [B, steps])
+        """
+        bs, cond_len = x.shape
+        assert self.fits(bs, cond_len + steps), \
+            f"engine sized for {self.max_batch_size} x {self.max_seq_length}, got {bs} x {cond_len + steps}"
+        use_cfg = cfg_enabled(cfg_scale[0])
+        num_samples = bs // 2 if use_cfg else bs
+        device = x.device
+        cfg_scale = [per_row(v, device, ndim=3) for v in cfg_scale]
+        temperature = [per_row(v, device) for v in temperature]
+        top_k, top_p = [per_row(v, device) for v in top_k], [per_row(v, device) for v in top_p]
+        self.reset()
+
+        timings = {"context": 0., "subtoken": 0., "sampling": 0.}
+        t_start = time.time()
+        tokens = self.tokens[:, :num_samples, :steps]
+        step_tokens = self.step_tokens[:, :bs]
+        cls_idx = x if use_cfg else x[:num_samples] #conditional + null class rows, fixed for the whole loop
+        inputs = x
+        for n in range(steps): ## start to sample
+            if n == 0: #prefill operation
+                input_pos = torch.arange(0, cond_len, device=device) #C
+            elif n == 1:
+                input_pos = torch.tensor([cond_len], device=device)
+            else:
+                input_pos = input_pos + 1
+
+            t = time.time()
+            if n == 0 and prefix_cache is not None:
+                h = prefix_cache.prefill(self, x, num_null=bs - num_samples)
+            else:
+                h = self.model.generate_context(inputs, input_pos=input_pos, first_step=(n == 0), kv_len=cond_len + n)
+            t = self._tick(timings, "context", t, profile)
+
+            factor_x = cls_idx
+            for i in range(self.k):
+                logits = self.model.decode_subtoken(h, factor_x, self.subtoken_pos[i:i + 1], first_step=(i == 0), kv_len=i + 1)
+                t = self._tick(timings, "subtoken", t, profile)
+
+                if use_cfg:
+                    cond_logits, uncond_logits = torch.split(logits, num_samples, dim=0)
+                    logits = uncond_logits + (cond_logits - uncond_logits) * cfg_scale[i]
+                next_token = sample_from_logits(logits, temperature[i], top_k[i], top_p[i])
+
+                tokens[i, :, n] = next_token[:, 0]
+                step_tokens[i, :num_samples] = next_token
+                if use_cfg:
+                    step_tokens[i, num_samples:] = next_token
+                factor_x = (step_tokens[i], cls_idx)
+                t = self._tick(timings, "sampling", t, profile)
+            inputs = (step_tokens[0], step_tokens[1], cls_idx)
+
+        sample = (tokens[0].clone(), tokens[1].clone())
+        if device.type == "cuda":
+            torch.cuda.current_stream(device).synchronize() # not other streams (e.g. a decode worker)
+        seconds = time.time() - t_start
+        self.last_stats = {"tokens": num_samples * steps, "seconds": seconds,
+                           "tokens_per_sec": num_samples * steps / max(seconds, 1e-9)}
+        if profile:
+            self.last_stats["ms_per_step"] = {name: 1000 * value / steps for name, value in timings.items()}
+        return sample
+
+    @torch.no_grad()
+    def step_slots(self, tokens, cls_idx, input_pos, kv_len, cfg_scale, temperature, top_k, top_p, use_cfg,
+                   sample_logits=True):
+        """ One decoding step over the cache rows of a continuous batch (see ContinuousBatchingScheduler)
+        tokens: [k, R, 1] last sub-tokens of every row, cls_idx: [R, 1] class of every row,
+        input_pos: [R] position of every row (0 starts a new sequence), kv_len: max(input_pos) + 1
+        with use_cfg rows 2s / 2s + 1 are the conditional / null-class rows of sequence s
+        cfg_scale, temperature, top_k, top_p: [S, k] per sequence and sub-token (top_k 0 / top_p 1.0 disable
+        filtering, top_k = top_p = None skips it for the whole batch)
+        return: next sub-tokens of every sequence [S, k]
+        """
+        h = self.model.generate_context_rows((tokens[0], tokens[1]), cls_idx, input_pos, kv_len)
+        next_tokens = []
+        factor_x = cls_idx
+        for i in range(self.k):
+            logits = self.model.decode_subtoken(h, factor_x, self.subtoken_pos[i:i + 1], first_step=(i == 0), kv_len=i + 1)[:, -1]
+            if use_cfg:
+                cond_logits, uncond_logits = logits.view(-1, 2, logits.shape[-1]).unbind(1)
+                logits = uncond_logits + (cond_logits - uncond_logits) * cfg_scale[:, i:i + 1]
+            logits = logits / temperature[:, i:i + 1]
+            if not sample_logits:
+                next_token = torch.topk(logits, k=1, dim=-1)[1]
+            else:
+                next_token = sample_top_k_top_p(logits, top_k=None if top_k is None else top_k[:, i],
+                                                top_p=None if top_p is None else top_p[:, i])
+            next_tokens.append(next_token)
+            factor_x = (next_token.repeat_interleave(2, dim=0) if use_cfg else next_token, cls_idx)
+        return torch.cat(next_tokens, dim=1)
+
+
+class PrefixKVCache:
+    """ Bounded LRU of prefilled class prefixes, reused across batches
+    The prefill over the cls_token_num class positions only depends on the class label, so its
+    KV entries and the output of its last position are computed once per class and copied into
+    the cache rows of later sequences, which start straight at token 0. Labels of the null-class
+    (cfg) rows are pinned and shared by every pair, at most max_classes other labels are kept.
+    The entries belong to one model and are dropped when another model, dtype or cache storage is
+    used, or when a weight of the model is written in place (load_state_dict, an optimizer step) or
+    replaced.
+
+    Usage:
+        prefix_cache = PrefixKVCache(max_classes=1000)
+        for x in batches:
+            sample = sample_Open_MAGVIT2(x, model, steps, ..., prefix_cache=prefix_cache)
+    """
+    def __init__(self, max_classes=1000):
+        self.max_classes = max_classes
+        self.entries = OrderedDict() # label -> ([prefix of every cache buffer], last position output)
+        self.pinned = set()
+        self.model = None
+        self.key = None
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.entries.clear()
+        self.pinned.clear()
+
+    @staticmethod
+    def weights_version(model):
+        """ changes whenever a parameter of model is written in place or replaced """
+        return tuple((param.data_ptr(), param._version) for param in model.parameters())
+
+    def prefill(self, engine, x, num_null=0):
+        """ Write the class prefixes of x [B, cls_len] (the last num_null rows being null-class rows)
+        into the first B cache rows of engine, prefilling the classes that are not cached yet
+        return: prefill output of the last class position of every row
+        """
+        bs, cond_len = x.shape
+        key = (engine.dtype, engine.kv_cache_dtype, cond_len, self.weights_version(engine.model))
+        if engine.model is not self.model or key != self.key: # prefixes of other weights or cache storage are of no use
+            self.clear()
+            self.model, self.key = engine.model, key
+        labels = [tuple(row) for row in x.tolist()]
+        self.pinned.update(labels[bs - num_null:])
+        buffers = engine.prefix_buffers()
+
+        missing = list(dict.fromkeys(label for label in labels if label not in self.entries))
+        if missing:
+            output = engine.prefill_prefix(torch.tensor(missing, dtype=x.dtype, device=x.device))
+            for i, label in enumerate(missing):
+                self.entries[label] = ([buf[i, :, :cond_len].clone() for buf in buffers], output[i:i + 1].clone())
+        missing = set(missing)
+        self.misses += sum(label in missing for label in labels)
+        self.hits += sum(label not in missing for label in labels)
+
+        states = [self.entries[label] for label in labels]
+        for j, buf in enumerate(buffers):
+            buf[:bs, :, :cond_len] = torch.stack([prefix[j] for prefix, _ in states])
+        output = torch.cat([last for _, last in states])
+
+        for label in labels:
+            self.entries.move_to_end(label)
+        evictable = [label for label in self.entries if label not in self.pinned]
+        for label in evictable[:max(0, len(evictable) - self.max_classes)]:
+            del self.entries[label]
+        return output
+
+    def stats(self):
+        rows = self.hits + self.misses
+        return {"classes": len(self.entries), "hits": self.hits, "misses": self.misses,
+                "hit_rate": self.hits / rows if rows else 0.}
+
+
+class FactorizedSpeculativeEngine:
+    """ Speculative sampling for sample_Open_MAGVIT2, a small draft transformer proposing tokens for a large one
+    Both transformers have to share the factorized codebook and the class tokens, e.g. Open-MAGVIT2-AR-B
+    drafting for Open-MAGVIT2-AR-L / XL. A token is the pair x = (pre, post), its probability is
+    q(x) = q1(pre) q2(post | pre) under the draft and p(x) = p1(pre) p2(post | pre) under the target.
+    Every round the draft samples num_draft tokens one by one, the target scores all of them with one
+    spatial forward and one sub-token pass per sub-token (the num_draft + 1 positions run as rows), and
+    each draft token d is kept with probability min(1, p(d) / q(d)). The first rejected one is replaced
+    by a sample of norm(max(p - q, 0)) without going over the joint codebook: x is drawn from the
+    factorized p and kept with probability 1 - min(1, q(x) / p(x)), q(x) only costs one more draft
+    sub-token step. A pass keeps x with probability TV(p, q), so rows still pending after
+    max_residual_passes passes sample the residual explicitly over the joint (pre, post) codebook.
+    When all drafts are kept a bonus token is drawn from the target.
+    p and q are the distributions actually sampled from (cfg, temperature and top-k / top-p of each
+    sub-token), so the output follows the sample_Open_MAGVIT2 distribution of the target exactly.
+    The rows of a batch advance together by the shortest accepted run of the batch.
+    """
+    def __init__(self, model, draft_model, max_batch_size, max_seq_length, num_draft=4, device=None, kv_cache_dtype=None):
+        assert model.config.factorized_k == 2 and draft_model.config.factorized_k == 2, "tokens are (pre, post) pairs"
+        assert list(model.config.factorized_bits) == list(draft_model.config.factorized_bits), \
+            "draft and target must share the tokenizer"
+        assert model.config.class_num == draft_model.config.class_num, "draft and target must share the class tokens"
+        self.target = FactorizedGenerationEngine(model, max_batch_size, max_seq_length, device=device,
+                                                 kv_cache_dtype=kv_cache_dtype, subtoken_rows=max_batch_size * (num_draft + 1))
+        self.draft = FactorizedGenerationEngine(draft_model, max_batch_size, max_seq_length, device=device,
+                                                kv_cache_dtype=kv_cache_dtype)
+        self.model = model
+        self.draft_model = draft_model
+        self.num_draft = num_draft
+        self.max_draft = num_draft
+        self.device = self.target.device
+        self.kv_cache_dtype = kv_cache_dtype
+        self.max_residual_passes = 8
+        self.last_stats = None
+
+    @classmethod
+    def for_model(cls, model, draft_model, batch_size, seq_length, device, num_draft=4, kv_cache_dtype=None):
+        """ reuse the engine attached to the target model when it matches, otherwise build a new one """
+        engine = getattr(model, "speculative_engine", None)
+        if (engine is None or engine.model is not model or engine.draft_model is not draft_model
+                or engine.device != torch.device(device) or engine.kv_cache_dtype != kv_cache_dtype
+                or not engine.target.fits(batch_size, seq_length) or engine.max_draft < num_draft):
+            engine = cls(model, draft_model, batch_size, seq_length, num_draft=num_draft, device=device,
+                         kv_cache_dtype=kv_cache_dtype)
+            model.speculative_engine = engine
+        engine.num_draft = num_draft
+        return engine
+
+    @staticmethod
+    def sampling_probs(logits, use_cfg, cfg_scale, temperature, top_k, top_p):
+        """ distributions sample_Open_MAGVIT2 samples a sub-token from, logits: [rows, N, V] -> probs [B, N, V] """
+        if use_cfg: # conditional rows first, then their null-class rows
+            cond_logits, uncond_logits = logits.chunk(2, dim=0)
+            logits = uncond_logits + (cond_logits - uncond_logits) * cfg_scale
+        B, N, V = logits.shape
+        logits = top_k_top_p_filtering_rows(logits.reshape(B * N, V) / temperature, top_k=top_k, top_p=top_p)
+        return F.softmax(logits.float(), dim=-1).view(B, N, V)
+
+    @staticmethod
+    def token_probs(engine, h, probs, pre=None):
+        """ sub-token distributions of the contexts h [rows, N, D] of engine's model
+        pre: [B, M] pre sub-tokens of the first M <= N positions to condition post on, the others are drawn from p1
+        return: p1 [B, N, V1], pre [B, N], p2 (post | pre) [B, N, V2]
+        """
+        model = engine.model
+        p1 = probs(0, model.decode_subtoken(h, None, engine.subtoken_pos[0:1], first_step=True, kv_len=1))
+        B, N, V = p1.shape
+        given = 0 if pre is None else pre.shape[1]
+        if given < N:
+            drawn = torch.multinomial(p1[:, given:].reshape(-1, V), num_samples=1).view(B, N - given)
+            pre = drawn if pre is None else torch.cat([pre, drawn], dim=1)
+        logits = model.decode_subtoken(h, (pre.repeat(h.shape[0] // B, 1), None), engine.subtoken_pos[1:2], kv_len=2) # null-class rows reuse pre
+        return p1, pre, probs(1, logits)
+
+    def joint_residual(self, h, draft_h, probs, num_samples):
+        """ norm(max(p - q, 0)) over the joint (pre, post) codebook at one position (p where p == q)
+        h / draft_h: target / draft contexts of the position [rows, 1, D] of num_samples samples
+        p2 (post | pre) and q2 (post | pre) are computed for every pre value, as many pre values per
+        sub-token pass as the sub-token caches of both engines have rows for
+        return: [num_samples, V1 * V2], index pre * V2 + post
+        """
+        V1 = 2 ** self.model.config.factorized_bits[0]
+        width = max(1, min(self.target.subtoken_rows, self.draft.subtoken_rows) // h.shape[0])
+        p_joint, q_joint = [], []
+        for start in range(0, V1, width):
+            pre = torch.arange(start, min(start + width, V1), device=h.device).expand(num_samples, -1)
+            for engine, ctx, joint in ((self.target, h, p_joint), (self.draft, draft_h, q_joint)):
+                p1, _, p2 = self.token_probs(engine, ctx.expand(-1, pre.shape[1], -1), probs, pre=pre)
+                joint.append(p1[:, 0, start:start + pre.shape[1], None] * p2) # [B, width, V2]
+        p_joint = torch.cat(p_joint, dim=1).flatten(1)
+        residual = (p_joint - torch.cat(q_joint, dim=1).flatten(1)).clamp(min=0)
+        return torch.where(residual.sum(dim=-1, keepdim=True) > 0, residual, p_joint)
+
+    def residual_sample(self, h, draft_h, probs, pending):
+        """ sample of norm(max(p - q, 0)) at one position for the rows in pending [B]
+        h / draft_h: target / draft contexts of the position [rows, 1, D]
+        x = (pre, post) ~ p is kept with probability 1 - min(1, q(x) / p(x)), i.e. max(p(x) - q(x), 0) / p(x).
+        Only the pending rows are scored, the rows left after max_residual_passes use joint_residual
+        return: [2, B] pre / post sub-tokens (rows outside pending are left at 0)
+        """
+        num_samples = pending.shape[0]
+        use_cfg = h.shape[0] != num_samples
+        sample = torch.zeros(2, num_samples, dtype=torch.long, device=pending.device)
+        pending = pending.nonzero()[:, 0]
+        for _ in range(self.max_residual_passes):
+            if pending.numel() == 0:
+                return sample
+            rows = torch.cat([pending, pending + num_samples]) if use_cfg else pending
+            p1, pre, p2 = self.token_probs(self.target, h[rows], probs)
+            post = torch.multinomial(p2[:, 0], num_samples=1)
+            q1, _, q2 = self.token_probs(self.draft, draft_h[rows], probs, pre=pre)
+            p_x = p1[:, 0].gather(-1, pre)[:, 0] * p2[:, 0].gather(-1, post)[:, 0]
+            q_x = q1[:, 0].gather(-1, pre)[:, 0] * q2[:, 0].gather(-1, post)[:, 0]
+            keep = torch.rand_like(p_x) * p_x > q_x
+            sample[:, pending[keep]] = torch.stack([pre[:, 0], post[:, 0]])[:, keep]
+            pending = pending[~keep]
+        if pending.numel() > 0:
+            rows = torch.cat([pending, pending + num_samples]) if use_cfg else pending
+            V2 = 2 ** self.model.config.factorized_bits[1]
+            x = torch.multinomial(self.joint_residual(h[rows], draft_h[rows], probs, pending.numel()), num_samples=1)[:, 0]
+            sample[:, pending] = torch.stack([x // V2, x % V2])
+        return sample
+
+    @torch.no_grad()
+    def generate(self, x, steps, temperature, top_k, top_p, cfg_scale, sample_logits=True):
+        """
+        x: class tokens [B, cls_len] ([2B, cls_len], conditional then null class, when cfg_scale[0] > 1)
+        temperature, top_k, top_p, cfg_scale: one scalar per sub-token, as for sample_Open_MAGVIT2 (per-sample
+        values and sample_logits=False are rejected, the accept / resample rule needs one sampled distribution)
+        return: (pre tokens [B, steps], post tokens [B, steps])
+        """
+        if not sample_logits:
+            raise ValueError("speculative sampling only samples (sample_logits=True), use sample_Open_MAGVIT2 for greedy decoding")
+        if any(isinstance(v, (list, tuple, torch.Tensor)) for value in (temperature, top_k, top_p, cfg_scale) for v in value):
+            raise ValueError("speculative sampling takes one scalar temperature / top_k / top_p / cfg_scale per sub-token, "
+                             "use sample_Open_MAGVIT2 for per-sample values")
+        bs, cond_len = x.shape
+        assert self.target.fits(bs, cond_len + steps), \
+            f"engine sized for {self.target.max_batch_size} x {self.target.max_seq_length}, got {bs} x {cond_len + steps}"
+        use_cfg = cfg_enabled(cfg_scale[0])
+        num_samples = bs // 2 if use_cfg else bs
+        device = x.device
+        probs = lambda i, logits: self.sampling_probs(logits, use_cfg, cfg_scale[i], temperature[i], top_k[i], top_p[i])
+        rows = lambda t: torch.cat([t, t]) if use_cfg else t
+        target, draft = self.target.model, self.draft.model
+        self.target.reset()
+        self.draft.reset()
+
+        t0 = time.time()
+        tokens = self.target.tokens[:, :num_samples, :steps] # pre / post sub-tokens
+        prefill_pos = torch.arange(0, cond_len, device=device)
+        h = target.generate_context(x, input_pos=prefill_pos, first_step=True, kv_len=cond_len)
+        draft.generate_context(x, input_pos=prefill_pos, first_step=True, kv_len=cond_len)
+        _, pre, p2 = self.token_probs(self.target, h[:, -1:], probs)
+        tokens[0, :, 0] = pre[:, 0]
+        tokens[1, :, 0] = torch.multinomial(p2[:, 0], num_samples=1)[:, 0]
+
+        n = 1 # tokens emitted so far
+        draft_inputs = tokens[:, :, :1] # emitted tokens the draft has not read yet
+        rounds = proposed = accepted = 0
+        while n < steps:
+            k = min(self.num_draft, steps - n - 1)
+
+            ## draft k tokens autoregressively, keeping q(d) and the context of every draft position
+            pos = cond_len + n - draft_inputs.shape[2]
+            inputs, draft_tokens, draft_ctx, draft_q = draft_inputs, [], [], []
+            for i in range(k):
+                length = inputs.shape[2]
+                h = draft.generate_context((rows(inputs[0]), rows(inputs[1]), x), input_pos=torch.arange(pos, pos + length, device=device),
+                                           kv_len=pos + length)[:, -1:]
+                q1, pre, q2 = self.token_probs(self.draft, h, probs)
+                post = torch.multinomial(q2[:, 0], num_samples=1)
+                inputs = torch.stack([pre, post]) # [2, B, 1]
+                pos += length
+                draft_tokens.append(inputs)
+                draft_ctx.append(h)
+                draft_q.append(q1[:, 0].gather(-1, pre)[:, 0] * q2[:, 0].gather(-1, post)[:, 0])
+
+            ## score the last emitted token and the k drafts with a single spatial forward of the target
+            start = cond_len + n - 1
+            chunk = torch.cat([tokens[:, :, n - 1:n]] + draft_tokens, dim=2) # [2, B, k + 1]
+            h = target.generate_context((rows(chunk[0]), rows(chunk[1]), x), input_pos=torch.arange(start, start + k + 1, device=device),
+                                        kv_len=start + k + 1)
+            # post of the drafts is conditioned on their pre, the bonus position draws its pre from p1
+            p1, pre, p2 = self.token_probs(self.target, h, probs, pre=chunk[0, :, 1:])
+
+            n_acc = 0
+            if k > 0:
+                d_pre, d_post = chunk[0, :, 1:], chunk[1, :, 1:]
+                p_d = p1[:, :k].gather(-1, d_pre[..., None])[..., 0] * p2[:, :k].gather(-1, d_post[..., None])[..., 0]
+                q_d = torch.stack(draft_q, dim=1)
+                run = (torch.rand_like(p_d) * q_d < p_d).long().cumprod(dim=1).sum(dim=1) # leading accepted drafts
+                n_acc = int(run.min())
+                proposed += k * num_samples
+                accepted += int(run.sum())
+            if n_acc < k: # rows that rejected draft n_acc resample it from the residual, the others keep it
+                reject = run == n_acc
+                residual = self.residual_sample(h[:, n_acc:n_acc + 1], draft_ctx[n_acc], probs, reject)
+                last = torch.where(reject[None], residual, chunk[:, :, 1 + n_acc])
+            else: # every draft kept, bonus token from the target
+                last = torch.stack([pre[:, k], torch.multinomial(p2[:, k], num_samples=1)[:, 0]])
+            tokens[:, :, n:n + n_acc] = chunk[:, :, 1:1 + n_acc]
+            tokens[:, :, n + n_acc] = last
+
+            ## the draft has read its inputs up to draft k - 2, after a full acceptance draft k - 1 is still unread
+            first_unread = n + n_acc - 1 if (k > 0 and n_acc == k) else n + n_acc
+            draft_inputs = tokens[:, :, first_unread:n + n_acc + 1]
+            n += n_acc + 1
+            rounds += 1
+
+        sample = (tokens[0].clone(), tokens[1].clone())
+        if device.type == "cuda":
+            torch.cuda.current_stream(device).synchronize() # not other streams (e.g. a decode worker)
+        seconds = time.time() - t0
+        self.last_stats = {"tokens": num_samples * steps, "seconds": seconds,
+                           "tokens_per_sec": num_samples * steps / max(seconds, 1e-9),
+                           "acceptance_rate": accepted / max(proposed, 1),
+                           "tokens_per_round": (steps - 1) / max(rounds, 1), "rounds": rounds}
+        return sample
+
+
+def plan_kv_cache_batch(model, memory_budget, seq_length, kv_cache_dtype=None, cfg=True):
+    """ Largest number of images whose KV caches (spatial + sub-token) fit in memory_budget bytes
+    seq_length: class tokens + image tokens, cfg: every image also needs a null-class row
+    """
+    dtype = kv_cache_dtype or model.class_emb.embedding_table.weight.dtype
+    n_kv_head = model.config.n_kv_head if model.config.n_kv_head is not None else model.config.n_head
+    head_dim = model.config.dim // model.config.n_head
+    positions = (len(model.spatial_blocks) * find_multiple(seq_length, 8)
+                 + len(model.factorized_blocks) * find_multiple(model.config.factorized_k, 8))
+    bytes_per_row = positions * KVCache.bytes_per_position(n_kv_head, head_dim, dtype)
+    bytes_per_image = bytes_per_row * (2 if cfg else 1)
+    return {"bytes_per_image": bytes_per_image, "max_batch_size": int(memory_budget // bytes_per_image)}
+
+@torch.no_grad()
+def kv_cache_logit_kl(model, x, tokens, kv_cache_dtype, cfg_scale=(1.0, 1.0)):
+    """ Quality check of a compressed KV cache against the full precision one
+    Both caches are fed the same (teacher forced) tokens, e.g. a sample_Open_MAGVIT2 output,
+    and the next sub-token distributions (after cfg) of every step are compared.
+    x: class tokens as passed to sample_Open_MAGVIT2, tokens: (pre [B, steps], post [B, steps])
+    return: {'mean_kl', 'max_kl'} of KL(full precision || compressed) in nats, over both sub-tokens
+    """
+    bs, cond_len = x.shape
+    pre, post = tokens
+    steps = pre.shape[1]
+    use_cfg = cfg_scale[0] > 1.0
+    num_samples = bs // 2 if use_cfg else bs
+    dtype = model.class_emb.embedding_table.weight.dtype
+    k = model.config.factorized_k
+    rows = lambda t: torch.cat([t, t]) if use_cfg else t
+
+    def step_log_probs(cache_dtype):
+        with torch.device(x.device):
+            model.setup_caches(max_batch_size=bs, max_seq_length=cond_len + steps, dtype=dtype,
+                               kv_cache_dtype=cache_dtype)
+            model.setup_factorized_caches(max_batch_size=bs, max_seq_length=k, dtype=dtype,
+                                          kv_cache_dtype=cache_dtype)
+        log_probs = []
+        for n in range(steps):
+            if n == 0:
+                inputs, input_pos = x, torch.arange(0, cond_len, device=x.device)
+            else:
+                inputs = (rows(pre[:, n - 1:n]), rows(post[:, n - 1:n]), x)
+                input_pos = torch.tensor([cond_len + n - 1], device=x.device)
+            h = model.generate_context(inputs, input_pos=input_pos, first_step=(n == 0), kv_len=cond_len + n)
+            factor_x = x
+            for i in range(k):
+                logits = model.decode_subtoken(h, factor_x, torch.tensor([i], device=x.device),
+                                               first_step=(i == 0), kv_len=i + 1)
+                logits = logits[:, -1].float()
+                if use_cfg:
+                    cond_logits, uncond_logits = torch.split(logits, num_samples, dim=0)
+                    logits = uncond_logits + (cond_logits - uncond_logits) * cfg_scale[i]
+                log_probs.append(F.log_softmax(logits, dim=-1))
+                factor_x = (rows(pre[:, n:n + 1]), x)
+        return log_probs
+
+    kl = [(ref.exp() * (ref - comp)).sum(-1) for ref, comp in zip(step_log_probs(None), step_log_probs(kv_cache_dtype))]
+    kl = torch.stack(kl, dim=1)
+    return {"mean_kl": kl.mean().item(), "max_kl": kl.max().item()}
 
 @torch.no_grad()
 def sample_Open_MAGVIT2(x, model, steps, temperature=1.0, sample_logits=True, 
-           top_k=None, top_p=None, callback=None, token_factorization=True, cfg_scale=1.0):
+           top_k=None, top_p=None, callback=None, token_factorization=True, cfg_scale=1.0, engine=None, profile=False,
+           kv_cache_dtype=None, prefix_cache=None):
     assert token_factorization is True ### using factorization should be true
-    k = 2
-    bs, _ = x.shape
-    device = x.device
-    if cfg_scale[0] > 1.0:
-        cond_token, uncond_token = torch.split(x, bs // 2, dim=0)
-        sample_pre, sample_post = cond_token, cond_token
-    else:
-        cond_token = x
-        sample_pre, sample_post = cond_token, cond_token
-    
-    cond_len = x.shape[1]
-    if cfg_scale[0] > 1.0:
-        max_batch_size = x.shape[0] // 2
-    else:
-        max_batch_size = x.shape[0]
+    if engine is None:
+        engine = FactorizedGenerationEngine.for_model(model, x.shape[0], x.shape[1] + steps, x.device,
+                                                      kv_cache_dtype=kv_cache_dtype)
+    sample = engine.generate(x, steps, temperature, top_k, top_p, cfg_scale, profile=profile, prefix_cache=prefix_cache)
+    if profile:
+        print(", ".join(f"{name}: {value:.2f} ms" for name, value in engine.last_stats["ms_per_step"].items())
+              + f" per step, {engine.last_stats['tokens_per_sec']:.1f} tokens/s")
+    return sample
 
-    max_seq_length = cond_len + steps
-    with torch.device(device):
-        max_batch_size_cfg = max_batch_size * 2 if cfg_scale[0] >= 1.0 else max_batch_size
-        model.setup_caches(max_batch_size=max_batch_size_cfg, max_seq_length=max_seq_length, dtype=model.class_emb.embedding_table.weight.dtype)
-    
-    for n in range(steps): ## start to sample
-        if n == 0: #prefill operation
-            input_pos = torch.arange(0, cond_len, device=device) #C
-        elif n == 1:
-            input_pos = torch.tensor([cond_len], device=device)
-        else:
-            input_pos = input_pos + 1
-        
-        h = model.generate_context(x, input_pos=input_pos, first_step=(n==0))
-
-        x = []
-        with torch.device(device): ##setup factorization 
-            max_batch_size_cfg = max_batch_size * 2 if cfg_scale[0] >= 1.0 else max_batch_size
-            model.setup_factorized_caches(max_batch_size=max_batch_size_cfg, max_seq_length=max_seq_length, dtype=model.class_emb.embedding_table.weight.dtype)
-        for i in range(k):
-            if i == 0:## only CLS Token
-                if cfg_scale[i] > 1.0:
-                    factor_x = torch.concat([cond_token, uncond_token])
-                else:
-                    factor_x = cond_token
-            factor_input_pos = torch.tensor([i], device=device)
-            logits = model.decode_subtoken(h, factor_x, factor_input_pos, first_step=(i==0))
-
-            if cfg_scale[i] > 1.0: #0611
-                cond_logits, uncond_logits = torch.split(logits, bs // 2, dim=0)
-                logits = uncond_logits + (cond_logits - uncond_logits) * cfg_scale[i]
-
-            factor_x = sample_from_logits(logits, temperature[i], top_k[i], top_p[i])
-
-            if i == 0:
-                sample_pre = torch.cat((sample_pre, factor_x), dim=1)
-            else:
-                sample_post = torch.cat((sample_post, factor_x), dim=1)
-            
-            if cfg_scale[i] > 1.0:
-                cfg_x = torch.concat([factor_x, factor_x])
-                factor_x = [cfg_x, torch.concat([cond_token, uncond_token])]
-                x.append(cfg_x)
-            else:
-                non_cfg_x = factor_x
-                factor_x = (non_cfg_x, cond_token)
-                x.append(non_cfg_x)
-        if cfg_scale[0] > 1.0:
-            x.append(torch.concat([cond_token, uncond_token]))
-        else:
-            x.append(cond_token)
-    
-    sample_pre = sample_pre[:, cond_len:]
-    sample_post = sample_post[:, cond_len:]
-    sample = (sample_pre, sample_post)
+@torch.no_grad()
+def speculative_sample_Open_MAGVIT2(x, model, draft_model, steps, temperature=(1.0, 1.0), top_k=(None, None),
+                                    top_p=(None, None), cfg_scale=(1.0, 1.0), num_draft=4, engine=None, kv_cache_dtype=None,
+                                    sample_logits=True):
+    """ sample_Open_MAGVIT2 with draft_model proposing num_draft tokens per target forward, see FactorizedSpeculativeEngine """
+    if engine is None:
+        engine = FactorizedSpeculativeEngine.for_model(model, draft_model, x.shape[0], x.shape[1] + steps, x.device,
+                                                       num_draft=num_draft, kv_cache_dtype=kv_cache_dtype)
+    return engine.generate(x, steps, temperature, top_k, top_p, cfg_scale, sample_logits=sample_logits)
 
-    return sample  
+@torch.no_grad()
+def benchmark_speculative(x, model, draft_model, steps, num_draft=4, repeats=3, **sampling):
+    """ Wall-clock of speculative_sample_Open_MAGVIT2 against sample_Open_MAGVIT2 on the target alone
+    sampling: temperature / top_k / top_p / cfg_scale, one value per sub-token as for sample_Open_MAGVIT2
+    return: {'acceptance_rate', 'tokens_per_round', 'target_seconds', 'speculative_seconds', 'speedup'}
+    """
+    def best_time(fn):
+        seconds = []
+        for _ in range(repeats):
+            if x.device.type == "cuda":
+                torch.cuda.synchronize(x.device)
+            t = time.time()
+            fn()
+            if x.device.type == "cuda":
+                torch.cuda.synchronize(x.device)
+            seconds.append(time.time() - t)
+        return min(seconds)
+
+    target_seconds = best_time(lambda: sample_Open_MAGVIT2(x, model, steps, **sampling))
+    speculative_seconds = best_time(lambda: speculative_sample_Open_MAGVIT2(x, model, draft_model, steps, num_draft=num_draft, **sampling))
+    stats = model.speculative_engine.last_stats
+    return {"acceptance_rate": stats["acceptance_rate"], "tokens_per_round": stats["tokens_per_round"],
+            "target_seconds": target_seconds, "speculative_seconds": speculative_seconds,
+            "speedup": target_seconds / speculative_seconds}
 
 def sample_from_logits(logits, temperature=1.0, top_k=None, top_p=None, sample_logits=True):
     logits = logits[:, -1, :] / temperature
-    if top_k is not None or top_p is not None:
-        if top_k > 0 or top_p < 1.0:
-            logits = top_k_top_p_filtering(logits, top_k=top_k, top_p=top_p)
-    
-    probs = F.softmax(logits, dim=-1)
 
-    if not sample_logits:
-        _, x = top_k(probs, k=1, dim=-1)
+    if not sample_logits: # the most likely token always survives top-k / top-p
+        _, x = torch.topk(logits, k=1, dim=-1)
     else:
-        x = torch.multinomial(probs, num_samples=1)
+        x = sample_top_k_top_p(logits, top_k=top_k, top_p=top_p)
 
     return x
\ No newline at end of file
@@ -69,7 +69,7 @@ class CausalSelfAttention(nn.Module):
         self.register_buffer("mask", mask.view(1, 1, config.block_size, config.block_size))
         self.n_head = config.n_head
 
-    def forward(self, x, layer_past=None):
+    def forward(self, x, layer_past=None, cache=None, pos=None):
         B, T, C = x.size()
 
         # calculate query, key, values for all heads in batch and move head forward to be the batch dim
@@ -77,7 +77,15 @@ class CausalSelfAttention(nn.Module):
         q = self.query(x).view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
         v = self.value(x).view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
 
-        present = torch.stack((k, v))
+        if cache is not None:
+            # preallocated cache (2, B, nh, max_len, hs): write the new keys / values at pos:pos+T in place
+            # and attend over the filled prefix, the new rows stay causal among themselves
+            cache[0, :, :, pos:pos + T] = k
+            cache[1, :, :, pos:pos + T] = v
+            k, v = cache[0, :, :, :pos + T], cache[1, :, :, :pos + T]
+            present = None
+        else:
+            present = torch.stack((k, v))
         if layer_past is not None:
             past_key, past_value = layer_past
             k = torch.cat((past_key, k), dim=-2)
@@ -85,7 +93,10 @@ class CausalSelfAttention(nn.Module):
 
         # causal self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, T) -> (B, nh, T, T)
         att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
-        if layer_past is None:
+        if cache is not None:
+            if T > 1:
+                att = att.masked_fill(self.mask[:,:,pos:pos + T,:pos + T] == 0, float('-inf'))
+        elif layer_past is None:
             att = att.masked_fill(self.mask[:,:,:T,:T] == 0, float('-inf'))
 
         att = F.softmax(att, dim=-1)
@@ -112,11 +123,12 @@ class Block(nn.Module):
             nn.Dropout(config.resid_pdrop),
         )
 
-    def forward(self, x, layer_past=None, return_present=False):
+    def forward(self, x, layer_past=None, return_present=False, cache=None, pos=None):
         # TODO: check that training still works
         if return_present: assert not self.training
         # layer past: tuple of length two with B, nh, T, hs
-        attn, present = self.attn(self.ln1(x), layer_past=layer_past)
+        # cache: preallocated 2, B, nh, max_len, hs written in place at pos (GPT.forward_with_cache)
+        attn, present = self.attn(self.ln1(x), layer_past=layer_past, cache=cache, pos=pos)
 
         x = x + attn
         x = x + self.mlp(self.ln2(x))
@@ -319,6 +331,39 @@ class GPT(nn.Module):
 
         return logits, loss, torch.stack(presents)  # _, _, n_layer, 2, b, nh, 1, dim_head
 
+    def new_kv_cache(self, batch_size, max_length, device=None, dtype=None):
+        """ preallocated key / value cache for forward_with_cache: n_layer, 2, b, nh, max_length, dim_head """
+        weight = self.pos_emb
+        return torch.zeros(self.config.n_layer, 2, batch_size, self.config.n_head, max_length,
+                           self.config.n_embd // self.config.n_head,
+                           device=device or weight.device, dtype=dtype or weight.dtype)
+
+    def forward_with_cache(self, idx, cache, pos, embeddings=None):
+        """
+        forward_with_past against a preallocated cache (new_kv_cache) instead of a growing list of presents:
+        the keys / values of the new positions pos:pos+T are written in place and nothing is concatenated,
+        so several positions (e.g. the class token and a given prefix) can be prefilled in one call.
+        idx: token indices (b, T'), embeddings: optional embeddings prepended to them (the class token)
+        return: logits of the T new positions (b, T, vocab_size)
+        """
+        # inference only, not token factorization
+        assert not self.training and not self.token_factorization
+        token_embeddings = self.tok_emb(idx)
+        if embeddings is not None:              # prepend explicit embeddings
+            token_embeddings = torch.cat((embeddings, token_embeddings), dim=1)
+        T = token_embeddings.shape[1]
+        assert pos + T <= cache.shape[-2], "Cannot forward, kv cache is exhausted."
+
+        x = self.drop(token_embeddings + self.pos_emb[:, pos:pos + T, :])
+        for i, block in enumerate(self.blocks):
+            x = block(x, cache=cache[i], pos=pos)
+        x = self.ln_f(x)
+        if self.weight_tying:
+            logits = x @ self.tok_emb.weight.T
+        else:
+            logits = self.head(x)
+        return logits
+
 
 class DummyGPT(nn.Module):
     # for debugging
@@ -1,5 +1,13 @@
-from OpenImageTokenizer.Open_MAGVIT2.modules.transformer.gpt import sample_Open_MAGVIT2
-from OpenImageTokenizer.IBQ.modules.transformer.llama import sample_IBQ
+import heapq
+import time
+import queue
+import threading
+from collections import deque
+from contextlib import contextmanager
+import numpy as np
+import torch
+from OpenImageTokenizer.Open_MAGVIT2.modules.transformer.gpt import sample_Open_MAGVIT2, FactorizedGenerationEngine
+from OpenImageTokenizer.IBQ.modules.transformer.llama import sample_IBQ, IBQGenerationEngine
 
 class SampleOpenMAGVIT2:
     def __init__(self) -> None:
@@ -7,4 +15,424 @@ class SampleOpenMAGVIT2:
 
 class SampleIBQ:
     def __init__(self) -> None:
-        pass
\ No newline at end of file
+        pass
+
+
+class KVBlockAllocator:
+    """ Free list of KV cache blocks for continuous batching
+    A block is the set of cache rows of one sequence: its conditional and null-class rows
+    when using cfg, so both halves of a cfg pair are admitted, decoded and released together.
+    Every image has the same length (class token + h * w tokens), so a block spans the whole
+    sequence axis and never has to grow or be paged. The lowest free block is handed out
+    first, which keeps the live blocks packed at the start of the cache and lets a decoding
+    step run over the first high_water blocks only.
+    """
+    def __init__(self, num_blocks, rows_per_block=1):
+        self.num_blocks = num_blocks
+        self.rows_per_block = rows_per_block
+        self.free_blocks = list(range(num_blocks)) # heap
+        self.used_blocks = set()
+
+    @property
+    def num_free(self):
+        return len(self.free_blocks)
+
+    @property
+    def high_water(self):
+        """ number of blocks a step has to cover, one past the highest block in use """
+        return max(self.used_blocks) + 1 if self.used_blocks else 0
+
+    def allocate(self):
+        """ lowest free block, None when the cache is full """
+        if not self.free_blocks:
+            return None
+        block = heapq.heappop(self.free_blocks)
+        self.used_blocks.add(block)
+        return block
+
+    def free(self, block):
+        self.used_blocks.remove(block)
+        heapq.heappush(self.free_blocks, block)
+
+    def rows(self, block):
+        return slice(block * self.rows_per_block, (block + 1) * self.rows_per_block)
+
+
+class GenerationRequest:
+    """ One image requested from a ContinuousBatchingScheduler
+    temperature, top_k, top_p, cfg_scale: scalars, or one value per sub-token for factorized models
+    (top_k 0 / top_p 1.0 disable filtering)
+    tokens: sampled tokens once done, [steps] (IBQ) or (pre [steps], post [steps]) (Open-MAGVIT2)
+    """
+    def __init__(self, class_label, temperature=1.0, top_k=0, top_p=1.0, cfg_scale=1.0, request_id=None):
+        self.class_label = int(class_label)
+        self.temperature = temperature
+        self.top_k = 0 if top_k is None else top_k
+        self.top_p = 1.0 if top_p is None else top_p
+        self.cfg_scale = cfg_scale
+        self.request_id = request_id
+        self.submit_time = time.time()
+        self.start_time = None # admitted into the decode batch
+        self.finish_time = None
+        self.tokens = None
+
+    @property
+    def done(self):
+        return self.finish_time is not None
+
+    @property
+    def latency(self):
+        return self.finish_time - self.submit_time
+
+
+class ContinuousBatchingScheduler:
+    """ Continuous batching for online class-conditional sampling (IBQ and Open-MAGVIT2 transformers)
+    Requests are queued with submit() and decoded together by step(). At every step boundary
+    waiting requests are admitted into free KV cache blocks and start from their class token
+    while the other sequences keep decoding, and sequences that produced their last token leave
+    the batch and release their block. Rows decode at different positions, each one attending
+    to its own prefix only, so unlike one sample_IBQ / sample_Open_MAGVIT2 loop per request the
+    decoding batch stays full under load and a new request waits at most one step to start.
+
+    Usage:
+        scheduler = ContinuousBatchingScheduler(model.transformer, max_images=16, steps=256, cfg=True)
+        request = scheduler.submit(207, cfg_scale=4.0, top_k=4000)
+        while not request.done:
+            scheduler.step()
+    """
+    def __init__(self, model, max_images, steps=256, cfg=True, device=None, kv_cache_dtype=None, sample_logits=True):
+        self.model = model
+        self.factorized = hasattr(model, "factorized_blocks")
+        self.k = model.config.factorized_k if self.factorized else 1
+        self.steps = steps
+        self.cfg = cfg
+        self.sample_logits = sample_logits
+        self.allocator = KVBlockAllocator(max_images, 2 if cfg else 1)
+        num_rows = max_images * self.allocator.rows_per_block
+        engine_cls = FactorizedGenerationEngine if self.factorized else IBQGenerationEngine
+        self.engine = engine_cls(model, num_rows, 1 + steps, device=device, kv_cache_dtype=kv_cache_dtype)
+        self.engine.reset()
+        self.device = self.engine.device
+
+        ## per block state, mirrored on the host so that admission and retirement need no device reads
+        self.host_positions = np.zeros(max_images, dtype=np.int64)
+        self.host_cls = np.full((num_rows, 1), model.config.class_num, dtype=np.int64) # null class by default
+        self.host_params = {
+            "cfg_scale": np.ones((max_images, self.k), dtype=np.float32),
+            "temperature": np.ones((max_images, self.k), dtype=np.float32),
+            "top_k": np.zeros((max_images, self.k), dtype=np.int64),
+            "top_p": np.ones((max_images, self.k), dtype=np.float32),
+        }
+        self.cls_idx = torch.from_numpy(self.host_cls).to(self.device)
+        self.params = {name: torch.from_numpy(value).to(self.device) for name, value in self.host_params.items()}
+        self.tokens = torch.zeros(self.k, num_rows, 1, dtype=torch.long, device=self.device) # inputs of the next step
+        self.output = torch.zeros(max_images, self.k, steps, dtype=torch.long, device=self.device)
+        self.slots = [None] * max_images
+        self.waiting = deque()
+        self.stats = {"steps": 0, "tokens": 0, "row_steps": 0, "busy_row_steps": 0}
+
+    @property
+    def has_pending(self):
+        return bool(self.waiting) or bool(self.allocator.used_blocks)
+
+    def submit(self, class_label, temperature=1.0, top_k=0, top_p=1.0, cfg_scale=1.0, request_id=None):
+        """ queue a request, it joins the decoding batch at the next step with a free block """
+        request = GenerationRequest(class_label, temperature=temperature, top_k=top_k, top_p=top_p,
+                                    cfg_scale=cfg_scale, request_id=request_id)
+        if cfg_scale is not None and np.any(np.asarray(cfg_scale) > 1.0):
+            assert self.cfg, "the scheduler was built without null-class rows (cfg=False)"
+        self.waiting.append(request)
+        return request
+
+    def _admit(self):
+        admitted = 0
+        while self.waiting and self.allocator.num_free:
+            request = self.waiting.popleft()
+            block = self.allocator.allocate()
+            rows = self.allocator.rows(block)
+            self.host_cls[rows.start] = request.class_label # the null-class row of a cfg pair keeps class_num
+            self.host_positions[block] = 0
+            for name in self.host_params:
+                self.host_params[name][block] = getattr(request, name)
+            self.slots[block] = request
+            request.start_time = time.time()
+            admitted += 1
+        if admitted:
+            self.cls_idx.copy_(torch.from_numpy(self.host_cls))
+            for name, value in self.host_params.items():
+                self.params[name].copy_(torch.from_numpy(value))
+        return admitted
+
+    def _synchronize(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+
+    @torch.no_grad()
+    def step(self):
+        """ Admit waiting requests, decode one token of every live sequence and retire the finished ones
+        return: the requests finished by this step
+        """
+        self._admit()
+        num_blocks = self.allocator.high_water
+        if num_blocks == 0:
+            return []
+        rows_per_block = self.allocator.rows_per_block
+        num_rows = num_blocks * rows_per_block
+        self.engine.bind()
+
+        ## free blocks below the high water mark decode a throw-away token at position 0
+        block_positions = self.host_positions[:num_blocks]
+        positions = torch.from_numpy(np.repeat(block_positions, rows_per_block)).to(self.device)
+        tokens = self.tokens[:, :num_rows] if self.factorized else self.tokens[0, :num_rows]
+        params = {name: value[:num_blocks] for name, value in self.params.items()}
+        if not (self.host_params["top_k"][:num_blocks] > 0).any() and not (self.host_params["top_p"][:num_blocks] < 1.0).any():
+            params["top_k"] = params["top_p"] = None # nobody filters, skip the sort
+        next_tokens = self.engine.step_slots(tokens, self.cls_idx[:num_rows], positions, int(block_positions.max()) + 1,
+                                             use_cfg=self.cfg, sample_logits=self.sample_logits, **params) # [num_blocks, k]
+
+        block_ids = torch.arange(num_blocks, device=self.device)
+        self.output[block_ids, :, positions[::rows_per_block]] = next_tokens
+        self.tokens[:, :num_rows] = next_tokens.t().repeat_interleave(rows_per_block, dim=1)[..., None]
+
+        live = np.fromiter(self.allocator.used_blocks, dtype=np.int64)
+        self.host_positions[live] += 1
+        self.stats["steps"] += 1
+        self.stats["tokens"] += len(live)
+        self.stats["row_steps"] += num_rows
+        self.stats["busy_row_steps"] += len(live) * rows_per_block
+
+        finished = []
+        for block in live[self.host_positions[live] == self.steps].tolist():
+            request = self.slots[block]
+            tokens = self.output[block].clone()
+            request.tokens = (tokens[0], tokens[1]) if self.factorized else tokens[0]
+            finished.append(request)
+            self.slots[block] = None
+            self.host_positions[block] = 0
+            self.allocator.free(block)
+        if finished:
+            self._synchronize()
+            now = time.time()
+            for request in finished:
+                request.finish_time = now
+        return finished
+
+    def run(self):
+        """ step until every submitted request is done """
+        finished = []
+        while self.has_pending:
+            finished.extend(self.step())
+        return finished
+
+    @property
+    def utilization(self):
+        """ fraction of the decoded rows that belonged to a live sequence """
+        return self.stats["busy_row_steps"] / max(self.stats["row_steps"], 1)
+
+
+def _latency_report(latencies, num_tokens, duration):
+    latencies = np.asarray(latencies)
+    return {
+        "requests": len(latencies),
+        "p50_latency": float(np.percentile(latencies, 50)),
+        "p99_latency": float(np.percentile(latencies, 99)),
+        "mean_latency": float(latencies.mean()),
+        "throughput": len(latencies) / duration, # images / s
+        "tokens_per_sec": num_tokens / duration,
+        "duration": duration,
+    }
+
+@torch.no_grad()
+def run_load_test(model, mode="continuous", num_requests=64, rate=2.0, max_images=16, steps=256,
+                  temperature=1.0, top_k=0, top_p=1.0, cfg_scale=1.0, num_classes=None, seed=0, kv_cache_dtype=None):
+    """ Local load generator for online class-conditional sampling
+    num_requests requests for random classes arrive as a Poisson process of `rate` requests per
+    second and are served in real time either by a ContinuousBatchingScheduler with max_images
+    blocks (mode="continuous") or one request at a time by sample_IBQ / sample_Open_MAGVIT2
+    (mode="sequential", the current serving loop). Latency counts from the arrival of a request.
+
+    model: the IBQ or Open-MAGVIT2 transformer (Net2NetTransformer.transformer)
+    temperature, top_k, top_p, cfg_scale: scalars, or one value per sub-token for Open-MAGVIT2
+    return: {'requests', 'p50_latency', 'p99_latency', 'mean_latency' (s), 'throughput' (images / s),
+             'tokens_per_sec', 'duration' (s)} (+ 'utilization' of the decoded rows with mode="continuous")
+    """
+    assert mode in ("continuous", "sequential")
+    rng = np.random.default_rng(seed)
+    num_classes = num_classes or model.config.class_num
+    arrivals = np.cumsum(rng.exponential(1.0 / rate, size=num_requests))
+    arrivals -= arrivals[0]
+    classes = rng.integers(0, num_classes, size=num_requests)
+    factorized = hasattr(model, "factorized_blocks")
+    use_cfg = bool(np.any(np.asarray(cfg_scale) > 1.0))
+    device = model.class_emb.embedding_table.weight.device
+
+    def wait_until(offset):
+        delay = start + offset - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    latencies = []
+    if mode == "continuous":
+        scheduler = ContinuousBatchingScheduler(model, max_images, steps=steps, cfg=use_cfg, device=device,
+                                                kv_cache_dtype=kv_cache_dtype)
+        start = time.time()
+        submitted = 0
+        while len(latencies) < num_requests:
+            now = time.time() - start
+            while submitted < num_requests and arrivals[submitted] <= now:
+                request = scheduler.submit(classes[submitted], temperature=temperature, top_k=top_k, top_p=top_p,
+                                           cfg_scale=cfg_scale, request_id=submitted)
+                request.submit_time = start + arrivals[submitted]
+                submitted += 1
+            if not scheduler.has_pending:
+                wait_until(arrivals[submitted])
+                continue
+            latencies.extend(request.latency for request in scheduler.step())
+        report = _latency_report(latencies, num_requests * steps, time.time() - start)
+        report["utilization"] = scheduler.utilization
+        return report
+
+    sample = sample_Open_MAGVIT2 if factorized else sample_IBQ
+    per_subtoken = lambda value: list(value) if isinstance(value, (list, tuple)) else [value] * 2
+    if factorized:
+        temperature, top_k, top_p, cfg_scale = map(per_subtoken, (temperature, top_k, top_p, cfg_scale))
+    start = time.time()
+    for i in range(num_requests):
+        wait_until(arrivals[i])
+        x = torch.tensor([[classes[i]]], device=device)
+        if use_cfg:
+            x = torch.cat([x, torch.full_like(x, model.config.class_num)])
+        sample(x, model, steps, temperature=temperature, top_k=top_k, top_p=top_p, cfg_scale=cfg_scale,
+               kv_cache_dtype=kv_cache_dtype)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        latencies.append(time.time() - (start + arrivals[i]))
+    return _latency_report(latencies, num_requests * steps, time.time() - start)
+
+
+_END_OF_BATCHES = object()
+
+class SamplingPipeline:
+    """ Overlap AR sampling with VQ decoding and image encoding
+    The caller samples token batches on its own thread and submits them; a decode worker turns
+    them into images (decode_fn) and an encode worker converts / writes them (encode_fn) while
+    the next batch is being sampled. Each queue holds at most max_pending batches, so a slow
+    stage makes submit wait instead of piling up tokens or decoded images. On CUDA the decoder
+    runs on its own stream, which waits for the sampling stream of the batch it decodes only.
+
+    decode_fn: item -> decoded item, should leave its results on the host (e.g. images.cpu())
+    encode_fn: decoded item -> result, results are kept in submission order
+
+    Usage:
+        with SamplingPipeline(decode_fn, encode_fn, device=device) as pipeline:
+            for batch in batches:
+                with pipeline.timed("sample"):
+                    item = sample(batch)
+                pipeline.submit(item)
+        pipeline.results, pipeline.utilization()
+    """
+    def __init__(self, decode_fn, encode_fn, max_pending=2, device=None):
+        self.decode_fn = decode_fn
+        self.encode_fn = encode_fn
+        self.device = torch.device(device) if device is not None else None
+        self.stream = torch.cuda.Stream(self.device) if self.device is not None and self.device.type == "cuda" else None
+        self.pending = queue.Queue(maxsize=max(1, max_pending)) # sampled, not decoded
+        self.decoded = queue.Queue(maxsize=max(1, max_pending)) # decoded, not encoded
+        self.results = []
+        self.busy = {"sample": 0., "decode": 0., "encode": 0., "submit_wait": 0.}
+        self.error = None
+        self.closed = False
+        self.start_time = time.time()
+        self.end_time = None
+        self.workers = [threading.Thread(target=self._decode_loop, daemon=True),
+                        threading.Thread(target=self._encode_loop, daemon=True)]
+        for worker in self.workers:
+            worker.start()
+
+    @contextmanager
+    def timed(self, stage):
+        """ add the time spent in the block to `stage` (e.g. "sample" around the caller's sampling) """
+        t = time.time()
+        try:
+            yield
+        finally:
+            self.busy[stage] = self.busy.get(stage, 0.) + time.time() - t
+
+    def _run(self, stage, fn, item):
+        if self.error is not None: ## an earlier batch failed, only drain the queues
+            return None
+        try:
+            with self.timed(stage):
+                return fn(item)
+        except Exception as e: ##re-raised in the caller thread
+            self.error = e
+            return None
+
+    def _decode_loop(self):
+        with torch.no_grad(): ## grad mode is per thread
+            while True:
+                item = self.pending.get()
+                if item is _END_OF_BATCHES:
+                    self.decoded.put(_END_OF_BATCHES)
+                    return
+                item, ready = item
+                if self.stream is not None:
+                    self.stream.wait_event(ready)
+                    with torch.cuda.stream(self.stream):
+                        decoded = self._run("decode", self.decode_fn, item)
+                else:
+                    decoded = self._run("decode", self.decode_fn, item)
+                del item
+                self.decoded.put(decoded)
+
+    def _encode_loop(self):
+        while True:
+            decoded = self.decoded.get()
+            if decoded is _END_OF_BATCHES:
+                return
+            result = self._run("encode", self.encode_fn, decoded)
+            if self.error is None:
+                self.results.append(result)
+
+    def submit(self, item):
+        """ hand a sampled batch to the decode worker, waits while max_pending batches are queued """
+        if self.error is not None:
+            raise self.error
+        ready = None
+        if self.stream is not None:
+            ready = torch.cuda.Event()
+            ready.record(torch.cuda.current_stream(self.device))
+        with self.timed("submit_wait"):
+            self.pending.put((item, ready))
+
+    def _stop(self):
+        if not self.closed:
+            self.closed = True
+            self.pending.put(_END_OF_BATCHES)
+            for worker in self.workers:
+                worker.join()
+            self.end_time = time.time()
+
+    def close(self):
+        """ wait for the queued batches to be decoded and encoded, return: the encode_fn results """
+        self._stop()
+        if self.error is not None:
+            raise self.error
+        return self.results
+
+    def utilization(self):
+        """ fraction of the wall time every stage was busy, and the total wall time (s) """
+        duration = (self.end_time or time.time()) - self.start_time
+        stats = {stage: busy / max(duration, 1e-9) for stage, busy in self.busy.items()}
+        stats["duration"] = duration
+        return stats
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else: ## stop the workers, the caller's exception propagates
+            self.error = self.error or exc_value
+            self._stop()
@@ -7,6 +7,7 @@ import numpy as np
 from PIL import Image
 import os
 import matplotlib.pyplot as plt
+from contextlib import nullcontext
 
 
 class MAGVIT2ImageTokenizer:
@@ -950,6 +951,67 @@ class IBQImageTokenizer:
             traceback.print_exc()
             return None
 
+class _HostCopier:
+    """
+    Copia las salidas de cada ventana a buffers de CPU preasignados.
+
+    En CUDA la copia se lanza sin bloquear en un stream aparte hacia uno de dos juegos
+    de buffers intermedios (pinned), y se vuelca al buffer final cuando llega la ventana
+    siguiente, de modo que la transferencia se solapa con su cómputo (doble buffer).
+    """
+    def __init__(self, device):
+        self.cuda = torch.device(device).type == "cuda"
+        self.stream = torch.cuda.Stream(device=device) if self.cuda else None
+        self.staging = [[], []]
+        self.slot = 0
+        self.pending = None
+
+    def _staging_buffer(self, i, src):
+        buffers = self.staging[self.slot]
+        if len(buffers) <= i:
+            buffers.append(None)
+        if buffers[i] is None or buffers[i].numel() < src.numel() or buffers[i].dtype != src.dtype:
+            buffers[i] = torch.empty(src.numel(), dtype=src.dtype, pin_memory=True)
+        return buffers[i][:src.numel()].view(src.shape)
+
+    def _finish(self, pending):
+        event, copies = pending
+        event.synchronize()
+        for dst, staging in copies:
+            dst.copy_(staging)
+
+    def copy(self, pairs):
+        """
+        Args:
+            pairs: Lista de (destino en CPU, origen en el dispositivo) de una misma ventana
+        """
+        if not self.cuda:
+            for dst, src in pairs:
+                dst.copy_(src)
+            return
+
+        self.stream.wait_stream(torch.cuda.current_stream())
+        copies = []
+        with torch.cuda.stream(self.stream):
+            for i, (dst, src) in enumerate(pairs):
+                staging = self._staging_buffer(i, src)
+                staging.copy_(src, non_blocking=True)
+                src.record_stream(self.stream)
+                copies.append((dst, staging))
+        event = torch.cuda.Event()
+        event.record(self.stream)
+        self.slot = 1 - self.slot
+
+        # Volcar la ventana anterior mientras ésta se copia
+        previous, self.pending = self.pending, (event, copies)
+        if previous is not None:
+            self._finish(previous)
+
+    def synchronize(self):
+        if self.pending is not None:
+            self._finish(self.pending)
+            self.pending = None
+
 class MAGVIT2VideoTokenizer:
     """
     Tokenizador de videos basado en MAGVIT2.
@@ -979,10 +1041,25 @@ class MAGVIT2VideoTokenizer:
         """Obtiene la configuración del modelo"""
         return self.config
 
-    def load_model(self):
+    @staticmethod
+    def _has_video_weights(state_dict):
+        """Indica si el state_dict ya contiene los pesos 3D del encoder y del decoder"""
+        video_weights = [k for k, v in state_dict.items()
+                         if k.startswith(("encoder.", "decoder.")) and torch.is_tensor(v) and v.dim() == 5]
+        return any(k.startswith("encoder.") for k in video_weights) and any(k.startswith("decoder.") for k in video_weights)
+
+    def load_model(self, skip_inflation=True):
         """
         Carga el modelo MAGVIT2 para video usando la configuración y checkpoint.
+
+        Cuando el checkpoint ya contiene los pesos completos del modelo de video, el modelo se
+        construye sin inflar desde el checkpoint de imagen (no se descarga ni se carga), ya que
+        esos pesos se sobrescribirían inmediatamente.
     
+        Args:
+            skip_inflation: Omitir el inflado desde el checkpoint de imagen si no es necesario
+                (False reproduce la carga anterior, útil para comparar tiempos de arranque)
+
         Returns:
             El modelo cargado
         """
@@ -991,20 +1068,34 @@ class MAGVIT2VideoTokenizer:
     
         try:
             import os
+            import time
             from OpenImageTokenizer.Open_MAGVIT2.models.video_lfqgan import VQModel
             from OpenImageTokenizer.hf_utils import get_model_checkpoint
+
+            start_time = time.time()
         
             # Obtener checkpoint y configuración
             checkpoint_path = self._get_checkpoint()
             config = self._get_config()
         
             print(f"Cargando modelo desde checkpoint: {checkpoint_path}")
+
+            # Cargar pesos del checkpoint
+            state_dict = torch.load(checkpoint_path, map_location="cpu")
+            if "state_dict" in state_dict:
+                state_dict = state_dict["state_dict"]
         
             # Crear el modelo con los parámetros de configuración ajustados
             model_args = config["model"]["init_args"].copy()
+
+            if skip_inflation and self._has_video_weights(state_dict):
+                # El checkpoint de video sobrescribe todo lo que aportaría el inflado
+                if model_args.get("image_pretrain_path") is not None:
+                    print("El checkpoint ya contiene los pesos de video. Omitiendo inflate_from_image.")
+                model_args["image_pretrain_path"] = None
         
             # Verificar si se necesita un checkpoint de imagen preentrenado
-            if "image_pretrain_path" in model_args:
+            elif model_args.get("image_pretrain_path") is not None:
                 image_pretrain_path = model_args["image_pretrain_path"]
             
                 # Si la ruta es relativa o no existe, obtener el checkpoint de imagen
@@ -1028,11 +1119,6 @@ class MAGVIT2VideoTokenizer:
             # Crear el modelo con los argumentos ajustados
             self.model = VQModel(**model_args)
         
-            # Cargar pesos del checkpoint
-            state_dict = torch.load(checkpoint_path, map_location="cpu")
-            if "state_dict" in state_dict:
-                state_dict = state_dict["state_dict"]
-        
             # Cargar pesos en el modelo
             missing, unexpected = self.model.load_state_dict(state_dict, strict=False)
         
@@ -1043,7 +1129,7 @@ class MAGVIT2VideoTokenizer:
         
             # Mover modelo al dispositivo y poner en modo evaluación
             self.model = self.model.eval().to(self.device)
-            print("Modelo cargado correctamente")
+            print(f"Modelo cargado correctamente en {time.time() - start_time:.2f} s")
         
             return self.model
         
@@ -1082,15 +1168,50 @@ class MAGVIT2VideoTokenizer:
     
         return transforms
 
-    def video_to_tensor(self, video_path, temporal_window=16, max_frames=64, resolution=None):
+    def plan_sampling(self, video_path, target_fps=None, target_duration=None, max_frames=None, start_time=0.0, num_threads=0, verbose=True):
+        """
+        Planifica qué frames leer de un video antes de decodificarlo.
+
+        Los frames se toman en una rejilla temporal fija (target_fps) durante target_duration
+        segundos, de modo que todos los videos tienen la misma densidad temporal sin importar
+        su fps original. Los índices se agrupan por intervalo de keyframes (GOP) para que el
+        decodificador sólo avance hacia delante dentro de cada grupo.
+
+        Args:
+            video_path: Ruta al video
+            target_fps: Frames por segundo a muestrear (None para el fps original)
+            target_duration: Segundos de video a muestrear (None hasta el final)
+            max_frames: Número máximo de frames a muestrear
+            start_time: Segundo inicial
+            num_threads: Hilos de decodificación de decord (0 para que decida decord)
+            verbose: Imprimir el resumen del plan
+
+        Returns:
+            dict: Plan de plan_frame_sampling ('indices', 'groups', 'decoded_frames', 'used_frames', ...)
+        """
+        from OpenImageTokenizer.Open_MAGVIT2.data.video_reader import plan_frame_sampling
+
+        plan = plan_frame_sampling(video_path, target_fps=target_fps, target_duration=target_duration,
+                                   start_time=start_time, max_frames=max_frames, num_threads=num_threads)
+        if verbose:
+            print(f"Muestreo: {plan['used_frames']} frames a {plan['fps']:.2f} fps "
+                  f"(original {plan['source_fps']:.2f} fps, {plan['duration']:.2f} s)")
+            print(f"Decodificación: {plan['decoded_frames']} frames decodificados para {plan['used_frames']} usados, "
+                  f"{len(plan['groups'])} grupos GOP, {plan['num_seeks']} saltos a keyframe")
+        return plan
+
+    def video_to_tensor(self, video_path, temporal_window=16, max_frames=64, resolution=None, target_fps=None, target_duration=None, num_threads=0):
         """
         Convierte un video a un tensor normalizado para el modelo, limitando la cantidad de frames.
     
         Args:
             video_path: Ruta al video
             temporal_window: Número de frames por ventana temporal
-            max_frames: Número máximo de frames a procesar para evitar problemas de memoria
+            max_frames: Número máximo de frames a procesar para evitar problemas de memoria (None para todos)
             resolution: Resolución para redimensionar (si es None, se obtiene de la configuración)
+            target_fps: Muestrear a este fps fijo en lugar de repartir max_frames por todo el video
+            target_duration: Segundos de video a muestrear con target_fps
+            num_threads: Hilos de decodificación de decord (0 para que decida decord)
             
         Returns:
             tuple: (tensor de video, frames por ventana, forma original)
@@ -1110,11 +1231,15 @@ class MAGVIT2VideoTokenizer:
         transforms = self.get_transforms(resolution)
     
         # Cargar video
-        vr = VideoReader(video_path, ctx=cpu(0))
+        vr = VideoReader(video_path, ctx=cpu(0), num_threads=num_threads)
         total_frames = len(vr)
     
+        if target_fps is not None or target_duration is not None:
+            # Rejilla temporal fija, agrupada por keyframes
+            frame_indices = self.plan_sampling(video_path, target_fps=target_fps, target_duration=target_duration,
+                                               max_frames=max_frames, num_threads=num_threads)['indices']
         # Limitar el número de frames para evitar problemas de memoria
-        if total_frames > max_frames:
+        elif max_frames is not None and total_frames > max_frames:
             print(f"Limitando el video de {total_frames} frames a {max_frames} frames para evitar problemas de memoria")
             # Tomar frames distribuidos uniformemente
             frame_indices = np.linspace(0, total_frames - 1, max_frames, dtype=int)
@@ -1133,6 +1258,37 @@ class MAGVIT2VideoTokenizer:
     
         return video_tensor, len(frame_indices), video_frames.shape
 
+    def iter_video_windows(self, video_path, window_size=16, resolution=None, frame_indices=None, target_fps=None, target_duration=None, num_threads=0):
+        """
+        Lee un video por ventanas de frames en lugar de cargar el clip completo.
+
+        Un hilo en segundo plano decodifica con decord y redimensiona/recorta cada ventana
+        mientras se codifica la anterior, por lo que la memoria máxima es proporcional al
+        tamaño de la ventana y no a la duración del video.
+
+        Args:
+            video_path: Ruta al video
+            window_size: Número de frames por ventana
+            resolution: Resolución para redimensionar (si es None, se obtiene de la configuración)
+            frame_indices: Frames a leer (None para todos)
+            target_fps: Muestrear a este fps fijo (ver plan_sampling)
+            target_duration: Segundos de video a muestrear
+            num_threads: Hilos de decodificación de decord (0 para que decida decord)
+
+        Yields:
+            torch.Tensor: Ventana normalizada [C, t, H, W] en CPU
+        """
+        from OpenImageTokenizer.Open_MAGVIT2.data.video_reader import iter_video_windows
+
+        if frame_indices is None and (target_fps is not None or target_duration is not None):
+            frame_indices = self.plan_sampling(video_path, target_fps=target_fps, target_duration=target_duration,
+                                               num_threads=num_threads)['indices']
+
+        transforms = self.get_transforms(resolution)
+        for window, _ in iter_video_windows(video_path, window_size, transforms, frame_indices=frame_indices,
+                                            num_threads=num_threads):
+            yield window
+
     def tensor_to_video(self, tensor):
         """
         Convierte un tensor de video a un array numpy para guardarlo.
@@ -1177,51 +1333,155 @@ class MAGVIT2VideoTokenizer:
         media.write_video(output_path, video_array, fps=fps)
         print(f"Video guardado en: {output_path}")
 
-    def save_frames(self, video_path, output_dir, interval=0.5):
+    def save_frames(self, video_path, output_dir, interval=0.5, num_workers=4):
         """
         Extrae frames de un video y los guarda como imágenes.
+
+        Sólo se decodifican los frames que se guardan (decord salta directamente a ellos)
+        y las imágenes se escriben desde un pool de hilos.
     
         Args:
             video_path: Ruta al video
             output_dir: Directorio donde guardar los frames
             interval: Intervalo de tiempo (en segundos) entre frames a guardar
+            num_workers: Hilos que escriben las imágenes
         """
-        import cv2
-        import imageio
-    
-        os.makedirs(output_dir, exist_ok=True)
-    
-        cap = cv2.VideoCapture(video_path)
-        fps = cap.get(cv2.CAP_PROP_FPS)
-        frame_interval = int(fps * interval)
-    
-        frame_count = 0
-        saved_count = 0
+        from OpenImageTokenizer.Open_MAGVIT2.data.video_reader import save_video_frames
     
-        while cap.isOpened():
-            ret, frame = cap.read()
-            if not ret:
-                break
-            
-            if frame_count % frame_interval == 0:
-                frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                frame_path = os.path.join(output_dir, f"frame_{saved_count * interval:.1f}.png")
-                imageio.imsave(frame_path, frame_rgb)
-                saved_count += 1
-            
-            frame_count += 1
-        
-        cap.release()
+        saved_count = save_video_frames(video_path, output_dir, interval=interval, num_workers=num_workers)
         print(f"Se guardaron {saved_count} frames en {output_dir}")
 
-    def encode(self, video, max_frames=64, chunk_size=16):
+    def _iter_video_chunks(self, video, chunk_size):
+        """
+        Divide un video en chunks temporales consecutivos de chunk_size frames.
+
+        Args:
+            video: Ruta al video, tensor [C, T, H, W] / [B, C, T, H, W] o iterable de tensores con esas formas
+            chunk_size: Frames por chunk (el último puede ser más corto)
+
+        Yields:
+            torch.Tensor: Chunk [B, C, t, H, W] en el dispositivo
+        """
+        if isinstance(video, str):
+            video = self.iter_video_windows(video, window_size=chunk_size)
+
+        if isinstance(video, torch.Tensor):
+            if video.dim() == 4:  # [C, T, H, W]
+                video = video.unsqueeze(0)
+            elif video.dim() != 5:
+                raise ValueError(f"Tensor de forma incorrecta: {video.shape}")
+            chunks = (video[:, :, start:start + chunk_size] for start in range(0, video.shape[2], chunk_size))
+        else:
+            chunks = video
+
+        # Reagrupar los chunks de entrada en chunks de exactamente chunk_size frames
+        pending = []
+        pending_frames = 0
+        for chunk in chunks:
+            if chunk.dim() == 4:
+                chunk = chunk.unsqueeze(0)
+            pending.append(chunk)
+            pending_frames += chunk.shape[2]
+            while pending_frames >= chunk_size:
+                buffer = pending[0] if len(pending) == 1 else torch.cat(pending, dim=2)
+                yield buffer[:, :, :chunk_size].to(self.device)
+                pending = [buffer[:, :, chunk_size:]]
+                pending_frames -= chunk_size
+        if pending_frames > 0:
+            buffer = pending[0] if len(pending) == 1 else torch.cat(pending, dim=2)
+            yield buffer.to(self.device)
+
+    def _replayable_chunks(self, video, chunk_size):
+        """
+        Función que devuelve un iterador nuevo sobre los chunks de video en cada llamada.
+
+        El streaming exacto recorre el video una vez por GroupNorm (ver iter_streaming),
+        así que la entrada debe poder releerse: una ruta, un tensor, una lista/tupla de
+        chunks o una función sin argumentos que devuelva un iterable nuevo.
+        """
+        if callable(video):
+            return lambda: self._iter_video_chunks(video(), chunk_size)
+        if not isinstance(video, (str, torch.Tensor)) and iter(video) is video:
+            raise ValueError("El streaming necesita recorrer el video varias veces: pasa una ruta, un tensor, "
+                             "una lista de chunks o una función que devuelva un iterable nuevo")
+        return lambda: self._iter_video_chunks(video, chunk_size)
+
+    def encode_stream(self, video, chunk_size=16):
+        """
+        Codifica un video de longitud arbitraria chunk a chunk con memoria constante.
+
+        Las convoluciones causales del encoder conservan sus últimos frames entre chunks
+        (y el desfase de las convoluciones con stride temporal), de modo que no se pierde
+        contexto temporal en las fronteras ni se submuestrea el video. Las GroupNorm
+        normalizan con las estadísticas de todo el video, acumuladas en pasadas previas
+        (una por GroupNorm), así que el resultado coincide con una codificación del clip
+        completo sea cual sea chunk_size. Si el video cabe en un chunk se codifica de una vez.
+
+        Coste: el video se recorre una vez por GroupNorm del encoder más una pasada final
+        (42 pasadas con la configuración publicada, que tiene 41 GroupNorm). Con una ruta,
+        cada pasada vuelve a decodificar el archivo desde el disco; si el video cabe en
+        memoria, es más rápido decodificarlo una sola vez y pasar la lista de chunks, p. ej.
+        list(self.iter_video_windows(ruta, window_size=chunk_size)).
+
+        Args:
+            video: Ruta al video, tensor de video, lista de chunks [C, t, H, W] / [B, C, t, H, W]
+                   o función que devuelva un iterable nuevo de chunks (el video se relee en cada pasada)
+            chunk_size: Frames por chunk (se redondea a un múltiplo de la compresión temporal)
+
+        Yields:
+            dict: {
+                'quant': Representación cuantizada del chunk,
+                'indices': Índices de tokens del chunk [B, t, h, w],
+                'frames': (primer frame, último frame + 1) del chunk en el video
+            }
+        """
+        from OpenImageTokenizer.Open_MAGVIT2.modules.diffusionmodules.improved_video_model import iter_streaming
+
+        # Cargar el modelo si aún no está cargado
+        if self.model is None:
+            self.load_model()
+
+        # Cada chunk completo debe producir un número entero de frames latentes
+        step = self.model.encoder.temporal_downsample
+        chunk_size = max(step, chunk_size // step * step)
+
+        # Usar EMA si está disponible (una sola vez para todo el video)
+        use_ema = hasattr(self.model, 'use_ema') and self.model.use_ema
+        ema_scope = self.model.ema_scope() if use_ema else nullcontext()
+
+        make_chunks = self._replayable_chunks(video, chunk_size)
+
+        @torch.no_grad()
+        def encode_chunk(chunk):
+            quant, diff, indices, _ = self.model.encode(chunk)
+            return quant, indices, chunk.shape[2]
+
+        start = 0
+        with ema_scope, self.model.streaming_scope():
+            for quant, indices, num_frames in iter_streaming(self.model.encoder, encode_chunk, make_chunks):
+                b, _, t, h, w = quant.shape
+                end = start + num_frames
+                yield {
+                    'quant': quant.cpu(),
+                    'indices': indices.view(b, t, h, w).cpu(),
+                    'frames': (start, end)
+                }
+                start = end
+
+    def encode(self, video, max_frames=64, chunk_size=16, streaming=False):
         """
         Codifica un video en tokens.
 
         Args:
-            video: Ruta al video o tensor de video
-            max_frames: Número máximo de frames a procesar a la vez
+            video: Ruta al video o tensor de video; con streaming=True también una lista de chunks
+                   ya decodificados o una función que devuelva un iterable nuevo de chunks
+            max_frames: Número máximo de frames a procesar a la vez (ignorado si streaming=True)
             chunk_size: Tamaño de los chunks temporales para procesar
+            streaming: Si es True, codifica todo el video con encode_stream y devuelve un único tensor.
+                       encode_stream recorre el video una vez por GroupNorm (42 pasadas con la
+                       configuración publicada), así que una ruta se decodifica desde el disco en
+                       cada pasada; pasar los chunks ya decodificados evita esas lecturas a cambio
+                       de tener el video en memoria
     
         Returns:
             dict: {
@@ -1236,6 +1496,26 @@ class MAGVIT2VideoTokenizer:
         else:
             raise ValueError("No se pudo cargar el modelo")
 
+        if streaming:
+            quant_list = []
+            indices_list = []
+            for encoded in self.encode_stream(video, chunk_size=chunk_size):
+                quant_list.append(encoded['quant'])
+                indices_list.append(encoded['indices'])
+            if not quant_list:
+                raise ValueError("No se pudo codificar ninguna ventana temporal del video")
+
+            quant = torch.cat(quant_list, dim=2)
+            indices = torch.cat(indices_list, dim=1)  # [B, T, H, W]
+            token_shape = tuple(indices.shape[1:])
+            print(f"Forma inferida de los tokens: {token_shape}")
+
+            return {
+                'quant': quant,
+                'indices': indices,
+                'token_shape': token_shape
+            }
+
         # Preparar el video según el tipo de entrada
         if isinstance(video, str):
             video_tensor, total_frames, original_shape = self.video_to_tensor(video, max_frames=max_frames)
@@ -1253,73 +1533,50 @@ class MAGVIT2VideoTokenizer:
         b, c, t, h, w = video_tensor.shape
         print(f"Procesando video tensor de forma: {video_tensor.shape}")
     
-        # Definimos el tamaño de la ventana temporal (según el modelo)
-        temporal_window = min(chunk_size, t)  # Usar chunk_size o menos si el video es más corto
-    
-        # Lista para almacenar resultados
-        quant_list = []
-        indices_list = []
+        # Planificar las ventanas temporales y la forma de la salida
+        windows = self._plan_windows(t, chunk_size)
+        if not windows:
+            raise ValueError("No se pudo codificar ninguna ventana temporal del video")
+        latent_windows = self._latent_windows(windows)
+        latent_t = latent_windows[-1][1]
+
+        # Usar EMA si está disponible (una sola vez para todas las ventanas)
+        use_ema = hasattr(self.model, 'use_ema') and self.model.use_ema
+        ema_scope = self.model.ema_scope() if use_ema else nullcontext()
+
+        copier = _HostCopier(self.device)
+        quant_out = None
+        indices_out = None
     
         try:
-            # Procesar en trozos pequeños para evitar problemas de memoria
             # Codificar el video por ventanas temporales
-            with torch.no_grad():
-                for idx in range(0, (t - 1) // temporal_window + 1):
-                    # Recortar ventana temporal
-                    start = idx * temporal_window
-                    end = min((idx + 1) * temporal_window, t)
-                
-                    print(f"Procesando segmento {idx+1}/{(t - 1) // temporal_window + 1} (frames {start}-{end-1})")
-                
-                    input_window = video_tensor[:, :, start:end, ...]
-                
-                    # Verificar si la ventana tiene frames suficientes
-                    if input_window.shape[2] < 2:  # Necesitamos al menos 2 frames
-                        print(f"Saltando segmento {idx+1} con solo {input_window.shape[2]} frames (necesitamos al menos 2)")
-                        continue
-                    
-                    # Usar EMA si está disponible
-                    if hasattr(self.model, 'use_ema') and self.model.use_ema:
-                        with self.model.ema_scope():
-                            quant, diff, indices, _ = self.model.encode(input_window)
-                    else:
-                        quant, diff, indices, _ = self.model.encode(input_window)
-                
-                    # Guardar resultados
-                    quant_list.append(quant.cpu())  # Mover a CPU para liberar memoria
-                    indices_list.append(indices.cpu())  # Mover a CPU para liberar memoria
-                
-                    # Forzar limpieza de memoria
-                    torch.cuda.empty_cache()
-        
-            # Combinar resultados si hay múltiples ventanas
-            if len(quant_list) > 1:
-                # No intentar concatenar, mantener como lista para evitar problemas de memoria
-                quant = quant_list
-                indices = indices_list
-            elif len(quant_list) == 1:
-                quant = quant_list[0]
-                indices = indices_list[0]
-            else:
-                raise ValueError("No se pudo codificar ninguna ventana temporal del video")
-        
-            # Obtener forma de los tokens
-            token_shape = None
-            if isinstance(indices, torch.Tensor):
-                if indices.dim() == 5:  # [B, T, C, H, W]
-                    token_shape = (indices.shape[1], indices.shape[3], indices.shape[4])  # [T, H, W]
-                elif indices.dim() == 4:  # [B, T, H, W]
-                    token_shape = (indices.shape[1], indices.shape[2], indices.shape[3])  # [T, H, W]
-                elif indices.dim() == 3:  # [T, H, W]
-                    token_shape = indices.shape
-        
-            # Imprimir información sobre la forma de los tokens
+            with ema_scope, torch.no_grad():
+                for idx, ((start, end), (latent_start, latent_end)) in enumerate(zip(windows, latent_windows)):
+                    print(f"Procesando segmento {idx+1}/{len(windows)} (frames {start}-{end-1})")
+
+                    quant, diff, indices, _ = self.model.encode(video_tensor[:, :, start:end, ...])
+                    indices = indices.view(b, latent_end - latent_start, quant.shape[3], quant.shape[4])
+
+                    # Reservar la salida completa con la primera ventana
+                    if quant_out is None:
+                        quant_out = torch.empty((b, quant.shape[1], latent_t) + tuple(quant.shape[3:]), dtype=quant.dtype)
+                        indices_out = torch.empty((b, latent_t) + tuple(indices.shape[2:]), dtype=indices.dtype)
+
+                    # Copiar al buffer de CPU mientras se calcula la siguiente ventana
+                    copier.copy([
+                        (quant_out[:, :, latent_start:latent_end], quant),
+                        (indices_out[:, latent_start:latent_end], indices)
+                    ])
+                copier.synchronize()
+        
+            token_shape = tuple(indices_out.shape[1:])  # [T, H, W]
             print(f"Forma inferida de los tokens: {token_shape}")
         
             return {
-                'quant': quant,
-                'indices': indices,
-                'token_shape': token_shape
+                'quant': quant_out,
+                'indices': indices_out,
+                'token_shape': token_shape,
+                'windows': latent_windows
             }
     
         except Exception as e:
@@ -1328,60 +1585,316 @@ class MAGVIT2VideoTokenizer:
             torch.cuda.empty_cache()
             raise
 
-    def decode(self, quant, chunk_size=16):
+    def _plan_windows(self, num_frames, chunk_size):
+        """
+        Divide num_frames en ventanas temporales independientes de chunk_size frames.
+
+        Returns:
+            list: Lista de (inicio, fin) de cada ventana con al menos 2 frames
+        """
+        temporal_window = min(chunk_size, num_frames)  # Usar chunk_size o menos si el video es más corto
+        windows = []
+        for idx, start in enumerate(range(0, num_frames, temporal_window)):
+            end = min(start + temporal_window, num_frames)
+            if end - start < 2:  # Necesitamos al menos 2 frames
+                print(f"Saltando segmento {idx+1} con solo {end - start} frames (necesitamos al menos 2)")
+                continue
+            windows.append((start, end))
+        return windows
+
+    def _latent_frames(self, num_frames):
+        """Frames latentes que produce el encoder causal a partir de num_frames frames"""
+        return (num_frames - 1) // self.model.encoder.temporal_downsample + 1
+
+    def _decoded_frames(self, latent_frames):
+        """Frames que produce el decoder causal a partir de latent_frames frames latentes"""
+        return (latent_frames - 1) * self.model.encoder.temporal_downsample + 1
+
+    def _latent_windows(self, windows):
+        """Posición (inicio, fin) de cada ventana en el eje temporal latente"""
+        latent_windows = []
+        latent_t = 0
+        for start, end in windows:
+            latent_frames = self._latent_frames(end - start)
+            latent_windows.append((latent_t, latent_t + latent_frames))
+            latent_t += latent_frames
+        return latent_windows
+
+    def _encode_bytes_per_frame(self, height, width):
+        """
+        Estimación de la memoria de activaciones del encoder por frame de entrada.
+
+        El pico está en el primer nivel (resolución completa, ch canales), donde un ResBlock
+        mantiene vivos unos seis tensores de ese tamaño (entrada, residual, normalización,
+        relleno causal y salidas de las convoluciones).
+        """
+        ch = self.model.encoder.conv_in.conv_1.out_channels
+        element_size = next(self.model.encoder.parameters()).element_size()
+        return 6 * ch * height * width * element_size
+
+    def plan_encode_batches(self, window_shapes, memory_budget=None, max_batch=16):
+        """
+        Agrupa ventanas temporales en lotes que caben en un presupuesto de memoria.
+
+        Sólo se apilan ventanas con la misma forma: las GroupNorm del encoder calculan sus
+        estadísticas sobre todo el eje temporal, así que rellenar una ventana corta con
+        frames vacíos cambiaría sus tokens.
+
+        Args:
+            window_shapes: Lista de formas (t, H, W) de cada ventana
+            memory_budget: Bytes disponibles para activaciones (None para limitar sólo por max_batch)
+            max_batch: Número máximo de ventanas por lote
+
+        Returns:
+            list: Lista de lotes, cada uno una lista de posiciones en window_shapes
+        """
+        buckets = {}
+        for i, shape in enumerate(window_shapes):
+            buckets.setdefault(tuple(shape), []).append(i)
+
+        batches = []
+        for (t, h, w), window_ids in buckets.items():
+            batch_size = max_batch
+            if memory_budget is not None:
+                window_bytes = t * self._encode_bytes_per_frame(h, w)
+                batch_size = max(1, min(max_batch, int(memory_budget // window_bytes)))
+            for start in range(0, len(window_ids), batch_size):
+                batches.append(window_ids[start:start + batch_size])
+        return batches
+
+    def encode_batched(self, videos, max_frames=64, chunk_size=16, max_batch=16, memory_budget=None):
+        """
+        Codifica varios videos apilando sus ventanas temporales en la dimensión de batch.
+
+        Las ventanas son independientes (igual que en encode), así que las de todos los
+        videos se reparten en lotes con plan_encode_batches y cada lote se codifica con una
+        sola pasada del modelo. Los resultados son los mismos que llamando a encode sobre
+        cada video.
+
+        Args:
+            videos: Lista de rutas o tensores de video [C, T, H, W] (p.ej. un grupo de clips de UCF-101)
+            max_frames: Número máximo de frames por video
+            chunk_size: Tamaño de las ventanas temporales
+            max_batch: Número máximo de ventanas por lote
+            memory_budget: Bytes disponibles para activaciones (None: memoria libre de la GPU, o sin límite en CPU)
+
+        Returns:
+            list: Un dict por video con el mismo formato que encode (None si no tiene ninguna ventana válida)
+        """
+        # Cargar el modelo si aún no está cargado
+        if self.model is None:
+            self.load_model()
+
+        # Cortar cada video en ventanas (en CPU hasta que se apilan)
+        windows = []  # (video, ventana en frames, ventana latente)
+        window_shapes = []
+        video_latent_windows = []
+        for v, video in enumerate(videos):
+            if isinstance(video, str):
+                video_tensor, _, _ = self.video_to_tensor(video, max_frames=max_frames)
+                video_tensor = video_tensor[0].cpu()
+            elif isinstance(video, torch.Tensor) and video.dim() == 4:  # [C, T, H, W]
+                video_tensor = video
+            else:
+                raise ValueError("Cada video debe ser una ruta o un tensor [C, T, H, W]")
+
+            video_windows = self._plan_windows(video_tensor.shape[1], chunk_size)
+            latent_windows = self._latent_windows(video_windows)
+            for (start, end), latent_window in zip(video_windows, latent_windows):
+                windows.append((v, video_tensor[:, start:end], latent_window))
+                window_shapes.append((end - start,) + tuple(video_tensor.shape[2:]))
+            video_latent_windows.append(latent_windows)
+
+        if memory_budget is None and str(self.device).startswith("cuda"):
+            memory_budget = torch.cuda.mem_get_info(torch.device(self.device))[0] * 0.9
+
+        batches = self.plan_encode_batches(window_shapes, memory_budget=memory_budget, max_batch=max_batch)
+        print(f"Codificando {len(windows)} ventanas de {len(videos)} videos en {len(batches)} lotes")
+
+        # Usar EMA si está disponible (una sola vez para todos los lotes)
+        use_ema = hasattr(self.model, 'use_ema') and self.model.use_ema
+        ema_scope = self.model.ema_scope() if use_ema else nullcontext()
+
+        copier = _HostCopier(self.device)
+        results = [None] * len(videos)
+        with ema_scope, torch.no_grad():
+            for batch in batches:
+                input_batch = torch.stack([windows[i][1] for i in batch]).to(self.device)
+                quant, diff, indices, _ = self.model.encode(input_batch)
+                indices = indices.view(len(batch), quant.shape[2], quant.shape[3], quant.shape[4])
+
+                pairs = []
+                for j, i in enumerate(batch):
+                    v, _, (latent_start, latent_end) = windows[i]
+                    # Reservar la salida completa del video con su primera ventana
+                    if results[v] is None:
+                        latent_t = video_latent_windows[v][-1][1]
+                        results[v] = {
+                            'quant': torch.empty((1, quant.shape[1], latent_t) + tuple(quant.shape[3:]), dtype=quant.dtype),
+                            'indices': torch.empty((1, latent_t) + tuple(indices.shape[2:]), dtype=indices.dtype),
+                            'token_shape': (latent_t,) + tuple(indices.shape[2:]),
+                            'windows': video_latent_windows[v]
+                        }
+                    pairs.append((results[v]['quant'][:, :, latent_start:latent_end], quant[j:j + 1]))
+                    pairs.append((results[v]['indices'][:, latent_start:latent_end], indices[j:j + 1]))
+                copier.copy(pairs)
+            copier.synchronize()
+
+        return results
+
+    def decode_stream(self, quant, chunk_size=16, style=None, to_cpu=True):
+        """
+        Decodifica una representación cuantizada chunk a chunk con memoria acotada.
+
+        Las convoluciones causales del decoder (incluido el Upsampler temporal) conservan
+        su contexto entre chunks y los frames se entregan a medida que se reconstruyen.
+        Las AdaptiveGroupNorm usan el estilo de todo el latente (quant completo o sus
+        estadísticas acumuladas chunk a chunk) y las GroupNorm las estadísticas de todo el
+        video, acumuladas en pasadas previas (una por GroupNorm), así que el resultado
+        coincide con una decodificación del clip completo sea cual sea chunk_size.
+
+        Args:
+            quant: Tensor cuantizado [B, C, T, h, w], lista de chunks (p.ej. los 'quant' de encode_stream)
+                   o función que devuelva un iterable nuevo de chunks (se relee en cada pasada)
+            chunk_size: Frames de video por chunk (se redondea a un múltiplo de la compresión temporal)
+            style: Latente completo para las estadísticas de las AdaptiveGroupNorm (None para usar todo quant)
+            to_cpu: Si es False, los chunks se entregan en el dispositivo (p.ej. para VideoStreamWriter)
+
+        Yields:
+            dict: {
+                'reconstructed': Frames reconstruidos del chunk [B, C, t, H, W],
+                'frames': (primer frame, último frame + 1) del chunk en el video reconstruido
+            }
+        """
+        from OpenImageTokenizer.Open_MAGVIT2.modules.diffusionmodules.improved_video_model import AdaptiveGroupNorm, iter_streaming
+
+        # Cargar el modelo si aún no está cargado
+        if self.model is None:
+            self.load_model()
+
+        step = self.model.encoder.temporal_downsample
+        latent_chunk = max(1, chunk_size // step)
+
+        if isinstance(quant, torch.Tensor) and style is None:
+            style = quant
+        if style is not None:
+            style = style.to(self.device)
+        make_chunks = self._replayable_chunks(quant, latent_chunk)
+
+        @torch.no_grad()
+        def decode_chunk(q):
+            return self.model.decode(q, modulation=modulation)
+
+        # Usar EMA si está disponible (una sola vez para todo el video)
+        use_ema = hasattr(self.model, 'use_ema') and self.model.use_ema
+        ema_scope = self.model.ema_scope() if use_ema else nullcontext()
+
+        start = 0
+        with ema_scope, self.model.streaming_scope():
+            # Escala y sesgo de las AdaptiveGroupNorm calculados una sola vez para todos los chunks
+            with torch.no_grad():
+                if style is not None:
+                    modulation = self.model.decoder.style_modulation(style)
+                else:
+                    statistics = AdaptiveGroupNorm.stream_style_statistics(make_chunks(), self.model.decoder.adaptive[0].eps)
+                    modulation = self.model.decoder.style_modulation(statistics=statistics)
+            for reconstructed in iter_streaming(self.model.decoder, decode_chunk, make_chunks):
+                end = start + reconstructed.shape[2]
+                yield {
+                    'reconstructed': reconstructed.cpu() if to_cpu else reconstructed,
+                    'frames': (start, end)
+                }
+                start = end
+
+    def iter_decode(self, quant, windows=None):
+        """
+        Decodifica ventana a ventana la representación cuantizada devuelta por encode.
+
+        Args:
+            quant: Representación cuantizada [B, C, T, h, w] (o lista de tensores por ventana)
+            windows: Lista de (inicio, fin) de cada ventana en el eje temporal latente (None para una sola ventana)
+
+        Yields:
+            torch.Tensor: Reconstrucción de cada ventana [B, C, t, H, W] en el dispositivo
+        """
+        # Cargar el modelo si aún no está cargado
+        if self.model is None:
+            self.load_model()
+
+        if isinstance(quant, list):
+            quant_list = quant
+        elif windows is not None:
+            quant_list = [quant[:, :, start:end] for start, end in windows]
+        else:
+            quant_list = [quant]
+
+        # Usar EMA si está disponible (una sola vez para todas las ventanas)
+        use_ema = hasattr(self.model, 'use_ema') and self.model.use_ema
+        ema_scope = self.model.ema_scope() if use_ema else nullcontext()
+
+        with ema_scope:
+            for i, q in enumerate(quant_list):
+                if len(quant_list) > 1:
+                    print(f"Decodificando segmento {i+1}/{len(quant_list)}...")
+
+                with torch.no_grad():
+                    # Mover al dispositivo correcto
+                    reconstructed = self.model.decode(q.to(self.device))
+
+                yield reconstructed
+
+    def decode(self, quant, chunk_size=16, streaming=False, windows=None):
         """
         Decodifica una representación cuantizada a un video.
+
+        La salida se reserva de una vez a partir del número de frames latentes de cada
+        ventana y la reconstrucción de cada ventana se copia a su posición mientras se
+        decodifica la siguiente.
     
         Args:
             quant: Representación cuantizada devuelta por encode
             chunk_size: Tamaño de los chunks temporales para procesar
+            streaming: Si es True, decodifica con decode_stream y devuelve un único tensor
+            windows: Ventanas latentes devueltas por encode ('windows'); None decodifica quant como un solo clip
         
         Returns:
-            tensor: Tensor de video reconstruido
+            tensor: Tensor de video reconstruido [B, C, T, H, W] en CPU
         """
         # Cargar el modelo si aún no está cargado
         if self.model is None:
             self.load_model()
-    
-        # Si tenemos una lista de quant (múltiples ventanas temporales)
+
+        if streaming:
+            reconstructed = [decoded['reconstructed'] for decoded in self.decode_stream(quant, chunk_size=chunk_size)]
+            return torch.cat(reconstructed, dim=2)
+
+        # Lista de quant por ventana (formato anterior de encode)
         if isinstance(quant, list):
-            reconstructed_list = []
-        
-            with torch.no_grad():
-                for i, q in enumerate(quant):
-                    print(f"Decodificando segmento {i+1}/{len(quant)}...")
-                
-                    # Mover al dispositivo correcto
-                    q = q.to(self.device)
-                
-                    # Usar EMA si está disponible
-                    if hasattr(self.model, 'use_ema') and self.model.use_ema:
-                        with self.model.ema_scope():
-                            reconstructed = self.model.decode(q)
-                    else:
-                        reconstructed = self.model.decode(q)
-                
-                    # Mover a CPU para liberar memoria
-                    reconstructed_list.append(reconstructed.cpu())
-                    torch.cuda.empty_cache()
-            
-            # No intentar concatenar para evitar problemas de memoria
-            return reconstructed_list
-            
-        else:
-            # Decodificar directamente
-            with torch.no_grad():
-                # Asegurar que está en el dispositivo correcto
-                quant = quant.to(self.device)
-            
-                # Usar EMA si está disponible
-                if hasattr(self.model, 'use_ema') and self.model.use_ema:
-                    with self.model.ema_scope():
-                        reconstructed = self.model.decode(quant)
-                else:
-                    reconstructed = self.model.decode(quant)
-            
-                return reconstructed
+            lengths = [q.shape[2] for q in quant]
+            windows = [(sum(lengths[:i]), sum(lengths[:i + 1])) for i in range(len(lengths))]
+            quant = torch.cat(quant, dim=2)
+        if windows is None:
+            windows = [(0, quant.shape[2])]
+
+        # Planificar la posición de cada ventana en la salida
+        frame_windows = []
+        total_frames = 0
+        for start, end in windows:
+            num_frames = self._decoded_frames(end - start)
+            frame_windows.append((total_frames, total_frames + num_frames))
+            total_frames += num_frames
+
+        copier = _HostCopier(self.device)
+        reconstructed_out = None
+        for (start, end), reconstructed in zip(frame_windows, self.iter_decode(quant, windows)):
+            # Reservar la salida completa con la primera ventana
+            if reconstructed_out is None:
+                b, c, _, h, w = reconstructed.shape
+                reconstructed_out = torch.empty((b, c, total_frames, h, w), dtype=reconstructed.dtype)
+            copier.copy([(reconstructed_out[:, :, start:end], reconstructed)])
+        copier.synchronize()
+
+        return reconstructed_out
 
     def encode_decode(self, video, max_frames=64, chunk_size=16):
         """
@@ -1416,7 +1929,7 @@ class MAGVIT2VideoTokenizer:
     
         # Decodificar
         print("Decodificando video...")
-        reconstructed = self.decode(encoded['quant'], chunk_size=chunk_size)
+        reconstructed = self.decode(encoded['quant'], chunk_size=chunk_size, windows=encoded['windows'])
     
         return {
             'original': original_tensor,
@@ -1430,7 +1943,7 @@ class MAGVIT2VideoTokenizer:
         Visualiza los tokens de video como imágenes para facilitar la interpretación.
 
         Args:
-            indices: Índices de tokens (de encode)
+            indices: Índices de tokens (de encode) [B, T, H, W], o lista de tensores por segmento
             save_path: Directorio para guardar la visualización
             token_size: Tamaño de cada token en la visualización
             colormap: Mapa de colores a utilizar
@@ -1440,13 +1953,21 @@ class MAGVIT2VideoTokenizer:
         """
         import matplotlib.pyplot as plt
         from PIL import Image
+
+        # Un único tensor se visualiza como un solo segmento directamente en save_path
+        single = isinstance(indices, torch.Tensor)
+        if single:
+            indices = [indices]
     
         # Si indices es una lista, procesamos cada elemento por separado
         if isinstance(indices, list):
             visualization_list = []
             for i, idx_tensor in enumerate(indices):
                 print(f"Visualizando tokens del segmento {i+1}/{len(indices)}...")
-                frame_path = None if save_path is None else os.path.join(save_path, f"segment_{i+1}")
+                if save_path is None:
+                    frame_path = None
+                else:
+                    frame_path = save_path if single else os.path.join(save_path, f"segment_{i+1}")
             
                 # Crear directorio si no existe
                 if frame_path:
@@ -1647,7 +2168,7 @@ class MAGVIT2VideoTokenizer:
     
         return output_path
 
-    def process_video(self, video_path, output_dir=None, save_frames_interval=None, max_frames=64, chunk_size=16, combine_segments=True):
+    def process_video(self, video_path, output_dir=None, save_frames_interval=None, max_frames=64, chunk_size=16, combine_segments=True, streaming=False, chunks=None):
         """
         Procesa un video: codifica, decodifica y visualiza tokens.
     
@@ -1655,108 +2176,103 @@ class MAGVIT2VideoTokenizer:
             video_path: Ruta al video
             output_dir: Directorio para guardar resultados
             save_frames_interval: Intervalo para guardar frames (en segundos, None para no guardar)
-            max_frames: Número máximo de frames a procesar
+            max_frames: Número máximo de frames a procesar (ignorado si streaming=True)
             chunk_size: Tamaño de los chunks temporales para procesar
-            combine_segments: Si es True, combina los segmentos reconstruidos en un solo video
+            combine_segments: Se mantiene por compatibilidad; la reconstrucción siempre se escribe en un único video
+            streaming: Si es True, usa encode_stream/decode_stream sobre el video completo
+            chunks: Con streaming=True, chunks ya decodificados de video_path (lista o función que
+                    devuelva un iterable nuevo). Si es None, el video se relee del disco en cada
+                    pasada del streaming exacto (una por GroupNorm del encoder)
         
         Returns:
             dict: Información del procesamiento
         """
-        # Crear directorios de salida si se especificó output_dir
-        if output_dir:
-            os.makedirs(os.path.join(output_dir, "original"), exist_ok=True)
-            os.makedirs(os.path.join(output_dir, "reconstructed"), exist_ok=True)
-            os.makedirs(os.path.join(output_dir, "tokens"), exist_ok=True)
+        from OpenImageTokenizer.Open_MAGVIT2.data.video_writer import VideoStreamWriter
+
+        # Sin output_dir no se escribe nada, se devuelven los tensores
+        if not output_dir:
+            try:
+                print(f"Procesando video: {video_path}")
+                if streaming:
+                    encoded = self.encode(video_path if chunks is None else chunks, chunk_size=chunk_size, streaming=True)
+                    reconstructed = self.decode(encoded['quant'], chunk_size=chunk_size, streaming=True)
+                    results = {'original': None, 'reconstructed': reconstructed, 'indices': encoded['indices'], 'token_shape': encoded['token_shape']}
+                else:
+                    results = self.encode_decode(video_path, max_frames=max_frames, chunk_size=chunk_size)
+                return {
+                    "original": results['original'],
+                    "reconstructed": results['reconstructed'],
+                    "indices": results['indices'],
+                    "token_shape": results['token_shape']
+                }
+            except Exception as e:
+                print(f"Error procesando video {video_path}: {e}")
+                import traceback
+                traceback.print_exc()
+                torch.cuda.empty_cache()  # Liberar memoria en caso de error
+                return None
+
+        # Crear directorios de salida
+        os.makedirs(os.path.join(output_dir, "original"), exist_ok=True)
+        os.makedirs(os.path.join(output_dir, "reconstructed"), exist_ok=True)
+        os.makedirs(os.path.join(output_dir, "tokens"), exist_ok=True)
     
         # Obtener nombre base del video
         video_name = os.path.basename(video_path)
         base_name = os.path.splitext(video_name)[0]
+        orig_path = os.path.join(output_dir, "original", f"{base_name}.mp4")
+        rec_path = os.path.join(output_dir, "reconstructed", f"{base_name}.mp4")
     
         try:
-            # Codificar y decodificar el video
             print(f"Procesando video: {video_path}")
-            results = self.encode_decode(video_path, max_frames=max_frames, chunk_size=chunk_size)
-        
-            # Guardar resultados si se especificó output_dir
-            if output_dir:
-                # Original - guardamos solo los primeros frames para evitar problemas de memoria
-                original_video = self.tensor_to_video(results['original'][0])
-                orig_path = os.path.join(output_dir, "original", f"{base_name}.mp4")
-                self.save_video(original_video, orig_path)
-                print(f"Video original guardado en: {orig_path}")
-            
-                # Reconstruido - puede ser una lista de tensores
-                segment_paths = []
-            
-                if isinstance(results['reconstructed'], list):
-                    # Guardar cada segmento como un archivo separado
-                    for i, segment in enumerate(results['reconstructed']):
-                        segment_video = self.tensor_to_video(segment[0])
-                        segment_path = os.path.join(output_dir, "reconstructed", f"{base_name}_segment_{i+1}.mp4")
-                        self.save_video(segment_video, segment_path)
-                        print(f"Segmento reconstruido {i+1} guardado en: {segment_path}")
-                        segment_paths.append(segment_path)
-                
-                    # La ruta principal apunta al primer segmento
-                    rec_path = os.path.join(output_dir, "reconstructed", f"{base_name}_segment_1.mp4")
-                
-                    # Combinar segmentos si se solicita
-                    if combine_segments and len(segment_paths) > 1:
-                        combined_path = os.path.join(output_dir, "reconstructed", f"{base_name}_combined.mp4")
-                        combined_path = self.combine_video_segments(segment_paths, combined_path)
-                        if combined_path:
-                            rec_path = combined_path  # Actualizar la ruta principal al video combinado
-                            print(f"Video reconstruido completo: {rec_path}")
+            if streaming:
+                # Original: se escribe ventana a ventana a medida que se lee
+                if chunks is None:
+                    windows = self.iter_video_windows(video_path, window_size=chunk_size)
                 else:
-                    # Guardar como un solo archivo
-                    reconstructed_video = self.tensor_to_video(results['reconstructed'][0])
-                    rec_path = os.path.join(output_dir, "reconstructed", f"{base_name}.mp4")
-                    self.save_video(reconstructed_video, rec_path)
-                    print(f"Video reconstruido guardado en: {rec_path}")
-            
-                # Guardar frames si se especificó
-                if save_frames_interval is not None:
-                    orig_frames_dir = os.path.join(output_dir, "original", f"{base_name}_frames")
-                    self.save_frames(orig_path, orig_frames_dir, interval=save_frames_interval)
-                
-                    if isinstance(results['reconstructed'], list) and not combine_segments:
-                        # Guardar frames de cada segmento
-                        for i in range(len(results['reconstructed'])):
-                            segment_path = os.path.join(output_dir, "reconstructed", f"{base_name}_segment_{i+1}.mp4")
-                            segment_frames_dir = os.path.join(output_dir, "reconstructed", f"{base_name}_segment_{i+1}_frames")
-                            self.save_frames(segment_path, segment_frames_dir, interval=save_frames_interval)
-                    else:
-                        # Guardar frames del video combinado o único
-                        rec_frames_dir = os.path.join(output_dir, "reconstructed", f"{base_name}_frames")
-                        self.save_frames(rec_path, rec_frames_dir, interval=save_frames_interval)
-            
-                # Tokens - puede ser una lista de tensores
-                if isinstance(results['indices'], list):
-                    for i, indices_segment in enumerate(results['indices']):
-                        token_dir = os.path.join(output_dir, "tokens", f"{base_name}_tokens_segment_{i+1}")
-                        self.visualize_tokens_video(indices_segment, token_dir)
-                
-                    # La ruta principal apunta al directorio general de tokens
-                    token_dir = os.path.join(output_dir, "tokens", f"{base_name}_tokens")
-                else:
-                    token_dir = os.path.join(output_dir, "tokens", f"{base_name}_tokens")
-                    self.visualize_tokens_video(results['indices'], token_dir)
-            
-                return {
-                    "original": orig_path,
-                    "reconstructed": rec_path,
-                    "tokens": token_dir,
-                    "indices": results['indices'],
-                    "token_shape": results['token_shape']
-                }
+                    windows = chunks() if callable(chunks) else chunks
+                with VideoStreamWriter(orig_path) as writer:
+                    for window in windows:
+                        writer.write(window)
+                # El streaming exacto relee el video (o los chunks) en cada pasada
+                print("Codificando video...")
+                encoded = self.encode(video_path if chunks is None else chunks, chunk_size=chunk_size, streaming=True)
+                decoded_chunks = (decoded['reconstructed'] for decoded in self.decode_stream(encoded['quant'], chunk_size=chunk_size, to_cpu=False))
             else:
-                # Devolver resultados sin guardar archivos
-                return {
-                    "original": results['original'],
-                    "reconstructed": results['reconstructed'],
-                    "indices": results['indices'],
-                    "token_shape": results['token_shape']
-                }
+                original_tensor, _, _ = self.video_to_tensor(video_path, max_frames=max_frames)
+                with VideoStreamWriter(orig_path) as writer:
+                    writer.write(original_tensor)
+                print("Codificando video...")
+                encoded = self.encode(original_tensor, max_frames=max_frames, chunk_size=chunk_size)
+                del original_tensor
+                decoded_chunks = self.iter_decode(encoded['quant'], encoded['windows'])
+            print(f"Video original guardado en: {orig_path}")
+
+            # Reconstruido: cada chunk decodificado se añade directamente al mismo archivo
+            print("Decodificando video...")
+            with VideoStreamWriter(rec_path) as writer:
+                for reconstructed in decoded_chunks:
+                    writer.write(reconstructed)
+            print(f"Video reconstruido guardado en: {rec_path}")
+        
+            # Guardar frames si se especificó
+            if save_frames_interval is not None:
+                orig_frames_dir = os.path.join(output_dir, "original", f"{base_name}_frames")
+                self.save_frames(orig_path, orig_frames_dir, interval=save_frames_interval)
+                rec_frames_dir = os.path.join(output_dir, "reconstructed", f"{base_name}_frames")
+                self.save_frames(rec_path, rec_frames_dir, interval=save_frames_interval)
+        
+            # Tokens
+            token_dir = os.path.join(output_dir, "tokens", f"{base_name}_tokens")
+            self.visualize_tokens_video(encoded['indices'], token_dir)
+        
+            return {
+                "original": orig_path,
+                "reconstructed": rec_path,
+                "tokens": token_dir,
+                "indices": encoded['indices'],
+                "token_shape": encoded['token_shape']
+            }
                 
         except Exception as e:
             print(f"Error procesando video {video_path}: {e}")
@@ -0,0 +1,81 @@
+import os
+import numpy as np
+import torch
+
+class ShardSet:
+    """A set of .npy sample shards (original-scripts/sample.py) read as one uint8 array [N, H, W, 3]
+    The shards are memory-mapped, only the indexed images are read from disk, so the
+    samples never have to be merged (or fit in memory) to be shuffled or evaluated.
+    Shards that are still being written (*.tmp.npy) are ignored.
+
+    Usage:
+        samples = ShardSet.from_dir(os.path.join(logdir, "shards"))
+        for batch in samples.iter_batches(200):
+            ...
+    """
+    def __init__(self, paths):
+        self.paths = sorted(paths)
+        assert len(self.paths) > 0, "no complete shard found"
+        self.shards = [np.load(path, mmap_mode="r") for path in self.paths]
+        self.offsets = np.cumsum([0] + [len(shard) for shard in self.shards])
+        for path, shard in zip(self.paths, self.shards):
+            assert shard.shape[1:] == self.shards[0].shape[1:] and shard.dtype == self.shards[0].dtype, \
+                f"{path}: {shard.dtype} {shard.shape[1:]} does not match {self.paths[0]}"
+
+    @classmethod
+    def from_dir(cls, shard_dir):
+        return cls([os.path.join(shard_dir, name) for name in os.listdir(shard_dir)
+                    if name.endswith(".npy") and not name.endswith(".tmp.npy")])
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    @property
+    def shape(self):
+        return (len(self),) + self.shards[0].shape[1:]
+
+    @property
+    def dtype(self):
+        return self.shards[0].dtype
+
+    def __getitem__(self, index):
+        """ index: int, slice or integer array, images are gathered shard by shard in disk order """
+        if isinstance(index, (int, np.integer)):
+            shard = np.searchsorted(self.offsets, index % len(self), side="right") - 1
+            return np.asarray(self.shards[shard][index % len(self) - self.offsets[shard]])
+        index = np.arange(len(self))[index] if isinstance(index, slice) else np.asarray(index, dtype=np.int64)
+        shard_ids = np.searchsorted(self.offsets, index, side="right") - 1
+        out = np.empty((len(index),) + self.shape[1:], dtype=self.dtype)
+        for shard in np.unique(shard_ids):
+            rows = np.nonzero(shard_ids == shard)[0]
+            local = index[rows] - self.offsets[shard]
+            order = np.argsort(local, kind="stable")
+            out[rows[order]] = self.shards[shard][local[order]]
+        return out
+
+    def iter_batches(self, batch_size, order=None):
+        """ batches of batch_size images, in storage order or in the given order (e.g. a permutation) """
+        for start in range(0, len(self), batch_size):
+            yield self[slice(start, start + batch_size) if order is None else order[start:start + batch_size]]
+
+
+@torch.no_grad()
+def inception_statistics(images, inception_model, batch_size=200, device="cuda"):
+    """ FID mean and covariance of uint8 images [N, H, W, 3] (a ShardSet or an array)
+    The images are streamed through InceptionV3 (metrics.inception, pool3 features) in batches
+    and only float64 running sums of the activations are kept.
+    return: mu [2048], sigma [2048, 2048], as np.mean / np.cov(rowvar=False) of the activations
+    """
+    count, total, outer = 0, None, None
+    for start in range(0, len(images), batch_size):
+        batch = torch.from_numpy(np.ascontiguousarray(images[start:start + batch_size])).to(device)
+        pred = inception_model(batch.permute(0, 3, 1, 2).float() / 255.)[0]
+        pred = pred.squeeze(3).squeeze(2).double().cpu().numpy()
+        if total is None:
+            total, outer = np.zeros(pred.shape[1]), np.zeros((pred.shape[1], pred.shape[1]))
+        count += len(pred)
+        total += pred.sum(0)
+        outer += pred.T @ pred
+    mu = total / count
+    sigma = (outer - count * np.outer(mu, mu)) / (count - 1)
+    return mu, sigma
@@ -0,0 +1,45 @@
+"""
+Load test of online class-conditional sampling: continuous batching against the one-request-at-a-time loop
+"""
+
+import argparse, os, sys
+import torch
+from omegaconf import OmegaConf
+from sample import load_model
+from OpenImageTokenizer.samples import run_load_test
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ckpt", type=str, nargs="?", help="checkpoint of the transformer (random weights when omitted)")
+    parser.add_argument("--config", type=str, help="config of the class-conditional transformer")
+    parser.add_argument("--num_requests", type=int, default=64, help="requests sent by the load generator")
+    parser.add_argument("--rate", type=float, default=2.0, help="mean arrival rate, requests per second (Poisson)")
+    parser.add_argument("--max_images", type=int, default=16, help="images decoded together by the scheduler")
+    parser.add_argument("-k", "--top_k", type=str, default="0")
+    parser.add_argument("-t", "--temperature", type=str, default="1.0")
+    parser.add_argument("-p", "--top_p", type=str, default="1.0")
+    parser.add_argument("--cfg_scale", type=str, default="1.0")
+    parser.add_argument("--token_factorization", action="store_true", help="whether to use token factorization")
+    parser.add_argument("--modes", type=str, default="sequential,continuous", help="comma-separated serving modes to compare")
+    parser.add_argument("--global_seed", type=int, default=0)
+    return parser
+
+if __name__ == "__main__":
+    sys.path.append(os.getcwd())
+    opt, unknown = get_parser().parse_known_args()
+    torch.manual_seed(opt.global_seed)
+    config = OmegaConf.load(opt.config)
+    model, _ = load_model(config, opt.ckpt, gpu=True, eval_mode=True)
+    transformer = model.transformer
+
+    parse = lambda value, type: [type(v) for v in value.split(",")] if opt.token_factorization else type(value.split(",")[0])
+    sampling = dict(top_k=parse(opt.top_k, int), temperature=parse(opt.temperature, float),
+                    top_p=parse(opt.top_p, float), cfg_scale=parse(opt.cfg_scale, float))
+    steps = transformer.config.block_size
+
+    for mode in opt.modes.split(","):
+        report = run_load_test(transformer, mode=mode, num_requests=opt.num_requests, rate=opt.rate,
+                               max_images=opt.max_images, steps=steps, seed=opt.global_seed, **sampling)
+        print(f"{mode}: p50 {report['p50_latency']:.2f} s, p99 {report['p99_latency']:.2f} s, "
+              f"{report['throughput']:.2f} images/s, {report['tokens_per_sec']:.1f} tokens/s"
+              + (f", {100 * report['utilization']:.1f}% of decoded rows busy" if "utilization" in report else ""))
@@ -0,0 +1,63 @@
+"""
+Speculative sampling benchmark: a small AR model drafting for larger ones of the same family (IBQ-AR-B for
+IBQ-AR-L / XL / XXL, Open-MAGVIT2-AR-B for Open-MAGVIT2-AR-L / XL), acceptance rate and speedup per pair
+"""
+
+import argparse, os, sys
+import torch
+from omegaconf import OmegaConf
+from sample import load_model, DEVICE
+from OpenImageTokenizer.IBQ.modules.transformer import llama
+from OpenImageTokenizer.Open_MAGVIT2.modules.transformer import gpt
+
+BENCHMARK = {
+    "Open-MAGVIT2": gpt.benchmark_speculative,
+    "IBQ": llama.benchmark_speculative
+}
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str, default="IBQ", choices=list(BENCHMARK))
+    parser.add_argument("--draft_config", type=str, help="config of the draft model (e.g. IBQ-AR-B / Open-MAGVIT2-AR-B)")
+    parser.add_argument("--draft_ckpt", type=str, help="checkpoint of the draft model")
+    parser.add_argument("--configs", type=str, nargs="+", help="configs of the target models (e.g. IBQ-AR-L / XL / XXL, Open-MAGVIT2-AR-L / XL)")
+    parser.add_argument("--ckpts", type=str, nargs="+", help="checkpoints of the target models, in the order of --configs")
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--num_draft", type=int, nargs="+", default=[4], help="draft tokens per round, one run per value")
+    parser.add_argument("-k", "--top_k", type=str, default="0", help="one value per sub-token for Open-MAGVIT2, e.g. 0,0")
+    parser.add_argument("-t", "--temperature", type=str, default="1.0")
+    parser.add_argument("-p", "--top_p", type=str, default="1.0")
+    parser.add_argument("--cfg_scale", type=str, default="1.0")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--global_seed", type=int, default=0)
+    return parser
+
+if __name__ == "__main__":
+    sys.path.append(os.getcwd())
+    opt, unknown = get_parser().parse_known_args()
+    assert len(opt.configs) == len(opt.ckpts), "one checkpoint per target config"
+    torch.manual_seed(opt.global_seed)
+    factorized = opt.model == "Open-MAGVIT2"
+    sampling = dict(temperature=[float(v) for v in opt.temperature.split(",")], top_k=[int(v) for v in opt.top_k.split(",")],
+                    top_p=[float(v) for v in opt.top_p.split(",")], cfg_scale=[float(v) for v in opt.cfg_scale.split(",")])
+    if factorized: # one value per sub-token, a single value is used for both
+        sampling = {name: values * 2 if len(values) == 1 else values for name, values in sampling.items()}
+    else:
+        sampling = {name: values[0] for name, values in sampling.items()}
+    use_cfg = (sampling["cfg_scale"][0] if factorized else sampling["cfg_scale"]) > 1.0
+    draft, _ = load_model(OmegaConf.load(opt.draft_config), opt.draft_ckpt, gpu=True, eval_mode=True)
+    draft = draft.transformer
+
+    classes = torch.randint(0, draft.config.class_num, (opt.batch_size, 1), device=DEVICE)
+    x = torch.cat([classes, torch.full_like(classes, draft.config.class_num)]) if use_cfg else classes
+
+    for config, ckpt in zip(opt.configs, opt.ckpts):
+        target, _ = load_model(OmegaConf.load(config), ckpt, gpu=True, eval_mode=True)
+        target = target.transformer
+        for num_draft in opt.num_draft:
+            report = BENCHMARK[opt.model](x, target, draft, target.config.block_size, num_draft=num_draft,
+                                          repeats=opt.repeats, **sampling)
+            print(f"{os.path.basename(opt.draft_ckpt)} -> {os.path.basename(ckpt)}, {num_draft} draft tokens: "
+                  f"acceptance {100 * report['acceptance_rate']:.1f}%, {report['tokens_per_round']:.2f} tokens / round, "
+                  f"{report['target_seconds']:.2f} s -> {report['speculative_seconds']:.2f} s ({report['speedup']:.2f}x)")
+        del target
@@ -1,27 +1,43 @@
 import numpy as np
 import os
+import sys
+import zipfile
 import argparse
+from tqdm import tqdm
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) ## repository root, for metrics/
+from metrics.shards import ShardSet
 
 def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("--logdir", required=True)
+    parser.add_argument("--output", default="sample.npz", help="written to the logdir")
+    parser.add_argument("--block_size", type=int, default=1000, help="images gathered and written at a time")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the shuffle")
     return parser
 
-def combine_npz(logdir):
-    save_npzs = [npz for npz in os.listdir(logdir)]
-
-    npzs = []
-
-    for save_npz in save_npzs:
-        tem_npz = np.load(os.path.join(logdir, save_npz))
-        data = tem_npz["arr_0"]
-        npzs.append(data)
+def combine_npz(logdir, output="sample.npz", block_size=1000, seed=None):
+    """ Merge the sample shards of logdir/shards into one shuffled npz (arr_0, as the FID evaluators read it)
+    The shuffle is a permutation index over the memory-mapped shards and the output is streamed
+    block by block into the npz, so peak memory is block_size images whatever the sample count.
+    Only complete shards are read, never the previous output, which is replaced atomically.
+    """
+    samples = ShardSet.from_dir(os.path.join(logdir, "shards"))
+    permutation = np.random.default_rng(seed).permutation(len(samples))
+    print(f"Merging {len(samples)} samples from {len(samples.paths)} shards")
 
-    save_npz = np.vstack(npzs)
-    np.random.shuffle(save_npz)
-    np.savez(os.path.join(logdir, "sample.npz"), save_npz)
+    output_path = os.path.join(logdir, output)
+    tmp_path = output_path + ".tmp"
+    header = {"descr": np.lib.format.dtype_to_descr(samples.dtype), "fortran_order": False, "shape": samples.shape}
+    with zipfile.ZipFile(tmp_path, mode="w", compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+        with archive.open("arr_0.npy", mode="w", force_zip64=True) as f:
+            np.lib.format.write_array_header_1_0(f, header)
+            for block in tqdm(samples.iter_batches(block_size, order=permutation),
+                              total=(len(samples) + block_size - 1) // block_size, desc="Writing"):
+                f.write(np.ascontiguousarray(block).tobytes())
+    os.replace(tmp_path, output_path)
 
 if __name__ == "__main__":
     parser = get_parser()
     args = parser.parse_args()
-    combine_npz(args.logdir)
\ No newline at end of file
+    combine_npz(args.logdir, output=args.output, block_size=args.block_size, seed=args.seed)
@@ -0,0 +1,35 @@
+"""
+FID of the sample shards written by sample.py, read in place (no combine_npz needed)
+"""
+
+import argparse, os, sys
+import numpy as np
+import torch
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))) ## repository root, for metrics/
+from metrics.fid import calculate_frechet_distance
+from metrics.inception import InceptionV3
+from metrics.shards import ShardSet, inception_statistics
+
+DEVICE = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--logdir", required=True, help="sample directory holding shards/")
+    parser.add_argument("--ref_stats", required=True, help="npz with the reference 'mu' and 'sigma'")
+    parser.add_argument("--batch_size", type=int, default=200)
+    parser.add_argument("--save_stats", type=str, default=None, help="also save the sample mu / sigma to this npz")
+    return parser
+
+if __name__ == "__main__":
+    opt = get_parser().parse_args()
+    samples = ShardSet.from_dir(os.path.join(opt.logdir, "shards"))
+    print(f"{len(samples)} samples in {len(samples.paths)} shards")
+
+    inception_model = InceptionV3([InceptionV3.BLOCK_INDEX_BY_DIM[2048]]).to(DEVICE)
+    inception_model.eval()
+    mu, sigma = inception_statistics(samples, inception_model, batch_size=opt.batch_size, device=DEVICE)
+    if opt.save_stats:
+        np.savez(opt.save_stats, mu=mu, sigma=sigma)
+
+    ref = np.load(opt.ref_stats)
+    print("FID: ", calculate_frechet_distance(mu, sigma, ref["mu"], ref["sigma"]))
@@ -11,8 +11,9 @@ from PIL import Image
 from tqdm import tqdm, trange
 from einops import repeat
 import importlib
-from OpenImageTokenizer.Open_MAGVIT2.modules.transformer.gpt import sample_Open_MAGVIT2
-from OpenImageTokenizer.IBQ.modules.transformer.llama import sample_IBQ
+from OpenImageTokenizer.Open_MAGVIT2.modules.transformer.gpt import sample_Open_MAGVIT2, PrefixKVCache as MAGVIT2PrefixKVCache
+from OpenImageTokenizer.IBQ.modules.transformer.llama import sample_IBQ, cfg_enabled, PrefixKVCache as IBQPrefixKVCache
+from OpenImageTokenizer.samples import SamplingPipeline
 import time
 try:
     import torch_npu
@@ -31,6 +32,11 @@ SAMPLE = {
     "IBQ": sample_IBQ
 }
 
+PREFIX_CACHE = {
+    "Open-MAGVIT2": MAGVIT2PrefixKVCache,
+    "IBQ": IBQPrefixKVCache
+}
+
 def get_obj_from_str(string, reload=False):
     print(string)
     module, cls = string.rsplit(".", 1)
@@ -50,23 +56,27 @@ def chw_to_pillow(x):
 
 @torch.no_grad()
 def sample_classconditional(model, batch_size, class_label, model_type, steps=256, temperature=None, top_k=None, callback=None,
-                            dim_z=18, h=16, w=16, verbose_time=False, top_p=None, token_factorization=False, cfg_scale=1.0):
+                            dim_z=18, h=16, w=16, verbose_time=False, top_p=None, token_factorization=False, cfg_scale=1.0,
+                            prefix_cache=None, decode=True):
+    """
+    class_label: a class for the whole batch, or one class per sample (list / tensor) so that
+    a batch can mix classes. temperature, top_k, top_p and cfg_scale (each sub-token value
+    with token_factorization) can likewise be scalars or one value per sample.
+    prefix_cache: PREFIX_CACHE[model_type] instance reusing the class prefill across calls
+    decode: with False only the tokens are sampled, see decode_samples
+    """
     log = dict()
-    assert type(class_label) == int, f'expecting type int but type is {type(class_label)}'
     assert not model.be_unconditional, 'Expecting a class-conditional Net2NetTransformer.'
-    c_indices = repeat(torch.tensor([class_label]), '1 -> b 1', b=batch_size).to(model.device)  # class token
-    if token_factorization:
-        if cfg_scale[0] > 1.0:
-            cond_null = torch.ones_like(c_indices) * model.transformer.config.class_num
-            cond_combined = torch.concat([c_indices, cond_null], dim=0) #(2B 1)
-        else:
-            cond_combined = c_indices # B 1
+    if isinstance(class_label, int):
+        c_indices = repeat(torch.tensor([class_label]), '1 -> b 1', b=batch_size).to(model.device)  # class token
     else:
-        if cfg_scale > 1.0:
-            cond_null = torch.ones_like(c_indices) * model.transformer.config.class_num
-            cond_combined = torch.concat([c_indices, cond_null], dim=0) #(2B 1)
-        else:
-            cond_combined = c_indices # B 1
+        c_indices = torch.as_tensor(class_label).view(-1, 1).to(model.device)  # one class token per sample
+        batch_size = c_indices.shape[0]
+    if cfg_enabled(cfg_scale[0] if token_factorization else cfg_scale):
+        cond_null = torch.ones_like(c_indices) * model.transformer.config.class_num
+        cond_combined = torch.concat([c_indices, cond_null], dim=0) #(2B 1)
+    else:
+        cond_combined = c_indices # B 1
 
     
     qzshape = [batch_size, dim_z, h, w]
@@ -75,37 +85,60 @@ def sample_classconditional(model, batch_size, class_label, model_type, steps=25
     index_sample = SAMPLE[model_type](cond_combined, model.transformer, steps=steps,
                             sample_logits=True, top_k=top_k, callback=callback,
                             temperature=temperature, top_p=top_p, token_factorization=token_factorization,
-                            cfg_scale=cfg_scale)
+                            cfg_scale=cfg_scale, prefix_cache=prefix_cache)
     if verbose_time:
         sampling_time = time.time() - t1
         print(f"Full sampling takes about {sampling_time:.2f} seconds.")
+    log["class_label"] = c_indices
+    if not decode:
+        log["index_sample"] = index_sample
+        log["qzshape"] = qzshape
+        return log
     x_sample = model.decode_to_img(index_sample, qzshape)
     log["samples"] = x_sample
-    log["class_label"] = c_indices
+    return log
+
+@torch.no_grad()
+def decode_samples(model, log):
+    """ VQ decode the tokens of sample_classconditional(..., decode=False), the images go to the host """
+    log["samples"] = model.decode_to_img(log.pop("index_sample"), log.pop("qzshape")).cpu()
+    log["class_label"] = log["class_label"].cpu()
     return log
 
 @torch.no_grad()
 def run(logdir, model, batch_size, model_type, temperature, top_k, unconditional=True, num_samples=50000,
         given_classes=None, top_p=None, token_factorization=True, cfg_scale=1.0, dim_z=None):
-    batches = [batch_size for _ in range(num_samples//batch_size)] + [num_samples % batch_size]
     if not unconditional:
         assert given_classes is not None
         print("Running in pure class-conditional sampling mode. I will produce "
               f"{num_samples} samples for each of the {len(given_classes)} classes, "
               f"i.e. {num_samples*len(given_classes)} in total.")
-        for class_label in tqdm(given_classes, desc="Classes"):
-            for n, bs in tqdm(enumerate(batches), desc="Sampling Class"):
-                if bs == 0: break
-                logs = sample_classconditional(model, batch_size=bs, class_label=class_label, model_type=model_type,
-                                               temperature=temperature, top_k=top_k, top_p=top_p, token_factorization=token_factorization, cfg_scale=cfg_scale
-                                               ,dim_z=dim_z)
-                save_from_logs(logs, logdir, base_count=n * batch_size, cond_key=logs["class_label"])
+        ## class and per-class index of every sample, batches mix consecutive classes so all of them are full
+        labels = np.repeat(np.asarray(given_classes, dtype=np.int64), num_samples)
+        counts = np.tile(np.arange(num_samples), len(given_classes))
+        prefix_cache = PREFIX_CACHE[model_type]() ## class prefill computed once per class
+        ## batch N is decoded and written as png on worker threads while batch N+1 is sampled
+        pipeline = SamplingPipeline(lambda logs: decode_samples(model, logs),
+                                    lambda logs: save_from_logs(logs, logdir, base_count=logs["base_count"], cond_key=logs["class_label"],
+                                                                counts=logs["counts"]),
+                                    max_pending=2, device=model.device)
+        with pipeline:
+            for start in tqdm(range(0, len(labels), batch_size), desc="Sampling"):
+                batch_labels = torch.from_numpy(labels[start:start + batch_size])
+                with pipeline.timed("sample"):
+                    logs = sample_classconditional(model, batch_size=len(batch_labels), class_label=batch_labels, model_type=model_type,
+                                                   temperature=temperature, top_k=top_k, top_p=top_p, token_factorization=token_factorization, cfg_scale=cfg_scale
+                                                   ,dim_z=dim_z, prefix_cache=prefix_cache, decode=False)
+                logs["base_count"], logs["counts"] = start, counts[start:start + batch_size]
+                pipeline.submit(logs)
+        print("Stage utilization: " + ", ".join(f"{stage} {value:.0%}" for stage, value in pipeline.utilization().items()
+                                                if stage != "duration"))
 
-def save_from_logs(logs, logdir, base_count, key="samples", cond_key=None):
+def save_from_logs(logs, logdir, base_count, key="samples", cond_key=None, counts=None):
     xx = logs[key]
     for i, x in enumerate(xx):
         x = chw_to_pillow(x)
-        count = base_count + i
+        count = base_count + i if counts is None else counts[i]
         if cond_key is None:
             x.save(os.path.join(logdir, f"{count:06}.png"))
         else:
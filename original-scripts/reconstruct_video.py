@@ -22,7 +22,8 @@ import random
 from OpenImageTokenizer.Open_MAGVIT2.models.video_lfqgan import VQModel
 import OpenImageTokenizer.Open_MAGVIT2.data.video_transforms as video_transforms
 import OpenImageTokenizer.Open_MAGVIT2.data.volume_transforms as volume_transforms
-from decord import VideoReader, cpu
+from OpenImageTokenizer.Open_MAGVIT2.data.video_reader import iter_video_windows, save_video_frames
+from OpenImageTokenizer.Open_MAGVIT2.data.video_writer import VideoStreamWriter
 try:
     import torch_npu
 except:
@@ -79,33 +80,10 @@ def write_video(filepath: str, video: np.ndarray, fps: int = 24) -> None:
     return media.write_video(filepath, video, fps=fps)
 
 def save_image_frame(video_path, save_dir):
-    cap = cv2.VideoCapture(video_path)
-
     # save frame interval
     interval = 0.5 
-    fps = cap.get(cv2.CAP_PROP_FPS) # get FPS
-    frame_interval = int(fps * interval)
-
-    frame_count = 0
-    saved_count = 0
-    
-    if not os.path.exists(save_dir):
-        os.makedirs(save_dir, exist_ok=True)
-    
-    while cap.isOpened():
-        ret, frame = cap.read()
-        if not ret:
-            break
-
-        if frame_count % frame_interval == 0:
-            frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            frame_image_path = os.path.join(save_dir, f"frame_{saved_count * interval}.png")  # save PNG
-            imageio.imsave(frame_image_path, frame_rgb)
-            saved_count += 1
-
-        frame_count += 1
-
-    cap.release()
+    # decode only the saved frames and write the PNGs from a thread pool
+    save_video_frames(video_path, save_dir, interval=interval, filename="frame_{time}.png")
 
 def tensor2numpy(input_tensor: torch.Tensor, range_min: int = -1) -> np.ndarray:
     """
@@ -150,7 +128,7 @@ def main():
 
     transforms = video_transforms.Compose([
             video_transforms.Resize(resolution, interpolation="bilinear"),
-            video_transforms.RandomCrop(size=(resolution, resolution)),
+            video_transforms.CenterCrop(size=(resolution, resolution)), ##same crop for every window of a video
             volume_transforms.ClipToTensor(),
             video_transforms.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5]) ##adopted [0.5 rules]
         ])
@@ -168,53 +146,34 @@ def main():
     
     with torch.no_grad():
         for video_path in video_paths:
-            vr = VideoReader(rf"{video_path}")
-            sampled_frms = vr.get_batch(np.arange(0, len(vr), 1, dtype=int)).asnumpy().astype(np.uint8)
-            vlen = sampled_frms.shape[0]
-            videos = transforms(sampled_frms)
-            videos = videos.unsqueeze(0).to(DEVICE)
             iteration += 1
-            b, c, t, h, w = videos.shape
             temporal_window = 17
-            output_video_list = []
-            for idx in tqdm(range(0, (t - 1) // temporal_window + 1)):
-                start, end = idx * temporal_window, (idx + 1) * temporal_window
-                input_video = videos[:, :, start:end, ...]
-                if model.use_ema:
-                    with model.ema_scope():
+            visualize_dir = os.path.join(args.visualize_dir, args.version)
+            save_dir = os.path.join(visualize_dir, str(count))
+            if not os.path.exists(save_dir):
+                os.makedirs(save_dir, exist_ok=True)
+            save_original_file_path = os.path.join(save_dir, f"original_{count}.mp4")
+            save_reconstruct_file_path = os.path.join(save_dir, f"reconstructed_{count}.mp4")
+            ### frames are decoded and transformed window by window in a background thread,
+            ### and every window is appended to the videos as soon as it is reconstructed
+            with VideoStreamWriter(save_original_file_path) as original_writer, \
+                    VideoStreamWriter(save_reconstruct_file_path) as reconstruct_writer:
+                for input_video, _ in tqdm(iter_video_windows(video_path, temporal_window, transforms)):
+                    input_video = input_video.unsqueeze(0).to(DEVICE)
+                    if model.use_ema:
+                        with model.ema_scope():
+                            quant, diff, indices, _ = model.encode(input_video)
+                            reconstructed_video = model.decode(quant)
+                    else:
                         quant, diff, indices, _ = model.encode(input_video)
                         reconstructed_video = model.decode(quant)
-                else:
-                    quant, diff, indices, _ = model.encode(input_video)
-                    reconstructed_video = model.decode(quant)
-    
-                reconstructed_video = reconstructed_video.clamp(-1, 1)
-                output_video_list.append(reconstructed_video)
-            
-            reconstructed_videos = torch.concat(output_video_list, dim=2)
-            ### visualize the videos
-            visualize_dir = os.path.join(args.visualize_dir, args.version)
-            if not os.path.exists(visualize_dir):
-                os.makedirs(visualize_dir, exist_ok=True)
-            b = videos.shape[0]
-            for i in range(b):
-                video = videos[i]
-                reconstruct_video = reconstructed_videos[i]
-                np_original_video = tensor2numpy(video)
-                np_reconstruct_video = tensor2numpy(reconstruct_video)
-                save_original_dir = os.path.join(visualize_dir, str(count))
-                save_reconstruct_dir = os.path.join(visualize_dir, str(count))
-                if not os.path.exists(save_original_dir):
-                    os.makedirs(save_original_dir, exist_ok=True)
-                if not os.path.exists(save_reconstruct_dir):
-                    os.makedirs(save_reconstruct_dir, exist_ok=True)
-                save_original_file_path = os.path.join(save_original_dir, f"original_{count}.mp4")
-                save_reconstruct_file_path = os.path.join(save_reconstruct_dir, f"reconstructed_{count}.mp4")
-                write_video(save_original_file_path, np_original_video)
-                write_video(save_reconstruct_file_path, np_reconstruct_video)
-                ### save the frame
-                save_image_frame(save_original_file_path, os.path.join(visualize_dir, str(count), "original_frame"))
-                save_image_frame(save_reconstruct_file_path, os.path.join(visualize_dir, str(count), "reconstruct_frame"))
+
+                    original_writer.write(input_video[0])
+                    reconstruct_writer.write(reconstructed_video[0])
+
+            ### save the frame
+            save_image_frame(save_original_file_path, os.path.join(save_dir, "original_frame"))
+            save_image_frame(save_reconstruct_file_path, os.path.join(save_dir, "reconstruct_frame"))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -12,8 +12,9 @@ from PIL import Image
 from tqdm import tqdm, trange
 from einops import repeat
 import importlib
-from OpenImageTokenizer.Open_MAGVIT2.modules.transformer.gpt import sample_Open_MAGVIT2
-from OpenImageTokenizer.IBQ.modules.transformer.llama import sample_IBQ
+from OpenImageTokenizer.Open_MAGVIT2.modules.transformer.gpt import sample_Open_MAGVIT2, PrefixKVCache as MAGVIT2PrefixKVCache
+from OpenImageTokenizer.IBQ.modules.transformer.llama import sample_IBQ, cfg_enabled, PrefixKVCache as IBQPrefixKVCache
+from OpenImageTokenizer.samples import SamplingPipeline
 import time
 try:
     import torch_npu
@@ -32,6 +33,11 @@ SAMPLE = {
     "IBQ": sample_IBQ
 }
 
+PREFIX_CACHE = {
+    "Open-MAGVIT2": MAGVIT2PrefixKVCache,
+    "IBQ": IBQPrefixKVCache
+}
+
 def get_obj_from_str(string, reload=False):
     print(string)
     module, cls = string.rsplit(".", 1)
@@ -52,23 +58,26 @@ def chw_to_pillow(x):
 @torch.no_grad()
 def sample_classconditional(model, batch_size, class_label, model_type, steps=256, temperature=None, top_k=None, callback=None,
                             dim_z=18, h=16, w=16, verbose_time=False, top_p=None, token_factorization=False, 
-                            cfg_scale=1.0):
+                            cfg_scale=1.0, prefix_cache=None, decode=True):
+    """
+    class_label: a class for the whole batch, or one class per sample (list / tensor) so that
+    a batch can mix classes. temperature, top_k, top_p and cfg_scale (each sub-token value
+    with token_factorization) can likewise be scalars or one value per sample.
+    prefix_cache: PREFIX_CACHE[model_type] instance reusing the class prefill across calls
+    decode: with False only the tokens are sampled, see decode_samples
+    """
     log = dict()
-    assert type(class_label) == int, f'expecting type int but type is {type(class_label)}'
     assert not model.be_unconditional, 'Expecting a class-conditional Net2NetTransformer.'
-    c_indices = repeat(torch.tensor([class_label]), '1 -> b 1', b=batch_size).to(model.device)  # class token
-    if token_factorization:
-        if cfg_scale[0] > 1.0:
-            cond_null = torch.ones_like(c_indices) * model.transformer.config.class_num
-            cond_combined = torch.concat([c_indices, cond_null], dim=0) #(2B 1)
-        else:
-            cond_combined = c_indices # B 1
+    if isinstance(class_label, int):
+        c_indices = repeat(torch.tensor([class_label]), '1 -> b 1', b=batch_size).to(model.device)  # class token
     else:
-        if cfg_scale > 1.0:
-            cond_null = torch.ones_like(c_indices) * model.transformer.config.class_num
-            cond_combined = torch.concat([c_indices, cond_null], dim=0) #(2B 1)
-        else:
-            cond_combined = c_indices # B 1
+        c_indices = torch.as_tensor(class_label).view(-1, 1).to(model.device)  # one class token per sample
+        batch_size = c_indices.shape[0]
+    if cfg_enabled(cfg_scale[0] if token_factorization else cfg_scale):
+        cond_null = torch.ones_like(c_indices) * model.transformer.config.class_num
+        cond_combined = torch.concat([c_indices, cond_null], dim=0) #(2B 1)
+    else:
+        cond_combined = c_indices # B 1
 
     qzshape = [batch_size, dim_z, h, w]
     
@@ -76,35 +85,101 @@ def sample_classconditional(model, batch_size, class_label, model_type, steps=25
     index_sample = SAMPLE[model_type](cond_combined, model.transformer, steps=steps,
                             sample_logits=True, top_k=top_k, callback=callback,
                             temperature=temperature, top_p=top_p, token_factorization=token_factorization,
-                            cfg_scale=cfg_scale)
+                            cfg_scale=cfg_scale, prefix_cache=prefix_cache)
     if verbose_time:
         sampling_time = time.time() - t1
         print(f"Full sampling takes about {sampling_time:.2f} seconds.")
+    log["class_label"] = c_indices
+    if not decode:
+        log["index_sample"] = index_sample
+        log["qzshape"] = qzshape
+        return log
     x_sample = model.decode_to_img(index_sample, qzshape)
     log["samples"] = x_sample
-    log["class_label"] = c_indices
     return log
 
+@torch.no_grad()
+def decode_samples(model, log):
+    """ VQ decode the tokens of sample_classconditional(..., decode=False), the images go to the host """
+    log["samples"] = model.decode_to_img(log.pop("index_sample"), log.pop("qzshape")).cpu()
+    log["class_label"] = log["class_label"].cpu()
+    return log
+
+def plan_shards(given_classes, num_samples, shard_size, chunk_idx=0, num_chunks=1):
+    """ Split the class-major list of samples into shards and pick the ones of process chunk_idx
+    The classes are split into num_chunks contiguous ranges and a process owns the shards that
+    start in its range, so the shards (and the seeds of their batches) do not depend on num_chunks.
+    return: labels of all the samples, [(shard index, first sample, number of samples)] of this process
+    """
+    labels = np.repeat(np.asarray(given_classes, dtype=np.int64), num_samples)
+    own_classes = np.array_split(np.arange(len(given_classes)), num_chunks)[chunk_idx]
+    first = own_classes[0] * num_samples if len(own_classes) else 0
+    last = (own_classes[-1] + 1) * num_samples if len(own_classes) else 0
+    shards = [(index, start, min(shard_size, len(labels) - start))
+              for index, start in enumerate(range(0, len(labels), shard_size)) if first <= start < last]
+    return labels, shards
+
+def shard_path(logdir, index):
+    return os.path.join(logdir, "shards", f"shard_{index:05d}.npy")
+
+def batch_seed(global_seed, start):
+    """ seed of the batch starting at sample `start`, the same whatever process samples it """
+    return int(np.random.SeedSequence([global_seed, start]).generate_state(1)[0])
+
+def write_shard_batch(logs):
+    """ encode stage: uint8 images of one batch into the memory-mapped shard, the completed shard is renamed """
+    shard, offset = logs["shard"], logs["offset"]
+    images = save_npz_from_logs(logs, None, base_count=offset)
+    if "images" not in shard: ## image size known from the first decoded batch
+        shard["images"] = np.lib.format.open_memmap(shard["tmp_path"], mode="w+", dtype=np.uint8,
+                                                    shape=(shard["size"],) + images.shape[1:])
+    shard["images"][offset:offset + len(images)] = images
+    if offset + len(images) == shard["size"]:
+        shard["images"].flush()
+        del shard["images"]
+        os.replace(shard["tmp_path"], shard["path"]) ## the shard only exists once it is complete
+    return len(logs["samples"])
+
 @torch.no_grad()
 def run_for_evaluation(logdir, model, batch_size, temperature, top_k, model_type, dim_z, unconditional=True, num_samples=50000,
-        given_classes=None, top_p=None, token_factorization=False, cfg_scale=1.0, chunk_id=0):
-    batches = [batch_size for _ in range(num_samples//batch_size)] + [num_samples % batch_size]
+        given_classes=None, top_p=None, token_factorization=False, cfg_scale=1.0, chunk_id=0, num_chunks=1,
+        shard_size=1000, global_seed=0):
+    """
+    Samples are written to logdir/shards/shard_XXXXX.npy (uint8 [n, H, W, 3], class-major order)
+    as their batches complete, and a rerun skips the shards that are already complete. Every batch
+    is seeded from (global_seed, index of its first sample), so a sample does not depend on the
+    number of processes nor on where a previous run stopped.
+    """
     assert given_classes is not None
+    assert shard_size % batch_size == 0, "batches must not straddle shards"
+    labels, shards = plan_shards(given_classes, num_samples, shard_size, chunk_id, num_chunks)
+    todo = [shard for shard in shards if not os.path.exists(shard_path(logdir, shard[0]))]
     print("Running in pure class-conditional sampling mode. I will produce "
             f"{num_samples} samples for each of the {len(given_classes)} classes, "
-            f"i.e. {num_samples*len(given_classes)} in total.")
-    images_npz = []
-    for class_label in tqdm(given_classes, desc="Classes"):
-        for n, bs in tqdm(enumerate(batches), desc="Sampling Class"):
-            if bs == 0: break
-            logs = sample_classconditional(model, batch_size=bs, class_label=class_label,
-                                            temperature=temperature, top_k=top_k, top_p=top_p, token_factorization=token_factorization
-                                            ,cfg_scale=cfg_scale, dim_z=dim_z, model_type=model_type)
-            batch_images = save_npz_from_logs(logs, logdir, base_count=n * batch_size)
-            images_npz.append(batch_images)
-
-    images_npz = np.vstack(images_npz)
-    np.savez(os.path.join(logdir, 'samples_{}.npz'.format(chunk_id)), images_npz)
+            f"i.e. {num_samples*len(given_classes)} in total, in {len(shards)} shards for chunk {chunk_id}"
+            f" ({len(shards) - len(todo)} already complete).")
+    os.makedirs(os.path.join(logdir, "shards"), exist_ok=True)
+    ## batches mix consecutive classes so all of them are full
+    prefix_cache = PREFIX_CACHE[model_type]() ## class prefill computed once per class
+    ## batch N is decoded and written to its shard on worker threads while batch N+1 is sampled
+    pipeline = SamplingPipeline(lambda logs: decode_samples(model, logs), write_shard_batch,
+                                max_pending=2, device=model.device)
+    with pipeline:
+        for index, first, size in tqdm(todo, desc="Sampling shards"):
+            shard = {"path": shard_path(logdir, index), "tmp_path": shard_path(logdir, index) + ".tmp.npy", "size": size}
+            for offset in range(0, size, batch_size):
+                start = first + offset
+                batch_labels = torch.from_numpy(labels[start:min(start + batch_size, first + size)])
+                torch.manual_seed(batch_seed(global_seed, start))
+                with pipeline.timed("sample"):
+                    logs = sample_classconditional(model, batch_size=len(batch_labels), class_label=batch_labels,
+                                                    temperature=temperature, top_k=top_k, top_p=top_p, token_factorization=token_factorization
+                                                    ,cfg_scale=cfg_scale, dim_z=dim_z, model_type=model_type, prefix_cache=prefix_cache,
+                                                    decode=False)
+                logs["shard"], logs["offset"] = shard, offset
+                pipeline.submit(logs)
+    print("Stage utilization: " + ", ".join(f"{stage} {value:.0%}" for stage, value in pipeline.utilization().items()
+                                            if stage != "duration"))
 
 def save_npz_from_logs(logs, logdir, base_count, key="samples", cond_key=None):
     xx = logs[key]
@@ -218,6 +293,12 @@ def get_parser():
         type=int,
         default=4
     )
+    parser.add_argument(
+        "--shard_size",
+        type=int,
+        default=1000,
+        help="samples per .npy shard, a multiple of the batch size"
+    )
     parser.add_argument(
         "--model",
         choices=["Open-MAGVIT2", "IBQ"]
@@ -280,13 +361,11 @@ if __name__ == "__main__":
     chunk_id = opt.chunk_idx
     if opt.classes == "imagenet":
         given_classes = [i for i in range(1000)]
-        chunk_classes = len(given_classes) // opt.num_chunks ## should be divided
-        class_chunks = given_classes[ chunk_id * chunk_classes : (chunk_id+1) * chunk_classes ]
-        given_classes = class_chunks
     else:
         cls_str = opt.classes
         assert not cls_str.endswith(","), 'class string should not end with a ","'
         given_classes = [int(c) for c in cls_str.split(",")]
+    ## every process takes the shards of its range of classes, see plan_shards
 
     ### The ckpt should be only a name and the logdir is the version dir
     if opt.token_factorization:
@@ -303,7 +382,8 @@ if __name__ == "__main__":
     start_time = time.time()
     run_for_evaluation(logdir, model, opt.batch_size, opt.temperature, opt.top_k, unconditional=model.be_unconditional,
         given_classes=given_classes, num_samples=opt.num_samples, top_p=opt.top_p, token_factorization=opt.token_factorization,
-        cfg_scale=opt.cfg_scale, chunk_id=chunk_id, model_type=opt.model, dim_z=dim_z)
+        cfg_scale=opt.cfg_scale, chunk_id=chunk_id, num_chunks=opt.num_chunks, model_type=opt.model, dim_z=dim_z,
+        shard_size=opt.shard_size, global_seed=opt.global_seed)
     end_time = time.time()
     print(end_time - start_time, 's')
 